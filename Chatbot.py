@@ -1,565 +1,3742 @@
-import os
+import os
 import json
+import atexit
+import asyncio
+import base64
+import glob
+import hashlib
+import heapq
+import itertools
 import sqlite3
-import pickle
-import csv
 import re
+import queue
+import threading
+import time
 import unicodedata
+import weakref
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar, copy_context
+from pathlib import Path
 from typing import Optional
-from datetime import datetime
-from uuid import uuid4
-from functools import lru_cache
-
-from openai import OpenAI
-import numpy as np
-
-# =========================
-# 1. CẤU HÌNH ĐƯỜNG DẪN
-# =========================
-
-REPO_ROOT = os.path.dirname(os.path.abspath(__file__))
-
-
-def resolve_path(env_name: str, default_relative: str) -> str:
-    """
-    Pick a path from environment if provided, otherwise fall back to repo-relative.
-    This keeps local dev (Windows) and deploy (Linux) in sync without hardcoding drives.
-    """
-    env_value = os.getenv(env_name)
-    if env_value:
-        return env_value
-    return os.path.join(REPO_ROOT, default_relative)
-
-
-BASE_DIR = resolve_path("CHATBOT_DATA_DIR", "central_data")
-
+from datetime import datetime
+from uuid import uuid4
+
+import numpy as np
+
+import meta_store
+import metrics
+import vector_index
+from vocab_index import GENERIC_WORDS, VocabIndex, read_query_log
+
+# =========================
+# 1. CẤU HÌNH ĐƯỜNG DẪN
+# =========================
+
+REPO_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def resolve_path(env_name: str, default_relative: str) -> str:
+    """
+    Pick a path from environment if provided, otherwise fall back to repo-relative.
+    This keeps local dev (Windows) and deploy (Linux) in sync without hardcoding drives.
+    """
+    env_value = os.getenv(env_name)
+    if env_value:
+        return env_value
+    return os.path.join(REPO_ROOT, default_relative)
+
+
+BASE_DIR = resolve_path("CHATBOT_DATA_DIR", "central_data")
+
 SQLITE_PATH = os.path.join(BASE_DIR, "sqlite", "paintings.db")
 # Semantic index data (fallback when keyword search returns nothing)
 TOPIC_META_PATH = os.path.join(BASE_DIR, "vectors", "meta.pkl")
+# Columnar, mmap-able replacement for meta.pkl (`build_catalog.py meta-store`)
+TOPIC_META_STORE_PATH = os.path.join(BASE_DIR, "vectors", "meta")
 TOPIC_VECTORS_PATH = os.path.join(BASE_DIR, "vectors", "vectors.npy")
-
-LOG_DIR = resolve_path("CHATBOT_LOG_DIR", "logs")
+# Row-normalized copy written by `build_catalog.py topic-matrix` (mmap'd, float32/16)
+TOPIC_VECTORS_NORM_PATH = os.path.join(BASE_DIR, "vectors", "vectors_norm.npy")
+# Model + per-row text hashes of vectors.npy, written by `build_catalog.py vectors`
+TOPIC_MANIFEST_PATH = os.path.join(BASE_DIR, "vectors", "vectors_manifest.json")
+
+LOG_DIR = resolve_path("CHATBOT_LOG_DIR", "logs")
+# Cache bền vững (embedding...) dùng chung giữa các worker
+CACHE_DIR = os.getenv("CHATBOT_CACHE_DIR") or os.path.join(BASE_DIR, "cache")
+EMBED_CACHE_PATH = os.path.join(CACHE_DIR, "embeddings.sqlite")
 IMAGE_BASE_URL = os.getenv(
     "IMAGE_BASE_URL",
     "https://painting-cgi.s3.ap-southeast-1.amazonaws.com/",
 )
-
-# =========================
-# 2. OPENAI CLIENT & API KEY
-# =========================
-
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-if not OPENAI_API_KEY:
-    raise RuntimeError(
-        "❌ Chưa thiết lập biến môi trường OPENAI_API_KEY. "
-        "Hãy set trong hệ thống trước khi chạy chatbot."
-    )
-
-# client với timeout/retry ngắn hơn (giống file cũ đã tối ưu)
-client = OpenAI(timeout=25, max_retries=2)
-
-EMBED_MODEL = "text-embedding-3-small"  # 1536 chiều
-CHAT_MODEL = "gpt-4o-mini"
-
-# =========================
-# 3. TOPIC INDEX & EMBEDDING
-# =========================
-
-TOPIC_VECTORS = None
-TOPIC_META = None
-
-
-def load_topic_index():
-    """Nạp topic index (dùng cho semantic topic search)."""
-    global TOPIC_VECTORS, TOPIC_META
-    if TOPIC_VECTORS is not None and TOPIC_META is not None:
-        return
-
-    if not (os.path.exists(TOPIC_META_PATH) and os.path.exists(TOPIC_VECTORS_PATH)):
-        TOPIC_VECTORS = None
-        TOPIC_META = []
-        return
-
-    with open(TOPIC_META_PATH, "rb") as f:
-        TOPIC_META = pickle.load(f)
-
-    TOPIC_VECTORS = np.load(TOPIC_VECTORS_PATH).astype("float32")
-    # Topic index loaded; keep silent to avoid noisy CLI startup.
-
-
-@lru_cache(maxsize=256)
-def embed_text(text: str):
-    """Tạo embedding cho text (cache để giảm số lần gọi API)."""
-    resp = client.embeddings.create(
-        model=EMBED_MODEL,
-        input=text
-    )
-    return np.array(resp.data[0].embedding, dtype="float32")
-
-
-def get_db_connection():
-    if not os.path.exists(SQLITE_PATH):
-        raise RuntimeError(
-            f"SQLite database not found at {SQLITE_PATH}. "
-            "Set CHATBOT_DATA_DIR to point to the data directory."
-        )
-    conn = sqlite3.connect(SQLITE_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
-
-
-def normalize_query_for_like(q: str) -> str:
-    return f"%{q.strip()}%"
-
-
-def build_image_url(img_path: str) -> str:
-    """Normalize relative image path to absolute URL."""
-    if not img_path:
-        return ""
-    clean = img_path.replace("\\", "/").lstrip("/")
-    if clean.startswith("cgi/"):
-        clean = clean[len("cgi/"):]
-    return f"{IMAGE_BASE_URL.rstrip('/')}/{clean}"
+
+CATALOG_FILES = (
+    SQLITE_PATH, TOPIC_META_PATH, os.path.join(TOPIC_META_STORE_PATH, meta_store.MANIFEST),
+    TOPIC_VECTORS_PATH, TOPIC_VECTORS_NORM_PATH,
+)
+CATALOG_VERSION_TTL = 2.0
+_catalog_version_cache = (0.0, "")
+
+
+def files_version(max_age: float = CATALOG_VERSION_TTL) -> str:
+    """
+    Version stamp of the catalogue files on disk (mtime + size), re-checked at
+    most every `max_age` seconds.
+    """
+    global _catalog_version_cache
+    checked_at, version = _catalog_version_cache
+    now = time.monotonic()
+    if version and now - checked_at < max_age:
+        return version
+    parts = []
+    for path in CATALOG_FILES:
+        try:
+            st = os.stat(path)
+            parts.append(f"{st.st_mtime_ns}:{st.st_size}")
+        except OSError:
+            parts.append("-")
+    version = hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()[:12]
+    _catalog_version_cache = (now, version)
+    return version
+
+
+def catalog_version() -> str:
+    """
+    Version of the catalogue snapshot currently serving requests (see
+    CatalogManager). Caches that depend on the catalogue store it and drop
+    their entries when it changes, i.e. exactly when a reload is swapped in.
+    """
+    return current_catalog().version
 
 
 # =========================
-# 4. AGENT: RETRIEVER
+# 2. OPENAI CLIENT & API KEY
 # =========================
 
-STOPWORDS = {"tranh", "buc", "con", "hinh", "anh", "ve"}
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
+# client với timeout/retry ngắn hơn (giống file cũ đã tối ưu).
+# Tạo lazy để các lệnh build offline import được module mà không cần API key;
+# SDK openai cũng chỉ được import khi cần (import mất ~0.7s).
+client = None
 
-def strip_accents(text: str) -> str:
-    """Remove accents for accent-insensitive comparisons."""
-    normalized = unicodedata.normalize("NFD", text or "")
-    return "".join(ch for ch in normalized if unicodedata.category(ch) != "Mn")
+
+def require_openai_key():
+    if not OPENAI_API_KEY:
+        raise RuntimeError(
+            "❌ Chưa thiết lập biến môi trường OPENAI_API_KEY. "
+            "Hãy set trong hệ thống trước khi chạy chatbot."
+        )
 
 
-def extract_tokens(query: str):
+def preload_openai():
+    """Import SDK openai ngay (serve.py gọi trước khi fork để worker dùng chung)."""
+    import openai  # noqa: F401
+
+
+def get_openai_client():
+    global client
+    if client is None:
+        require_openai_key()
+        from openai import OpenAI
+        client = OpenAI(timeout=25, max_retries=2)
+    return client
+
+
+# Client async cho chế độ ASGI (asgi.py); cùng cấu hình timeout/retry.
+async_client = None
+
+
+def get_async_openai_client():
+    global async_client
+    if async_client is None:
+        require_openai_key()
+        from openai import AsyncOpenAI
+        async_client = AsyncOpenAI(timeout=25, max_retries=2)
+    return async_client
+
+
+# Mỗi request có 1 latency budget; mọi call OpenAI trong request dùng timeout
+# = min(cap của loại call, thời gian còn lại) và không retry. Circuit breaker
+# ngắt hẳn OpenAI khi lỗi liên tiếp -> Director trả lời bằng dữ liệu local.
+REQUEST_BUDGET_S = float(os.getenv("CHATBOT_REQUEST_BUDGET_S", "8"))
+EMBED_TIMEOUT_S = float(os.getenv("CHATBOT_EMBED_TIMEOUT_S", "2"))
+# Request embedding nhiều câu (batch) được chờ lâu hơn.
+EMBED_BATCH_TIMEOUT_S = float(os.getenv("CHATBOT_EMBED_BATCH_TIMEOUT_S", "15"))
+CHAT_TIMEOUT_S = float(os.getenv("CHATBOT_CHAT_TIMEOUT_S", "6"))
+MIN_CALL_BUDGET_S = 0.3  # còn ít hơn thế thì không gọi nữa
+BREAKER_FAILURES = int(os.getenv("CHATBOT_BREAKER_FAILURES", "5"))
+BREAKER_RESET_S = float(os.getenv("CHATBOT_BREAKER_RESET_S", "30"))
+
+
+class UpstreamUnavailable(RuntimeError):
+    """OpenAI không được gọi: breaker đang mở hoặc request hết budget."""
+
+
+class RequestBudget:
+    """Deadline, độ ưu tiên với OpenAI (PRIORITIES) + các phần đã phải chạy degraded."""
+
+    def __init__(self, seconds: float, priority: str = "interactive"):
+        self.deadline = time.monotonic() + seconds
+        self.priority = priority
+        self.degraded = set()
+
+    def remaining(self) -> float:
+        return self.deadline - time.monotonic()
+
+
+_request_budget: ContextVar[Optional[RequestBudget]] = ContextVar(
+    "chatbot_request_budget", default=None
+)
+
+
+def start_budget(seconds: float = REQUEST_BUDGET_S,
+                 priority: str = "interactive") -> RequestBudget:
+    """Gọi ở đầu mỗi request (ghi đè budget cũ; app.py gỡ nó khi request xong)."""
+    budget = RequestBudget(seconds, priority)
+    _request_budget.set(budget)
+    return budget
+
+
+def clear_budget():
+    """Gỡ budget của thread/task hiện tại (request xong, thread được dùng lại)."""
+    _request_budget.set(None)
+
+
+@contextmanager
+def request_budget(seconds: float = REQUEST_BUDGET_S, priority: str = "interactive"):
     """
-    Normalize and split the user query into tokens:
-    - lowercase + strip accents
-    - split on non-alphanumeric
-    - drop stopwords like 'tranh', 'con' to focus on core nouns
+    `with request_budget() as budget:` — budget của 1 request, gỡ khi xong để
+    budget đã hết hạn không sang request sau trên cùng thread (waitress dùng
+    lại thread).
     """
-    clean = strip_accents((query or "").lower())
-    raw_tokens = re.split(r"[^a-z0-9]+", clean)
-    return [t for t in raw_tokens if t and t not in STOPWORDS]
+    budget = RequestBudget(seconds, priority)
+    token = _request_budget.set(budget)
+    try:
+        yield budget
+    finally:
+        try:
+            _request_budget.reset(token)
+        except ValueError:  # generator được đóng ở context khác
+            _request_budget.set(None)
 
 
-class RetrieverAgent:
-    """
-    Nhiệm vụ:
-    - Tìm tranh trong SQLite bằng keyword.
-    - Nếu cần thì dùng semantic topic search (theo topic_meta + vectors).
+def current_budget() -> Optional[RequestBudget]:
+    return _request_budget.get()
+
+
+class CircuitBreaker:
+    """
+    closed -> open sau `failures` lỗi liên tiếp; open -> half-open sau
+    `reset_s` giây (cho đúng 1 request thử); thử thành công thì closed lại.
     """
 
-    def keyword_search_paintings(self, user_input: str, limit: Optional[int] = None):
-        conn = get_db_connection()
-        conn.create_function("strip_accents", 1, strip_accents)
-        cur = conn.cursor()
+    def __init__(self, name: str, failures: int = BREAKER_FAILURES,
+                 reset_s: float = BREAKER_RESET_S):
+        self.name = name
+        self.failures = failures
+        self.reset_s = reset_s
+        self._consecutive = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+        self.trips = 0
+        self.rejected = 0
 
-        tokens = extract_tokens(user_input)
-        if not tokens:
-            normalized = strip_accents((user_input or "").lower().strip())
-            tokens = [normalized] if normalized else []
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if not self._probing and time.monotonic() - self._opened_at >= self.reset_s:
+                self._probing = True
+                return True
+            self.rejected += 1
+            return False
 
-        columns = ["title", "keywords", "themes", "emotions"]
-        clauses = []
-        params = []
-        for tok in tokens:
-            like_pattern = f"%{tok}%"
-            clause = " OR ".join([f"strip_accents(lower({col})) LIKE ?" for col in columns])
-            clauses.append(f"({clause})")
-            params.extend([like_pattern] * len(columns))
+    def record_success(self):
+        with self._lock:
+            self._consecutive = 0
+            self._opened_at = None
+            self._probing = False
 
-        where_sql = " AND ".join(clauses) if clauses else "1=1"
+    def record_failure(self):
+        with self._lock:
+            self._consecutive += 1
+            if self._probing or (self._opened_at is None and self._consecutive >= self.failures):
+                if not self._probing:
+                    self.trips += 1
+                self._opened_at = time.monotonic()
+            self._probing = False
 
-        query = f"""
-            SELECT id, title, image, general_info, keywords, themes, emotions,
-                   description_short, json_path
-            FROM paintings
-            WHERE {where_sql}
-            ORDER BY id ASC
-        """
-        if limit is not None:
-            query += "\n            LIMIT ?;"
-            params.append(limit)
-        else:
-            query += ";"
-
-        cur.execute(query, params)
-        rows = cur.fetchall()
-        conn.close()
-
-        results = []
-        for r in rows:
-            results.append({
-                "id": r["id"],
-                "title": r["title"],
-                "image": r["image"],
-                "general_info": r["general_info"],
-                "keywords": (r["keywords"] or "").split(",") if r["keywords"] else [],
-                "themes": (r["themes"] or "").split(",") if r["themes"] else [],
-                "emotions": (r["emotions"] or "").split(",") if r["emotions"] else [],
-                "description_short": r["description_short"],
-                "json_path": r["json_path"]
-            })
-
-        return results
-
-    def semantic_topic_search(
-        self,
-        user_input: str,
-        top_k_topics: int = 2,
-        max_items: Optional[int] = None
-    ):
-        load_topic_index()
-        if TOPIC_VECTORS is None or len(TOPIC_META) == 0:
-            return []
+    def release(self):
+        """Call kết thúc mà không rõ thành/bại: cho phép lần thử khác."""
+        with self._lock:
+            self._probing = False
+
+    @property
+    def is_open(self) -> bool:
+        with self._lock:
+            return self._opened_at is not None
+
+    def stats(self) -> dict:
+        return {"open": int(self.is_open), "trips": self.trips, "rejected": self.rejected}
+
+
+EMBED_BREAKER = CircuitBreaker("embedding")
+CHAT_BREAKER = CircuitBreaker("chat")
+metrics.register_stats("breaker_embedding", EMBED_BREAKER.stats)
+metrics.register_stats("breaker_chat", CHAT_BREAKER.stats)
+
+
+# Scheduler trước mọi call OpenAI: token bucket theo request/phút và token/phút,
+# giới hạn số call đồng thời, hàng đợi có giới hạn xếp theo ưu tiên. Giới hạn
+# tính cho từng process (chia cho --workers khi pre-fork). 0 = không giới hạn.
+OPENAI_RPM = float(os.getenv("CHATBOT_OPENAI_RPM", "500"))
+OPENAI_TPM = float(os.getenv("CHATBOT_OPENAI_TPM", "200000"))
+OPENAI_CONCURRENCY = int(os.getenv("CHATBOT_OPENAI_CONCURRENCY", "16"))
+OPENAI_QUEUE_MAX = int(os.getenv("CHATBOT_OPENAI_QUEUE_MAX", "64"))
+# Lượt chat interactive chờ trong hàng đợi tối đa bấy nhiêu giây rồi degraded;
+# batch/rebuild chờ đến hết budget.
+OPENAI_QUEUE_WAIT_S = float(os.getenv("CHATBOT_OPENAI_QUEUE_WAIT_S", "2"))
+PRIORITIES = {"interactive": 0, "batch": 1, "rebuild": 2}
+RATE_LIMITED_PAUSE_S = 1.0  # OpenAI trả 429 mà không có Retry-After
+SCHEDULER_POLL_S = 1.0
+
+
+class SchedulerRejected(UpstreamUnavailable):
+    """Hàng đợi OpenAI đầy (queue_full) hoặc chờ quá hạn (queue_timeout)."""
+
+    def __init__(self, reason: str):
+        super().__init__(f"openai scheduler: {reason}")
+        self.reason = reason
+
+
+def estimate_tokens(texts, max_tokens: int = 0) -> int:
+    """
+    Token 1 call chiếm trong TPM, tính như phía OpenAI: prompt ước lượng
+    (~3 ký tự / token với tiếng Việt) + max_tokens của output.
+    """
+    return sum(len(t or "") for t in texts) // 3 + 1 + max_tokens
+
+
+class TokenBucket:
+    """`per_min` đơn vị / phút, tích luỹ tối đa 1 phút; per_min <= 0 = không giới hạn."""
+
+    def __init__(self, per_min: float):
+        self.capacity = per_min
+        self.rate = per_min / 60.0
+        self.level = per_min
+        self.stamp = time.monotonic()
+
+    def wait_s(self, amount: float, now: float) -> float:
+        """0 nếu lấy được `amount` ngay, nếu không thì số giây đến khi đủ."""
+        if self.rate <= 0:
+            return 0.0
+        self.level = min(self.capacity, self.level + (now - self.stamp) * self.rate)
+        self.stamp = now
+        need = min(amount, self.capacity)
+        return 0.0 if self.level >= need else (need - self.level) / self.rate
+
+    def take(self, amount: float):
+        if self.rate > 0:
+            self.level -= min(amount, self.capacity)
+
+
+class _Waiter:
+    __slots__ = ("priority", "seq", "tokens", "granted", "evicted", "wake")
+
+    def __init__(self, priority: int, seq: int, tokens: int):
+        self.priority = priority
+        self.seq = seq
+        self.tokens = tokens
+        self.granted = False
+        self.evicted = False
+        self.wake = None
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class OpenAIScheduler:
+    """
+    Call chạy ngay nếu hàng đợi trống và đủ slot + bucket; nếu không thì vào
+    hàng đợi (heap theo ưu tiên, rồi thứ tự đến) và chỉ call đầu hàng được cấp
+    quyền, nên call lớn không bị call nhỏ chen mãi. Hàng đầy: call ưu tiên cao
+    đẩy call ưu tiên thấp nhất (mới nhất) ra, nếu không thì bị từ chối ngay.
+    Dùng được từ thread (acquire) và event loop (aacquire).
+    """
+
+    def __init__(self, rpm: float = OPENAI_RPM, tpm: float = OPENAI_TPM,
+                 concurrency: int = OPENAI_CONCURRENCY, queue_max: int = OPENAI_QUEUE_MAX):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.concurrency = concurrency
+        self.queue_max = queue_max
+        self.in_flight = 0
+        self._queue = []
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.rejected = Counter()
+
+    def _ready_in(self, tokens: int, now: float) -> Optional[float]:
+        """0 = chạy được ngay; > 0 = giây đến khi bucket đủ; None = hết slot đồng thời."""
+        if self.concurrency > 0 and self.in_flight >= self.concurrency:
+            return None
+        return max(
+            self._paused_until - now,
+            self.requests.wait_s(1, now),
+            self.tokens.wait_s(tokens, now),
+            0.0,
+        )
+
+    def _start(self, tokens: int):
+        self.in_flight += 1
+        self.requests.take(1)
+        self.tokens.take(tokens)
+        self.admitted += 1
+
+    def _dispatch(self, now: float) -> Optional[float]:
+        """Cấp quyền cho các call đầu hàng khi đủ tài nguyên; trả thời gian chờ của đầu hàng."""
+        while self._queue:
+            head = self._queue[0]
+            wait = self._ready_in(head.tokens, now)
+            if wait != 0:
+                return wait
+            heapq.heappop(self._queue)
+            self._start(head.tokens)
+            head.granted = True
+            head.wake()
+        return None
 
+    def _admit(self, tokens: int, priority: int) -> Optional[_Waiter]:
+        """None nếu được chạy ngay, nếu không thì _Waiter đã vào hàng (giữ lock)."""
+        now = time.monotonic()
+        if not self._queue and self._ready_in(tokens, now) == 0:
+            self._start(tokens)
+            return None
+        if self.queue_max > 0 and len(self._queue) >= self.queue_max:
+            worst = max(self._queue)
+            if worst.priority <= priority:
+                self.rejected["queue_full"] += 1
+                raise SchedulerRejected("queue_full")
+            self._queue.remove(worst)
+            heapq.heapify(self._queue)
+            worst.evicted = True
+            worst.wake()
+        waiter = _Waiter(priority, next(self._seq), tokens)
+        heapq.heappush(self._queue, waiter)
+        return waiter
+
+    def _poll(self, waiter: _Waiter, deadline: Optional[float]) -> Optional[float]:
+        """None khi đã được cấp quyền, nếu không thì số giây nên ngủ trước lần poll sau."""
+        with self._lock:
+            now = time.monotonic()
+            if not waiter.granted:
+                self._dispatch(now)
+            if waiter.granted:
+                return None
+            if waiter.evicted:
+                self.rejected["queue_full"] += 1
+                raise SchedulerRejected("queue_full")
+            if deadline is not None and now >= deadline:
+                self._queue.remove(waiter)
+                heapq.heapify(self._queue)
+                self.rejected["queue_timeout"] += 1
+                raise SchedulerRejected("queue_timeout")
+            sleep = self._ready_in(self._queue[0].tokens, now) or SCHEDULER_POLL_S
+            if deadline is not None:
+                sleep = min(sleep, deadline - now)
+            return max(sleep, 0.001)
+
+    def _abandon(self, waiter: _Waiter):
+        """Caller bị huỷ khi đang chờ: bỏ khỏi hàng, hoặc trả slot đã được cấp."""
+        with self._lock:
+            if waiter.granted:
+                self.in_flight -= 1
+                self._dispatch(time.monotonic())
+            elif waiter in self._queue:
+                self._queue.remove(waiter)
+                heapq.heapify(self._queue)
+
+    def acquire(self, tokens: int, priority: str = "interactive",
+                deadline: Optional[float] = None) -> float:
+        """Chờ đến lượt (raise SchedulerRejected); trả số giây đã chờ."""
+        start = time.monotonic()
+        with self._lock:
+            waiter = self._admit(tokens, PRIORITIES.get(priority, 0))
+            if waiter is not None:
+                event = threading.Event()
+                waiter.wake = event.set
         try:
-            q_vec = embed_text(user_input)
+            while waiter is not None:
+                sleep = self._poll(waiter, deadline)
+                if sleep is None:
+                    break
+                event.wait(sleep)
+        except BaseException as e:
+            if not isinstance(e, SchedulerRejected):
+                self._abandon(waiter)
+            raise
+        return self._observe_wait(start, priority)
+
+    async def aacquire(self, tokens: int, priority: str = "interactive",
+                       deadline: Optional[float] = None) -> float:
+        start = time.monotonic()
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            waiter = self._admit(tokens, PRIORITIES.get(priority, 0))
+            if waiter is not None:
+                woken = loop.create_future()
+
+                def wake():
+                    loop.call_soon_threadsafe(lambda: woken.done() or woken.set_result(None))
+
+                waiter.wake = wake
+        try:
+            while waiter is not None:
+                sleep = self._poll(waiter, deadline)
+                if sleep is None:
+                    break
+                try:
+                    await asyncio.wait_for(asyncio.shield(woken), sleep)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException as e:
+            if not isinstance(e, SchedulerRejected):
+                self._abandon(waiter)
+            raise
+        return self._observe_wait(start, priority)
+
+    @staticmethod
+    def _observe_wait(start: float, priority: str) -> float:
+        waited = time.monotonic() - start
+        metrics.OPENAI_QUEUE_WAIT.observe(waited, priority=priority)
+        metrics.record_timing("openai_queue", waited * 1000)
+        return waited
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+            self._dispatch(time.monotonic())
+
+    def pause(self, seconds: float):
+        """OpenAI trả 429: ngưng cấp quyền `seconds` giây thay vì để các call retry dồn dập."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def saturated(self) -> bool:
+        """Hàng đợi đầy: không nhận thêm việc batch."""
+        with self._lock:
+            return self.queue_max > 0 and len(self._queue) >= self.queue_max
+
+    def stats(self) -> dict:
+        with self._lock:
+            queued = Counter(w.priority for w in self._queue)
+            stats = {
+                "in_flight": self.in_flight,
+                "queued": len(self._queue),
+                "admitted": self.admitted,
+                "rejected_queue_full": self.rejected["queue_full"],
+                "rejected_queue_timeout": self.rejected["queue_timeout"],
+                "paused": int(self._paused_until > time.monotonic()),
+            }
+        for name, level in PRIORITIES.items():
+            stats[f"queued_{name}"] = queued[level]
+        return stats
+
+
+OPENAI_SCHEDULER = OpenAIScheduler()
+metrics.register_stats("openai_scheduler", OPENAI_SCHEDULER.stats)
+
+
+def _skip_upstream(breaker: CircuitBreaker, budget: Optional[RequestBudget], reason: str):
+    if budget is not None:
+        budget.degraded.add(breaker.name)
+    metrics.UPSTREAM_SKIPPED.inc(upstream=breaker.name, reason=reason)
+
+
+def _call_timeout(breaker: CircuitBreaker, cap_s: float,
+                  budget: Optional[RequestBudget]) -> Optional[float]:
+    if budget is None:
+        return None
+    timeout = min(cap_s, budget.remaining())
+    if timeout < MIN_CALL_BUDGET_S:
+        _skip_upstream(breaker, budget, "budget")
+        raise UpstreamUnavailable(f"{breaker.name}: request budget exhausted")
+    return timeout
+
+
+def _queue_deadline(budget: Optional[RequestBudget]) -> Optional[float]:
+    """Hạn chờ hàng đợi: chừa MIN_CALL_BUDGET_S cho call; interactive tối đa QUEUE_WAIT_S."""
+    if budget is None:
+        return None
+    deadline = budget.deadline - MIN_CALL_BUDGET_S
+    if budget.priority == "interactive":
+        deadline = min(deadline, time.monotonic() + OPENAI_QUEUE_WAIT_S)
+    return deadline
+
+
+def _check_upstream(breaker: CircuitBreaker, cap_s: float) -> Optional[RequestBudget]:
+    """Trước khi vào hàng đợi: còn budget và breaker cho gọi."""
+    budget = current_budget()
+    _call_timeout(breaker, cap_s, budget)
+    if not breaker.allow():
+        _skip_upstream(breaker, budget, "circuit_open")
+        raise UpstreamUnavailable(f"{breaker.name}: circuit open")
+    return budget
+
+
+def _not_admitted(breaker: CircuitBreaker, budget: Optional[RequestBudget], error):
+    breaker.release()
+    if isinstance(error, SchedulerRejected):
+        _skip_upstream(breaker, budget, error.reason)
+
+
+def _admitted_timeout(breaker: CircuitBreaker, cap_s: float,
+                      budget: Optional[RequestBudget]) -> Optional[float]:
+    """Timeout của call sau khi đã chờ hàng đợi (hết budget thì trả slot)."""
+    try:
+        return _call_timeout(breaker, cap_s, budget)
+    except UpstreamUnavailable:
+        OPENAI_SCHEDULER.release()
+        breaker.release()
+        raise
+
+
+def _record_outcome(breaker: CircuitBreaker, budget: Optional[RequestBudget], error):
+    OPENAI_SCHEDULER.release()
+    if error is None:
+        breaker.record_success()
+    elif isinstance(error, Exception):
+        breaker.record_failure()
+        if budget is not None:
+            budget.degraded.add(breaker.name)
+        if getattr(error, "status_code", None) == 429:
+            headers = getattr(getattr(error, "response", None), "headers", None) or {}
+            try:
+                pause = float(headers.get("retry-after"))
+            except (TypeError, ValueError):
+                pause = RATE_LIMITED_PAUSE_S
+            OPENAI_SCHEDULER.pause(pause)
+    else:
+        breaker.release()  # client ngắt stream / task bị huỷ: không tính là lỗi
+
+
+def _priority(budget: Optional[RequestBudget]) -> str:
+    return budget.priority if budget is not None else "rebuild"
+
+
+@contextmanager
+def upstream_call(breaker: CircuitBreaker, cap_s: float, tokens: int = 1):
+    """
+    `with upstream_call(breaker, cap, tokens) as timeout:` — timeout cho call
+    (None khi không có budget, vd. build offline). Chờ OPENAI_SCHEDULER cấp
+    quyền (`tokens` = estimate_tokens của call); raise UpstreamUnavailable nếu
+    không được gọi; lỗi của call được tính vào breaker.
+    """
+    budget = _check_upstream(breaker, cap_s)
+    try:
+        OPENAI_SCHEDULER.acquire(tokens, _priority(budget), _queue_deadline(budget))
+    except BaseException as e:
+        _not_admitted(breaker, budget, e)
+        raise
+    timeout = _admitted_timeout(breaker, cap_s, budget)
+    error = None
+    try:
+        yield timeout
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        _record_outcome(breaker, budget, error)
+
+
+@asynccontextmanager
+async def aupstream_call(breaker: CircuitBreaker, cap_s: float, tokens: int = 1):
+    """Như upstream_call cho code async (chờ scheduler không chặn event loop)."""
+    budget = _check_upstream(breaker, cap_s)
+    try:
+        await OPENAI_SCHEDULER.aacquire(tokens, _priority(budget), _queue_deadline(budget))
+    except BaseException as e:
+        _not_admitted(breaker, budget, e)
+        raise
+    timeout = _admitted_timeout(breaker, cap_s, budget)
+    error = None
+    try:
+        yield timeout
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        _record_outcome(breaker, budget, error)
+
+
+def with_timeout(openai_client, timeout: Optional[float]):
+    """Client dùng cho 1 call: timeout theo budget, không retry."""
+    if timeout is None:
+        return openai_client
+    return openai_client.with_options(timeout=timeout, max_retries=0)
+
+
+# Call trùng đang chạy chờ tối đa bấy nhiêu giây (và không quá budget còn lại)
+# trước khi tự gọi riêng.
+SINGLEFLIGHT_WAIT_S = float(os.getenv("CHATBOT_SINGLEFLIGHT_WAIT_S", "10"))
+_LEADER_ABORTED = object()
+
+
+class SingleFlight:
+    """
+    Gộp các call cùng key đang chạy đồng thời: call đầu tiên (leader) chạy
+    thật, các call trùng chờ chung kết quả hoặc exception của nó. Chỉ gộp
+    call đang bay, không cache: leader tự ghi cache bên trong `fn`.
+    Follower chờ quá hạn, hoặc leader bị huỷ (client ngắt, task cancel),
+    thì tự chạy `fn` như không có coalescing.
+    """
+
+    def __init__(self, layer: str, wait_s: float = SINGLEFLIGHT_WAIT_S):
+        self.layer = layer
+        self.wait_s = wait_s
+        self._calls = {}        # key -> Future (thread)
+        self._async_calls = {}  # key -> asyncio.Future (event loop)
+        self._lock = threading.Lock()
+
+    def _wait_s(self) -> float:
+        budget = current_budget()
+        if budget is None:
+            return self.wait_s
+        return max(0.0, min(self.wait_s, budget.remaining()))
+
+    def _shared(self, outcome):
+        ok, value = outcome
+        if ok:
+            metrics.SINGLEFLIGHT_CALLS.inc(layer=self.layer, role="shared")
+            return True, value
+        if value is _LEADER_ABORTED:
+            return False, None
+        metrics.SINGLEFLIGHT_CALLS.inc(layer=self.layer, role="shared")
+        raise value
+
+    def do(self, key, fn, *args):
+        with self._lock:
+            flight = self._calls.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._calls[key] = Future()
+        if not leader:
+            try:
+                done, value = self._shared(flight.result(timeout=self._wait_s()))
+                if done:
+                    return value
+            except FutureTimeout:
+                metrics.SINGLEFLIGHT_CALLS.inc(layer=self.layer, role="timeout")
+            return fn(*args)
+
+        metrics.SINGLEFLIGHT_CALLS.inc(layer=self.layer, role="leader")
+        outcome = (False, _LEADER_ABORTED)
+        try:
+            value = fn(*args)
+            outcome = (True, value)
+            return value
         except Exception as e:
-            print(f"[Retriever] Semantic embedding error: {e}")
-            return []
-        q_norm = q_vec / (np.linalg.norm(q_vec) + 1e-8)
-        topic_norm = TOPIC_VECTORS / (
-            np.linalg.norm(TOPIC_VECTORS, axis=1, keepdims=True) + 1e-8
+            outcome = (False, e)
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            flight.set_result(outcome)
+
+    async def ado(self, key, fn, *args):
+        """Như do() cho coroutine `fn` (các call cùng 1 event loop)."""
+        loop = asyncio.get_running_loop()
+        flight = self._async_calls.get(key)
+        if flight is not None and flight.get_loop() is loop:
+            try:
+                outcome = await asyncio.wait_for(asyncio.shield(flight), self._wait_s())
+                done, value = self._shared(outcome)
+                if done:
+                    return value
+            except asyncio.TimeoutError:
+                metrics.SINGLEFLIGHT_CALLS.inc(layer=self.layer, role="timeout")
+            return await fn(*args)
+
+        flight = self._async_calls[key] = loop.create_future()
+        metrics.SINGLEFLIGHT_CALLS.inc(layer=self.layer, role="leader")
+        outcome = (False, _LEADER_ABORTED)
+        try:
+            value = await fn(*args)
+            outcome = (True, value)
+            return value
+        except Exception as e:
+            outcome = (False, e)
+            raise
+        finally:
+            if self._async_calls.get(key) is flight:
+                del self._async_calls[key]
+            flight.set_result(outcome)
+
+
+EMBED_MODEL = "text-embedding-3-small"  # 1536 chiều
+EMBED_BATCH_MAX = 1024  # số câu tối đa trong 1 request embedding (API cho tối đa 2048)
+CHAT_MODEL = "gpt-4o-mini"
+SUMMARY_MAX_TOKENS = 400
+# "openai" (mặc định) hoặc "local" (hash embedding, chạy offline/test)
+EMBED_BACKEND = os.getenv("CHATBOT_EMBED_BACKEND", "openai")
+
+# =========================
+# 3. TOPIC INDEX & EMBEDDING
+# =========================
+
+# Ma trận vector (đã chuẩn hoá theo hàng), meta.pkl và vector index thuộc về
+# CatalogSnapshot hiện tại (mục 4), đổi nguyên khối khi reload catalogue.
+# "exact" (numpy, mặc định) hoặc "flat" / "ivf" / "hnsw" (FAISS, build bằng
+# `python build_catalog.py vector-index --kind ...`; thiếu faiss/file -> exact).
+VECTOR_INDEX_KIND = os.getenv("CHATBOT_VECTOR_INDEX", "exact")
+
+
+def normalize_rows(matrix, dtype="float32"):
+    """L2-normalize each row (same epsilon as the old per-request code)."""
+    matrix = np.asarray(matrix, dtype="float32")
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True) + 1e-8
+    return (matrix / norms).astype(dtype, copy=False)
+
+
+def load_topic_matrix():
+    """
+    Prefer the prebuilt normalized matrix, memory-mapped so every worker shares
+    the same page cache; otherwise normalize vectors.npy once in this process.
+    """
+    if os.path.exists(TOPIC_VECTORS_NORM_PATH) and (
+        os.path.getmtime(TOPIC_VECTORS_NORM_PATH) >= os.path.getmtime(TOPIC_VECTORS_PATH)
+    ):
+        return np.load(TOPIC_VECTORS_NORM_PATH, mmap_mode="r")
+    return normalize_rows(np.load(TOPIC_VECTORS_PATH, mmap_mode="r"))
+
+
+def read_topic_index():
+    """
+    (vectors, meta) từ đĩa; (None, []) nếu thiếu file hoặc sai model embedding.
+    meta là MetaStore (mmap) nếu đã có meta store, không thì meta.pkl.
+    """
+    if not os.path.exists(TOPIC_VECTORS_PATH):
+        return None, []
+
+    if os.path.exists(TOPIC_MANIFEST_PATH):
+        with open(TOPIC_MANIFEST_PATH, encoding="utf-8") as f:
+            built_with = json.load(f).get("model")
+        if built_with and built_with != get_embedding_backend().name:
+            print(
+                f"[Retriever] vectors.npy được build bằng {built_with}, "
+                f"không khớp backend {get_embedding_backend().name} -> tắt semantic search."
+            )
+            return None, []
+
+    meta = meta_store.load_meta(TOPIC_META_STORE_PATH, TOPIC_META_PATH)
+    if meta is None:
+        return None, []
+    vectors = load_topic_matrix()
+    if len(meta) != vectors.shape[0]:
+        raise ValueError(
+            f"meta có {len(meta)} dòng nhưng vectors.npy có {vectors.shape[0]} dòng"
+        )
+    return vectors, meta
+
+
+def load_topic_index():
+    """(vectors, meta) của catalogue hiện tại (dùng cho semantic topic search)."""
+    return current_catalog().topic()
+
+
+def open_vector_index(vectors):
+    """VectorIndex theo CHATBOT_VECTOR_INDEX; thiếu faiss/file -> exact."""
+    index = None
+    if VECTOR_INDEX_KIND != "exact":
+        index = vector_index.VectorIndex.load(
+            vector_index.index_path(os.path.dirname(TOPIC_VECTORS_PATH), VECTOR_INDEX_KIND),
+            matrix=vectors,
+            stamp=vector_index.source_stamp(TOPIC_VECTORS_PATH),
         )
-
-        scores = topic_norm @ q_norm  # cosine similarity
-        top_idx = np.argsort(scores)[::-1][:top_k_topics]
-
-        candidate_ids = []
-        for idx in top_idx:
-            meta = TOPIC_META[idx]
-            ids = meta.get("suggest_ids") or []
-            if not ids and meta.get("id") is not None:
-                ids = [meta.get("id")]
-            candidate_ids.extend(ids)
-
-        # loại trùng, giữ thứ tự
-        seen = set()
-        unique_ids = []
-        max_allowed = max_items if max_items is not None else float("inf")
-        for i in candidate_ids:
-            if i not in seen:
-                seen.add(i)
-                unique_ids.append(i)
-            if len(unique_ids) >= max_allowed:
-                break
-
-        if not unique_ids:
-            return []
-
-        conn = get_db_connection()
-        cur = conn.cursor()
-
-        placeholders = ",".join("?" for _ in unique_ids)
-        sql = f"""
-            SELECT id, title, image, general_info, keywords, themes, emotions,
-                   description_short, json_path
-            FROM paintings
-            WHERE id IN ({placeholders});
-        """
-        cur.execute(sql, unique_ids)
-        rows = cur.fetchall()
-        conn.close()
-
-        row_map = {r["id"]: r for r in rows}
-        results = []
-        for pid in unique_ids:
-            r = row_map.get(pid)
-            if not r:
-                continue
-            results.append({
-                "id": r["id"],
-                "title": r["title"],
-                "image": r["image"],
-                "general_info": r["general_info"],
-                "keywords": (r["keywords"] or "").split(",") if r["keywords"] else [],
-                "themes": (r["themes"] or "").split(",") if r["themes"] else [],
-                "emotions": (r["emotions"] or "").split(",") if r["emotions"] else [],
-                "description_short": r["description_short"],
-                "json_path": r["json_path"]
-            })
-
-        return results
-
-    def search_paintings_for_user_query(self, user_input: str, max_results: Optional[int] = None):
-        """
-        Router search:
-        - Ưu tiên keyword.
-        - Nếu keyword trả quá ít kết quả -> dùng thêm semantic topic search.
-        """
-        kw_results = self.keyword_search_paintings(user_input, limit=max_results)
-        if kw_results:
-            print(f"[Retriever] Keyword search trả {len(kw_results)} kết quả, dùng trực tiếp.")
-            return kw_results
-
-        print("[Retriever] Keyword ít kết quả -> thêm semantic topic search.")
-        sem_results = self.semantic_topic_search(
-            user_input, top_k_topics=2, max_items=max_results
-        )
-
-        if sem_results:
-            print(f"[Retriever] Semantic topic search trả {len(sem_results)} kết quả.")
-            return sem_results
-
-        print("[Retriever] Không có semantic -> fallback keyword.")
-        return kw_results
-
-
-# =========================
-# 5. AGENT: SUMMARIZER
-# =========================
-
-class SummarizerAgent:
-    """
-    Nhiệm vụ:
-    - Viết 1 đoạn giới thiệu ngắn (2–4 câu) về chủ đề tranh phù hợp với yêu cầu của khách.
-    - Không render gallery, chỉ text giới thiệu.
-    """
-
-    SYSTEM_PROMPT = """
-Bạn là nhân viên tư vấn bán tranh.
-Nhiệm vụ: Viết đoạn giới thiệu NGẮN GỌN (2–4 câu) về bộ sưu tập tranh
-phù hợp với yêu cầu của khách hàng.
-
-Quy tắc:
-- Không liệt kê từng bức tranh chi tiết.
-- Chỉ nói khái quát về phong cách, cảm xúc, không gian phù hợp.
-- Giọng văn thân thiện, rõ ràng, ưu tiên súc tích.
-"""
-
-    def _compact_for_summary(self, products, max_items: int = 10):
-        """Giữ thông tin tối thiểu cho Summarizer để giảm token."""
-        trimmed = []
-        for item in products[:max_items]:
-            if not isinstance(item, dict):
-                continue
-            trimmed.append({
-                "id": item.get("id"),
-                "title": item.get("title"),
-                "general_info": item.get("general_info"),
-                "themes": item.get("themes"),
-                "emotions": item.get("emotions"),
-                "description_short": item.get("description_short"),
-            })
-        return trimmed
-
-    def summarize(self, user_input: str, products: list) -> str:
-        if not products:
-            return "Hiện tại mình chưa tìm thấy bức tranh phù hợp trong kho dữ liệu."
-
-        compacted = self._compact_for_summary(products)
-        context_text = json.dumps(compacted, ensure_ascii=False, separators=(",", ":"))
-
-        messages = [
-            {"role": "system", "content": self.SYSTEM_PROMPT},
-            {
-                "role": "user",
-                "content": (
-                    f"Yêu cầu của khách: {user_input}\n\n"
-                    f"Dữ liệu tóm tắt các tranh:\n{context_text}"
-                )
-            },
-        ]
-
-        resp = client.chat.completions.create(
-            model=CHAT_MODEL,
-            messages=messages,
-            temperature=0.7,
-            max_tokens=400,
-            response_format={"type": "text"},
-        )
-
-        return resp.choices[0].message.content
-
-
-# =========================
-# 6. AGENT: DESIGNER (RENDER UI/HTML)
-# =========================
-
-class DesignerAgent:
-    """
-    Nhiệm vụ:
-    - Enrich dữ liệu (thêm image_html, link_html).
-    - Render HTML layout: phần trên là intro_text, phần dưới là gallery nhiều tranh.
-    """
-
-    @staticmethod
-    def enrich_product_data(context_list):
-        for item in context_list:
-            if isinstance(item, dict) and "image" in item and "id" in item:
-                img_path = item["image"]  # vd: "cgi/28.jpg"
-                sp_id = item["id"]        # vd: 28
-                image_url = build_image_url(img_path)
-
-                image_html = (
-                    f"<img src='{image_url}' "
-                    f"style='max-width: 100%; border-radius: 10px;'>"
-                )
-                link_html = (
-                    f"<a class='link-btn' href='https://cgi.vn/san-pham/{sp_id}' "
-                    f"target='_blank'>Xem chi tiết</a>"
-                )
-                ar_link_html = (
-                    f"<a class='link-btn' href='https://cgi.vn/ar/{sp_id}.html' "
-                    f"target='_blank'>Xem AR</a>"
-                )
-
-                item["image_html"] = image_html
-                item["hình_html"] = image_html  # alias
-                item["link_html"] = link_html
-                item["ar_link_html"] = ar_link_html
-
-        return context_list
-
-    def render_gallery(self, intro_text: str, products: list) -> str:
-        """
-        Tạo HTML hoàn chỉnh:
-        - Phần đầu: intro_text.
-        - Phần sau: gallery tất cả tranh.
-        """
-        if not products:
-            return (
-                "<p>Hiện tại mình chưa tìm thấy bức tranh phù hợp trong kho dữ liệu.</p>"
-            )
-
-        products = self.enrich_product_data(products)
-
-        html_parts = []
-        # Phần giới thiệu ngắn
-        if intro_text:
-            html_parts.append(f"<p>{intro_text}</p>")
-
-        # Phần gallery
-        html_parts.append("<h3>Danh sách tranh gợi ý</h3>")
-        html_parts.append('<div class="gallery">')
-
-        for item in products:
-            title = item.get("title") or "Tranh"
-            image_html = (
-                item.get("image_html")
-                or item.get("hình_html")
-                or "<div>(Không có hình)</div>"
-            )
-            link_html = item.get("link_html") or ""
-            ar_link_html = item.get("ar_link_html") or ""
-            links_combined = ""
-            if ar_link_html or link_html:
-                separator = "<span class=\"link-separator\">|</span>" if ar_link_html and link_html else ""
-                links_combined = f"<p class='links-row'>{ar_link_html}{separator}{link_html}</p>"
-
-            block = f"""
-            <div class="item" style="margin-bottom: 16px;">
-                <h4>{title}</h4>
-                {image_html}
-                {links_combined}
-            </div>
-            """
-            html_parts.append(block)
-
-        html_parts.append("</div>")
-        return "\n".join(html_parts)
-
-
-# =========================
-# 7. AGENT: LOGS
-# =========================
-
-SESSION_ID = str(uuid4())[:8]
-
-
-class LogAgent:
-    """
-    Nhiệm vụ:
-    - Ghi log dạng CSV: mỗi ngày 1 file, mỗi dòng là 1 lượt chat.
-    """
-
-    def __init__(self, log_dir: str = LOG_DIR):
-        self.log_dir = log_dir
-        os.makedirs(self.log_dir, exist_ok=True)
-
-    def log_chat(self, user_input: str, bot_reply: str):
-        today = datetime.now().strftime("%Y-%m-%d")
-        log_file = os.path.join(self.log_dir, f"{today}.csv")
-
-        current_time = datetime.now().strftime("%H:%M:%S")
-        is_new = not os.path.exists(log_file)
-
-        with open(log_file, "a", encoding="utf-8", newline="") as f:
-            writer = csv.writer(f)
-            if is_new:
-                writer.writerow(["ID phiên", "Thời gian", "Người dùng", "Chatbot"])
-            writer.writerow([SESSION_ID, current_time, user_input, bot_reply])
-
-
-# =========================
-# 8. AGENT: DIRECTOR (ĐIỀU PHỐI)
-# =========================
-
-class DirectorAgent:
-    """
-    Nhiệm vụ:
-    - Nhận câu hỏi từ user.
-    - Gọi Retriever -> lấy danh sách tranh.
-    - Gọi Summarizer -> tạo intro ngắn.
-    - Gọi Designer -> render HTML trả về.
-    - Gọi LogAgent -> ghi log.
-    """
-
-    def __init__(self):
-        self.retriever = RetrieverAgent()
-        self.summarizer = SummarizerAgent()
-        self.designer = DesignerAgent()
-        self.logger = LogAgent()
-
-    def handle_user_message(self, user_input: str) -> str:
-        # 1. Lấy dữ liệu tranh
-        products = self.retriever.search_paintings_for_user_query(user_input)
-
-        # 2. Tạo đoạn giới thiệu ngắn
-        intro_text = self.summarizer.summarize(user_input, products)
-
-        # 3. Render HTML layout
-        response_html = self.designer.render_gallery(intro_text, products)
-
-        # 4. Ghi log
-        self.logger.log_chat(user_input, response_html)
-
-        return response_html
-
-
-# =========================
-# 9. MAIN CHATBOT LOOP (CLI)
-# =========================
-
-def chatbot_cli():
-    # Preload topic index để tránh đọc file ở request đầu tiên
-    load_topic_index()
-
-    director = DirectorAgent()
-
-    print("🤖 Chatbot (multi-agent) đã sẵn sàng! Gõ 'exit' để thoát.\n")
-    while True:
-        user_input = input("Bạn: ")
-        if user_input.lower().strip() == "exit":
-            print("👋 Chatbot kết thúc.")
-            break
-
-        try:
-            reply = director.handle_user_message(user_input)
-        except Exception as e:
-            print("❌ Lỗi trong quá trình xử lý:", e)
-            reply = "Xin lỗi, hiện tại mình đang gặp chút trục trặc hệ thống, bạn thử lại sau nhé."
-
-        print("Chatbot (HTML):")
-        print(reply)
-        print("-" * 40)
-
-
-if __name__ == "__main__":
-    chatbot_cli()
+        if index is None:
+            print(f"[Retriever] Không mở được index '{VECTOR_INDEX_KIND}' -> dùng exact.")
+    return index or vector_index.VectorIndex.exact(vectors)
+
+
+def load_vector_index():
+    """VectorIndex của catalogue hiện tại (None nếu semantic search bị tắt)."""
+    return current_catalog().vector_index()
+
+
+def top_k_indices(scores, k: int):
+    """Indices of the k best scores, best first (argpartition, not a full sort)."""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    if k < len(scores):
+        idx = np.argpartition(-scores, k - 1)[:k]
+    else:
+        idx = np.arange(len(scores))
+    return idx[np.argsort(-scores[idx], kind="stable")]
+
+
+class OpenAIEmbeddingBackend:
+    """Embeddings API; one request embeds a whole list of texts."""
+
+    def __init__(self, model: str = EMBED_MODEL):
+        self.model = model
+        self.name = model
+
+    def embed(self, texts):
+        texts = list(texts)
+        cap = EMBED_TIMEOUT_S if len(texts) == 1 else EMBED_BATCH_TIMEOUT_S
+        with upstream_call(EMBED_BREAKER, cap, estimate_tokens(texts)) as timeout, \
+                metrics.openai_span("embedding", self.model) as span:
+            resp = with_timeout(get_openai_client(), timeout).embeddings.create(
+                model=self.model, input=texts
+            )
+            span.record_usage(getattr(resp, "usage", None))
+        ordered = sorted(resp.data, key=lambda d: d.index)
+        return np.array([d.embedding for d in ordered], dtype="float32")
+
+    async def aembed(self, texts):
+        texts = list(texts)
+        tokens = estimate_tokens(texts)
+        async with aupstream_call(EMBED_BREAKER, EMBED_TIMEOUT_S, tokens) as timeout:
+            with metrics.openai_span("embedding", self.model) as span:
+                resp = await with_timeout(get_async_openai_client(), timeout).embeddings.create(
+                    model=self.model, input=texts
+                )
+                span.record_usage(getattr(resp, "usage", None))
+        ordered = sorted(resp.data, key=lambda d: d.index)
+        return np.array([d.embedding for d in ordered], dtype="float32")
+
+
+class LocalHashEmbeddingBackend:
+    """
+    Deterministic offline embeddings: accent-folded words and character
+    trigrams hashed into `dim` signed buckets. No network, same output on every
+    machine — for tests, benchmarks and offline builds.
+    """
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+        self.name = f"local-hash-{dim}"
+
+    def _features(self, text: str):
+        words = WORD_RE.findall(fold_text(text))
+        feats = list(words)
+        for word in words:
+            padded = f" {word} "
+            feats.extend(padded[i:i + 3] for i in range(len(padded) - 2))
+        return feats
+
+    def embed(self, texts):
+        out = np.zeros((len(texts), self.dim), dtype="float32")
+        for row, text in enumerate(texts):
+            for feat in self._features(text):
+                h = int.from_bytes(
+                    hashlib.blake2b(feat.encode("utf-8"), digest_size=8).digest(), "little"
+                )
+                out[row, h % self.dim] += 1.0 if (h >> 63) & 1 else -1.0
+        return out
+
+    async def aembed(self, texts):
+        return self.embed(texts)
+
+
+EMBEDDING_BACKENDS = {
+    "openai": OpenAIEmbeddingBackend,
+    "local": LocalHashEmbeddingBackend,
+}
+_EMBEDDING_BACKEND = None
+
+
+def get_embedding_backend(name: Optional[str] = None):
+    """Backend instance by name (default: CHATBOT_EMBED_BACKEND, shared)."""
+    global _EMBEDDING_BACKEND
+    if name is not None:
+        return EMBEDDING_BACKENDS[name]()
+    if _EMBEDDING_BACKEND is None:
+        _EMBEDDING_BACKEND = EMBEDDING_BACKENDS[EMBED_BACKEND]()
+    return _EMBEDDING_BACKEND
+
+
+def text_hash(model: str, text: str) -> str:
+    """Stable hash of (model, text) to detect rows that need re-embedding."""
+    return hashlib.sha1(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+
+def normalize_query(text: str) -> str:
+    """Cache key form of a query: folded, whitespace collapsed."""
+    return " ".join(fold_text(text).split())
+
+
+EMBED_CACHE_MAX_ENTRIES = int(os.getenv("CHATBOT_EMBED_CACHE_MAX", "50000"))
+EMBED_CACHE_TTL = float(os.getenv("CHATBOT_EMBED_CACHE_TTL", str(30 * 24 * 3600)))
+
+
+class EmbeddingCache:
+    """
+    Two-level embedding cache keyed by (model, normalize_query(text)):
+    - a small in-process LRU in front,
+    - a SQLite file (WAL) shared by every worker and surviving restarts,
+      bounded by `max_entries` (LRU on last_used) and `ttl` seconds.
+    If the cache file cannot be opened the cache keeps working in memory only.
+    """
+
+    TOUCH_INTERVAL = 60.0  # giảm số lần ghi last_used cho key nóng
+    EVICT_EVERY = 256
+
+    def __init__(self, path: str = EMBED_CACHE_PATH, max_entries: int = EMBED_CACHE_MAX_ENTRIES,
+                 ttl: float = EMBED_CACHE_TTL, memory_entries: int = 1024):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.memory_entries = memory_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self._conn_pid = None
+        self._disk_ok = True
+        self._puts = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(text: str, model: str) -> str:
+        return hashlib.sha1(f"{model}\0{normalize_query(text)}".encode("utf-8")).hexdigest()
+
+    def _disk(self):
+        """Per-process connection (reopened after fork); None if disk is unusable."""
+        if not self._disk_ok:
+            return None
+        if self._conn is None or self._conn_pid != os.getpid():
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+                conn.execute("PRAGMA journal_mode=WAL;")
+                conn.execute("PRAGMA synchronous=NORMAL;")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS embeddings ("
+                    "key TEXT PRIMARY KEY, model TEXT, vec BLOB, "
+                    "created REAL, last_used REAL);"
+                )
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings(last_used);"
+                )
+                conn.commit()
+            except (OSError, sqlite3.Error) as e:
+                print(f"[EmbeddingCache] Không mở được {self.path}: {e} -> chỉ cache RAM.")
+                self._disk_ok = False
+                return None
+            self._conn, self._conn_pid = conn, os.getpid()
+        return self._conn
+
+    def _remember(self, key, vec):
+        self._memory[key] = vec
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, text: str, model: str, count: bool = True):
+        key = self.key(text, model)
+        now = time.time()
+        with self._lock:
+            vec = self._memory.get(key)
+            if vec is not None:
+                self._memory.move_to_end(key)
+                if count:
+                    self.memory_hits += 1
+                return vec
+
+            conn = self._disk()
+            row = None
+            if conn is not None:
+                try:
+                    row = conn.execute(
+                        "SELECT vec, created, last_used FROM embeddings WHERE key = ?;", (key,)
+                    ).fetchone()
+                    if row is not None and now - row[1] > self.ttl:
+                        conn.execute("DELETE FROM embeddings WHERE key = ?;", (key,))
+                        conn.commit()
+                        row = None
+                    elif row is not None and now - row[2] > self.TOUCH_INTERVAL:
+                        conn.execute(
+                            "UPDATE embeddings SET last_used = ? WHERE key = ?;", (now, key)
+                        )
+                        conn.commit()
+                except sqlite3.Error as e:
+                    print(f"[EmbeddingCache] Lỗi đọc cache: {e}")
+                    row = None
+
+            if row is None:
+                if count:
+                    self.misses += 1
+                return None
+
+            vec = np.frombuffer(row[0], dtype="float32")
+            self._remember(key, vec)
+            if count:
+                self.disk_hits += 1
+            return vec
+
+    def put(self, text: str, model: str, vec):
+        key = self.key(text, model)
+        vec = np.ascontiguousarray(vec, dtype="float32")
+        vec.setflags(write=False)
+        now = time.time()
+        with self._lock:
+            self._remember(key, vec)
+            conn = self._disk()
+            if conn is None:
+                return
+            try:
+                conn.execute(
+                    "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?);",
+                    (key, model, vec.tobytes(), now, now),
+                )
+                self._puts += 1
+                if self._puts % self.EVICT_EVERY == 0:
+                    self._evict(conn, now)
+                conn.commit()
+            except sqlite3.Error as e:
+                print(f"[EmbeddingCache] Lỗi ghi cache: {e}")
+
+    def _evict(self, conn, now):
+        conn.execute("DELETE FROM embeddings WHERE created < ?;", (now - self.ttl,))
+        (count,) = conn.execute("SELECT count(*) FROM embeddings;").fetchone()
+        excess = count - self.max_entries
+        if excess > 0:
+            conn.execute(
+                "DELETE FROM embeddings WHERE key IN ("
+                "SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?);",
+                (excess,),
+            )
+
+    def clear_memory(self):
+        with self._lock:
+            self._memory.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            total = hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": hits / total if total else 0.0,
+                "memory_entries": len(self._memory),
+            }
+
+
+EMBED_CACHE = EmbeddingCache()
+metrics.register_stats("embed_cache", EMBED_CACHE.stats)
+
+
+class LatencyEWMA:
+    """Exponentially weighted moving average of a latency in ms."""
+
+    def __init__(self, initial_ms: float, alpha: float = 0.2):
+        self.value = initial_ms
+        self.alpha = alpha
+
+    def observe(self, ms: float):
+        self.value += self.alpha * (ms - self.value)
+
+
+# Ước lượng thời gian 1 lần gọi embedding (cho latency budget của hybrid search)
+EMBED_LATENCY = LatencyEWMA(initial_ms=300.0)
+
+
+def embed_texts(texts) -> np.ndarray:
+    """
+    embed_text cho nhiều câu: tra cache từng câu; các câu chưa có (loại trùng
+    theo key của cache) được embed trong 1 request mỗi EMBED_BATCH_MAX câu.
+    """
+    backend = get_embedding_backend()
+    vecs = [EMBED_CACHE.get(text, backend.name) for text in texts]
+    missing = {}
+    for i, vec in enumerate(vecs):
+        if vec is None:
+            missing.setdefault(EMBED_CACHE.key(texts[i], backend.name), []).append(i)
+    groups = list(missing.values())
+    for start in range(0, len(groups), EMBED_BATCH_MAX):
+        chunk = groups[start:start + EMBED_BATCH_MAX]
+        for rows, vec in zip(chunk, backend.embed([texts[rows[0]] for rows in chunk])):
+            EMBED_CACHE.put(texts[rows[0]], backend.name, vec)
+            for i in rows:
+                vecs[i] = vec
+    if not vecs:
+        return np.empty((0, 0), dtype="float32")
+    return np.stack(vecs)
+
+
+# Câu trùng (cùng key cache) đang chờ API chỉ tạo 1 request embedding.
+EMBED_FLIGHT = SingleFlight("embedding")
+
+
+def _embed_and_cache(backend, text: str):
+    start = time.perf_counter()
+    vec = backend.embed([text])[0]
+    EMBED_LATENCY.observe((time.perf_counter() - start) * 1000)
+    EMBED_CACHE.put(text, backend.name, vec)
+    return vec
+
+
+async def _aembed_and_cache(backend, text: str):
+    start = time.perf_counter()
+    vec = (await backend.aembed([text]))[0]
+    EMBED_LATENCY.observe((time.perf_counter() - start) * 1000)
+    await asyncio.to_thread(EMBED_CACHE.put, text, backend.name, vec)
+    return vec
+
+
+def embed_text(text: str):
+    """Tạo embedding cho text (cache bền vững để giảm số lần gọi API)."""
+    backend = get_embedding_backend()
+    vec = EMBED_CACHE.get(text, backend.name)
+    if vec is None:
+        key = EMBED_CACHE.key(text, backend.name)
+        vec = EMBED_FLIGHT.do(key, _embed_and_cache, backend, text)
+    return vec
+
+
+async def embed_text_async(text: str):
+    """embed_text cho event loop: cache đọc/ghi trong thread, API gọi bằng client async."""
+    backend = get_embedding_backend()
+    vec = await asyncio.to_thread(EMBED_CACHE.get, text, backend.name)
+    if vec is None:
+        key = EMBED_CACHE.key(text, backend.name)
+        vec = await EMBED_FLIGHT.ado(key, _aembed_and_cache, backend, text)
+    return vec
+
+
+SQLITE_MMAP_SIZE = int(os.getenv("CHATBOT_SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_CACHE_KB = int(os.getenv("CHATBOT_SQLITE_CACHE_KB", "16384"))
+SQLITE_POOL_SIZE = int(os.getenv("CHATBOT_SQLITE_POOL_SIZE", "16"))
+
+
+def get_db_connection():
+    """Open a read-only, tuned connection (UDF registered once per connection)."""
+    if not os.path.exists(SQLITE_PATH):
+        raise RuntimeError(
+            f"SQLite database not found at {SQLITE_PATH}. "
+            "Set CHATBOT_DATA_DIR to point to the data directory."
+        )
+    uri = Path(SQLITE_PATH).absolute().as_uri() + "?mode=ro"
+    # check_same_thread=False: pooled connections move between request threads,
+    # but only one thread uses a connection at a time.
+    conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.create_function("strip_accents", 1, strip_accents, deterministic=True)
+    conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE};")
+    conn.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_KB};")
+    conn.execute("PRAGMA query_only=ON;")
+    return conn
+
+
+class SQLitePool:
+    """
+    Thread-safe pool of read-only connections.
+    Connections are checked out per query and returned afterwards; at most
+    `max_idle` stay open between requests.
+    """
+
+    def __init__(self, factory, max_idle: int = SQLITE_POOL_SIZE):
+        self.factory = factory
+        self.max_idle = max_idle
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.discarded = 0
+        self.retired = False
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self._idle.get_nowait()
+            with self._lock:
+                self.hits += 1
+        except queue.Empty:
+            conn = self.factory()
+            with self._lock:
+                self.misses += 1
+
+        broken = False
+        try:
+            yield conn
+        except sqlite3.DatabaseError:
+            # Không trả connection có thể đã hỏng về pool.
+            broken = True
+            with self._lock:
+                self.discarded += 1
+            raise
+        finally:
+            # Mọi đường ra (kể cả lỗi của caller, GeneratorExit): trả về pool hoặc đóng.
+            if not broken and not self.retired and self._idle.qsize() < self.max_idle:
+                self._idle.put(conn)
+            else:
+                conn.close()
+
+    def retire(self):
+        """Catalogue cũ: đóng connection rảnh, connection đang mượn đóng khi trả về."""
+        self.retired = True
+        self.close_all()
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "discarded": self.discarded,
+                "idle": self._idle.qsize(),
+            }
+
+
+metrics.register_stats("sqlite_pool", lambda: current_catalog().pool.stats())
+
+
+def db_connection():
+    """`with db_connection() as conn:` — pooled read-only connection."""
+    return current_catalog().pool.connection()
+
+
+def normalize_query_for_like(q: str) -> str:
+    return f"%{q.strip()}%"
+
+
+def build_image_url(img_path: str) -> str:
+    """Normalize relative image path to absolute URL."""
+    if not img_path:
+        return ""
+    clean = img_path.replace("\\", "/").lstrip("/")
+    if clean.startswith("cgi/"):
+        clean = clean[len("cgi/"):]
+    return f"{IMAGE_BASE_URL.rstrip('/')}/{clean}"
+
+
+# =========================
+# 4. AGENT: RETRIEVER
+# =========================
+
+STOPWORDS = {"tranh", "buc", "con", "hinh", "anh", "ve"}
+
+
+# NFD không tách "đ"/"Đ" thành d + dấu, nên map riêng.
+D_STROKE = str.maketrans({"đ": "d", "Đ": "D"})
+# Tăng khi cách fold đổi: bảng shadow build bằng bản fold cũ bị bỏ qua (dùng LIKE).
+FOLD_VERSION = "2"
+
+
+def strip_accents(text: str) -> str:
+    """Remove accents for accent-insensitive comparisons (đ -> d)."""
+    normalized = unicodedata.normalize("NFD", (text or "").translate(D_STROKE))
+    return "".join(ch for ch in normalized if unicodedata.category(ch) != "Mn")
+
+
+def fold_text(text: str) -> str:
+    """Lowercase + strip accents, same folding as the keyword LIKE path."""
+    return strip_accents((text or "").lower())
+
+
+def extract_tokens(query: str):
+    """
+    Normalize and split the user query into tokens:
+    - lowercase + strip accents
+    - split on non-alphanumeric
+    - drop stopwords like 'tranh', 'con' to focus on core nouns
+    """
+    clean = strip_accents((query or "").lower())
+    raw_tokens = re.split(r"[^a-z0-9]+", clean)
+    return [t for t in raw_tokens if t and t not in STOPWORDS]
+
+
+SEARCH_COLUMNS = ("title", "keywords", "themes", "emotions")
+PAINTING_COLUMNS = (
+    "id, title, image, general_info, keywords, themes, emotions, "
+    "description_short, json_path"
+)
+SQL_IN_CHUNK = 500  # số tham số của 1 `IN (...)` (SQLite cũ giới hạn 999)
+WORD_RE = re.compile(r"[a-z0-9]+")
+
+
+def row_to_painting(r) -> dict:
+    """Build the product dict returned by the retriever from a DB row."""
+    return {
+        "id": r["id"],
+        "title": r["title"],
+        "image": r["image"],
+        "general_info": r["general_info"],
+        "keywords": (r["keywords"] or "").split(",") if r["keywords"] else [],
+        "themes": (r["themes"] or "").split(",") if r["themes"] else [],
+        "emotions": (r["emotions"] or "").split(",") if r["emotions"] else [],
+        "description_short": r["description_short"],
+        "json_path": r["json_path"]
+    }
+
+
+# Trọng số xếp hạng keyword: khớp ở title quan trọng hơn emotions;
+# khớp nguyên từ được nhân thêm EXACT_WORD_BONUS so với khớp chuỗi con.
+COLUMN_WEIGHTS = (3.0, 2.0, 1.5, 1.0)  # theo thứ tự SEARCH_COLUMNS
+EXACT_WORD_BONUS = 1.5
+
+
+def keyword_score(folded_cols, tokens, col_words=None) -> float:
+    """Relevance of one painting (pre-folded SEARCH_COLUMNS) for the query tokens."""
+    score = 0.0
+    for tok in tokens:
+        for i, text in enumerate(folded_cols):
+            if tok not in text:
+                continue
+            words = col_words[i] if col_words is not None else WORD_RE.findall(text)
+            weight = COLUMN_WEIGHTS[i]
+            score += weight * EXACT_WORD_BONUS if tok in words else weight
+    return round(score, 4)
+
+
+def _word_counts(text: str) -> dict:
+    counts = {}
+    for word in WORD_RE.findall(text):
+        counts[word] = counts.get(word, 0) + 1
+    return counts
+
+
+class KeywordIndex:
+    """
+    Accent-folded inverted index over title/keywords/themes/emotions.
+
+    Mirrors `strip_accents(lower(col)) LIKE '%tok%'`: every substring of every
+    [a-z0-9] word gets a posting list, so a token lookup is one dict hit and a
+    query is an intersection of per-token postings (AND of per-column OR).
+    """
+
+    def __init__(self, rows, folded: Optional[dict] = None):
+        """`folded` optionally maps id -> pre-folded SEARCH_COLUMNS values."""
+        self.rows = sorted((dict(r) for r in rows), key=lambda r: r["id"])
+        self.pos_by_id = {row["id"]: pos for pos, row in enumerate(self.rows)}
+        self.folded = []
+        self.col_words = []
+        postings = {}
+        for pos, row in enumerate(self.rows):
+            folded_cols = (folded or {}).get(row["id"])
+            if folded_cols is None:
+                folded_cols = tuple(fold_text(row[col]) for col in SEARCH_COLUMNS)
+            self.folded.append(folded_cols)
+            col_words = tuple(frozenset(WORD_RE.findall(text)) for text in folded_cols)
+            self.col_words.append(col_words)
+            words = set().union(*col_words)
+            for word in words:
+                n = len(word)
+                for i in range(n):
+                    for j in range(i + 1, n + 1):
+                        postings.setdefault(word[i:j], set()).add(pos)
+        self.postings = {k: frozenset(v) for k, v in postings.items()}
+        self.bm25 = BM25Index(
+            [row["id"] for row in self.rows],
+            [
+                [_word_counts(text) for text in folded_cols]
+                for folded_cols in self.folded
+            ],
+        )
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _lookup(self, token: str) -> frozenset:
+        if WORD_RE.fullmatch(token):
+            return self.postings.get(token, frozenset())
+        # Token có dấu cách / ký tự lạ (fallback nguyên câu) -> quét chuỗi đã fold.
+        return frozenset(
+            pos for pos, cols in enumerate(self.folded)
+            if any(token in text for text in cols)
+        )
+
+    def _match(self, tokens):
+        """Sorted row positions matching every token (all rows if no tokens)."""
+        if not tokens:
+            return range(len(self.rows))
+        postings = sorted((self._lookup(t) for t in tokens), key=len)
+        matched = set(postings[0])
+        for posting in postings[1:]:
+            if not matched:
+                break
+            matched &= posting
+        return sorted(matched)
+
+    def search(self, tokens, limit: Optional[int] = None):
+        """Return painting dicts matching every token, ordered by id."""
+        positions = self._match(tokens)
+        if limit is not None and limit >= 0:
+            positions = positions[:limit]
+        return [row_to_painting(self.rows[pos]) for pos in positions]
+
+    def search_ranked(self, tokens):
+        """[(id, score)] for every match, best first (ties by id)."""
+        scored = [
+            (self.rows[pos]["id"], keyword_score(self.folded[pos], tokens, self.col_words[pos]))
+            for pos in self._match(tokens)
+        ]
+        scored.sort(key=lambda item: (-item[1], item[0]))
+        return scored
+
+    def get_many(self, ids) -> dict:
+        """Fresh painting dicts for the given ids."""
+        return {
+            pid: row_to_painting(self.rows[self.pos_by_id[pid]])
+            for pid in ids if pid in self.pos_by_id
+        }
+
+
+class BM25Index:
+    """
+    BM25 over the whole words of the folded search columns, with each column's
+    term frequency scaled by COLUMN_WEIGHTS (BM25F-lite). Per-posting weights
+    are query independent, so a query is a few numpy scatter-adds.
+    """
+
+    def __init__(self, ids, col_words_tf, k1: float = 1.2, b: float = 0.75):
+        """`col_words_tf`: per doc, per column, a {word: count} dict."""
+        self.ids = np.asarray(ids)
+        n_docs = len(ids)
+        doc_tf = []
+        for cols in col_words_tf:
+            tf = {}
+            for weight, counts in zip(COLUMN_WEIGHTS, cols):
+                for word, count in counts.items():
+                    tf[word] = tf.get(word, 0.0) + weight * count
+            doc_tf.append(tf)
+        doc_len = np.array([sum(tf.values()) for tf in doc_tf], dtype="float32")
+        avgdl = float(doc_len.mean()) if n_docs else 1.0
+
+        raw = {}
+        for pos, tf in enumerate(doc_tf):
+            for word, freq in tf.items():
+                raw.setdefault(word, []).append((pos, freq))
+
+        self.postings = {}
+        for word, entries in raw.items():
+            docs = np.array([e[0] for e in entries], dtype=np.int32)
+            tf = np.array([e[1] for e in entries], dtype="float32")
+            idf = np.log(1.0 + (n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            norm = tf + k1 * (1.0 - b + b * doc_len[docs] / max(avgdl, 1e-6))
+            self.postings[word] = (docs, (idf * tf * (k1 + 1.0) / norm).astype("float32"))
+
+    def search(self, tokens, limit: int):
+        """[(id, score)] of the best `limit` docs containing any token."""
+        scores = np.zeros(len(self.ids), dtype="float32")
+        for tok in set(tokens):
+            posting = self.postings.get(tok)
+            if posting is not None:
+                np.add.at(scores, posting[0], posting[1])
+        hits = np.flatnonzero(scores)
+        if not len(hits):
+            return []
+        best = hits[top_k_indices(scores[hits], limit)]
+        return [(int(self.ids[i]), float(scores[i])) for i in best]
+
+
+# Accent-folded shadow of SEARCH_COLUMNS + FTS5 trigram index, written offline
+# by `python build_catalog.py search-index`. Old DBs without them (or built
+# with another FOLD_VERSION) use LIKE.
+SEARCH_TABLE = "paintings_search"
+SEARCH_FTS_TABLE = "paintings_fts"
+SEARCH_META_TABLE = "paintings_search_meta"
+FTS_MIN_TOKEN = 3  # trigram tokenizer cannot match shorter substrings
+
+
+def has_search_tables(conn) -> bool:
+    names = {
+        r[0] for r in conn.execute(
+            "SELECT name FROM sqlite_master WHERE name IN (?, ?, ?);",
+            (SEARCH_TABLE, SEARCH_FTS_TABLE, SEARCH_META_TABLE),
+        )
+    }
+    if names != {SEARCH_TABLE, SEARCH_FTS_TABLE, SEARCH_META_TABLE}:
+        return False
+    row = conn.execute(
+        f"SELECT value FROM {SEARCH_META_TABLE} WHERE key = 'fold';"
+    ).fetchone()
+    return row is not None and row[0] == FOLD_VERSION
+
+
+def search_tables_available() -> bool:
+    """Cached check whether paintings.db carries the precomputed search tables."""
+    return current_catalog().search_tables()
+
+
+def fts_phrase(token: str) -> str:
+    return '"' + token.replace('"', '""') + '"'
+
+
+# Set CHATBOT_KEYWORD_INDEX=0 to go back to per-request SQL LIKE scans.
+USE_KEYWORD_INDEX = os.getenv("CHATBOT_KEYWORD_INDEX", "1") != "0"
+
+
+def build_keyword_index(conn) -> KeywordIndex:
+    """Keyword index from the paintings table (folded columns from the shadow table if any)."""
+    rows = conn.execute(f"SELECT {PAINTING_COLUMNS} FROM paintings;").fetchall()
+    folded = None
+    if has_search_tables(conn):
+        cols = ", ".join(SEARCH_COLUMNS)
+        folded = {
+            r[0]: tuple(v or "" for v in r[1:])
+            for r in conn.execute(f"SELECT id, {cols} FROM {SEARCH_TABLE};")
+        }
+    return KeywordIndex(rows, folded=folded)
+
+
+def load_keyword_index():
+    """In-memory keyword index of the current catalogue (built once per snapshot)."""
+    return current_catalog().keyword_index()
+
+
+# Viết lại câu hỏi bằng từ vựng của catalogue (vocab_index.py) trước keyword/BM25:
+# sửa lỗi gõ, giữ cụm nhiều chữ, bỏ stopword / chữ đệm suy ra từ dữ liệu.
+QUERY_REWRITE = os.getenv("CHATBOT_QUERY_REWRITE", "1") == "1"
+QUERY_LOG_MAX = 20000  # số câu hỏi gần nhất trong LOG_DIR dùng để suy ra chữ đệm
+
+
+def build_vocab_index(conn) -> VocabIndex:
+    cols = ", ".join(SEARCH_COLUMNS)
+    docs = [tuple(r) for r in conn.execute(f"SELECT {cols} FROM paintings;")]
+    paths = sorted(
+        glob.glob(os.path.join(LOG_DIR, "*.csv")) + glob.glob(os.path.join(LOG_DIR, "*.jsonl"))
+    )
+    try:
+        queries = read_query_log(paths)[-QUERY_LOG_MAX:]
+    except OSError as e:
+        print(f"[Vocab] Không đọc được log câu hỏi: {e}")
+        queries = []
+    return VocabIndex(docs, fold_text, STOPWORDS, queries)
+
+
+# =========================
+# CATALOGUE SNAPSHOT & HOT RELOAD
+# =========================
+
+# Giây giữa 2 lần kiểm tra file catalogue (0 = không theo dõi, chỉ reload qua admin).
+CATALOG_WATCH_S = float(os.getenv("CHATBOT_CATALOG_WATCH_S", "0"))
+
+
+class CatalogSnapshot:
+    """
+    Mọi thứ suy ra từ 1 version của catalogue: meta + ma trận vector, vector
+    index, keyword index, cờ search tables và pool SQLite. Mỗi phần dựng lazy
+    đúng 1 lần (warm() dựng trước tất cả); request lấy snapshot 1 lần và dùng
+    nó đến hết, nên reload không làm lẫn dữ liệu của 2 version.
+    """
+
+    def __init__(self, version: str, files: Optional[str] = None):
+        self.version = version
+        self.files = files or version  # files_version() lúc dựng
+        self.pool = SQLitePool(get_db_connection)
+        self._lock = threading.RLock()
+        self._topic = None
+        self._vector_index = None
+        self._keyword_index = None
+        self._vocab_index = None
+        self._search_tables = None
+
+    def topic(self):
+        if self._topic is None:
+            with self._lock:
+                if self._topic is None:
+                    self._topic = read_topic_index()
+        return self._topic
+
+    @property
+    def topic_meta(self):
+        return self.topic()[1]
+
+    def vector_index(self):
+        if self._vector_index is None:
+            with self._lock:
+                if self._vector_index is None:
+                    vectors, meta = self.topic()
+                    self._vector_index = (
+                        open_vector_index(vectors) if vectors is not None and meta else False
+                    )
+        return self._vector_index or None
+
+    def keyword_index(self) -> KeywordIndex:
+        if self._keyword_index is None:
+            with self._lock:
+                if self._keyword_index is None:
+                    with self.pool.connection() as conn:
+                        self._keyword_index = build_keyword_index(conn)
+        return self._keyword_index
+
+    def vocab_index(self) -> VocabIndex:
+        if self._vocab_index is None:
+            with self._lock:
+                if self._vocab_index is None:
+                    with self.pool.connection() as conn:
+                        self._vocab_index = build_vocab_index(conn)
+        return self._vocab_index
+
+    def search_tables(self) -> bool:
+        if self._search_tables is None:
+            with self.pool.connection() as conn:
+                self._search_tables = has_search_tables(conn)
+        return self._search_tables
+
+    def warm(self):
+        """Dựng trước mọi index mà request sẽ cần (chạy nền trước khi swap)."""
+        self.vector_index()
+        self.search_tables()
+        if USE_KEYWORD_INDEX or RETRIEVAL_MODE == "hybrid" or SESSION_REFINE:
+            self.keyword_index()
+        if QUERY_REWRITE:
+            self.vocab_index()
+
+    def retire(self):
+        self.pool.retire()
+
+
+class CatalogManager:
+    """
+    Giữ snapshot đang phục vụ. reload() dựng snapshot mới từ file trên đĩa
+    (ngoài mọi lock của request), warm toàn bộ rồi mới swap bằng 1 phép gán;
+    request đang chạy tiếp tục với snapshot cũ. Lỗi khi dựng -> giữ bản cũ.
+    """
+
+    def __init__(self):
+        self.current = CatalogSnapshot(files_version())
+        self._reload_lock = threading.Lock()
+        self._watcher = None
+        self._stop_watch = threading.Event()
+        self.reloads = 0
+        self.failures = 0
+        self.last_reload_s = 0.0
+        self._forced = itertools.count(1)
+
+    def reload(self, force: bool = False) -> bool:
+        """
+        True nếu đã swap sang version mới. `force` với file không đổi stamp
+        (dựng lại giữ nguyên mtime/size) vẫn cho version mới, để các cache theo
+        catalog_version() (ReplyCache, FragmentCache, session) bỏ dữ liệu cũ.
+        """
+        if not self._reload_lock.acquire(blocking=False):
+            return False  # đang có reload khác chạy
+        try:
+            files = files_version(max_age=0)
+            version = files
+            if files == self.current.files:
+                if not force:
+                    return False
+                version = f"{files}.{next(self._forced)}"
+            start = time.perf_counter()
+            try:
+                snapshot = CatalogSnapshot(version, files)
+                snapshot.warm()
+            except Exception as e:
+                self.failures += 1
+                print(f"[Catalog] Reload {version} lỗi, giữ version {self.current.version}: {e}")
+                return False
+            old, self.current = self.current, snapshot
+            old.retire()
+            self.reloads += 1
+            self.last_reload_s = time.perf_counter() - start
+            print(f"[Catalog] {old.version} -> {version} ({self.last_reload_s:.2f}s)")
+            return True
+        finally:
+            self._reload_lock.release()
+
+    def start_watcher(self, interval: float = CATALOG_WATCH_S):
+        """Thread nền: file đổi và đứng yên qua 1 chu kỳ nữa -> reload."""
+        if interval <= 0 or (self._watcher is not None and self._watcher.is_alive()):
+            return
+        self._stop_watch = stop = threading.Event()
+
+        def watch():
+            seen = self.current.files
+            while not stop.wait(interval):
+                version = files_version(max_age=0)
+                if version != self.current.files and version == seen:
+                    self.reload()
+                seen = version
+
+        self._watcher = threading.Thread(target=watch, name="catalog-watcher", daemon=True)
+        self._watcher.start()
+
+    def stop_watcher(self):
+        """Dừng thread theo dõi (trước khi fork: thread không sống sót qua fork)."""
+        self._stop_watch.set()
+        if self._watcher is not None:
+            self._watcher.join()
+            self._watcher = None
+
+    def stats(self) -> dict:
+        return {
+            "reloads": self.reloads,
+            "reload_failures": self.failures,
+            "last_reload_seconds": self.last_reload_s,
+        }
+
+
+CATALOG = CatalogManager()
+metrics.register_stats("catalog", CATALOG.stats)
+
+
+def current_catalog() -> CatalogSnapshot:
+    return CATALOG.current
+
+
+class RankedResults:
+    """
+    Kết quả đã xếp hạng theo độ liên quan: chỉ giữ (id, score), dict sản phẩm
+    chỉ được dựng cho trang thực sự trả về.
+    """
+
+    def __init__(self, ranked, fetch, route: str):
+        self.ranked = ranked  # [(id, score)], tốt nhất trước
+        self._fetch = fetch   # ids -> {id: painting dict}
+        self.route = route
+
+    @classmethod
+    def from_products(cls, products, route: str):
+        """Wrap an already-ordered product list (each with a "score")."""
+        by_id = {p["id"]: p for p in products}
+        ranked = [(p["id"], p.get("score", 0.0)) for p in products]
+        return cls(ranked, lambda ids: {i: dict(by_id[i]) for i in ids if i in by_id}, route)
+
+    def __len__(self):
+        return len(self.ranked)
+
+    @property
+    def ids(self):
+        return [pid for pid, _ in self.ranked]
+
+    def page(self, offset: int = 0, limit: Optional[int] = None):
+        chunk = self.ranked[offset:None if limit is None else offset + limit]
+        found = self._fetch([pid for pid, _ in chunk])
+        results = []
+        for pid, score in chunk:
+            item = found.get(pid)
+            if item is None:
+                continue
+            item["score"] = score
+            results.append(item)
+        return results
+
+
+# "router" (mặc định): keyword trước, semantic khi keyword rỗng.
+# "hybrid": BM25 + vector, fuse bằng RRF.
+RETRIEVAL_MODE = os.getenv("CHATBOT_RETRIEVAL_MODE", "router")
+HYBRID_CANDIDATES = int(os.getenv("CHATBOT_HYBRID_CANDIDATES", "50"))
+HYBRID_RRF_K = 60
+HYBRID_LEXICAL_WEIGHT = float(os.getenv("CHATBOT_HYBRID_LEXICAL_WEIGHT", "1.0"))
+HYBRID_VECTOR_WEIGHT = float(os.getenv("CHATBOT_HYBRID_VECTOR_WEIGHT", "1.0"))
+HYBRID_CONFIDENT_HITS = int(os.getenv("CHATBOT_HYBRID_CONFIDENT_HITS", "3"))
+HYBRID_BUDGET_MS = float(os.getenv("CHATBOT_HYBRID_BUDGET_MS", "800"))
+# Lượt chat cùng câu hỏi (normalize_query) cùng lúc dùng chung 1 lần retrieval.
+RETRIEVE_FLIGHT = SingleFlight("retrieval")
+# Route mà keyword/BM25 không đủ -> phải dùng vector (hoặc không tìm được gì).
+SEMANTIC_FALLBACK_ROUTES = ("semantic", "hybrid-vector", "none")
+
+
+def retrieval_stats() -> dict:
+    turns = fallbacks = 0
+    for (route, _cached), n in metrics.RETRIEVAL_ROUTES.snapshot().items():
+        turns += n
+        if route in SEMANTIC_FALLBACK_ROUTES:
+            fallbacks += n
+    stats = {"semantic_fallback_rate": fallbacks / turns if turns else 0.0}
+    vocab = current_catalog()._vocab_index
+    if vocab:
+        stats.update({f"vocab_{k}": v for k, v in vocab.stats().items()})
+    return stats
+
+
+metrics.register_stats("retrieval", retrieval_stats)
+
+
+class RetrieverAgent:
+    """
+    Nhiệm vụ:
+    - Tìm tranh trong SQLite bằng keyword.
+    - Nếu cần thì dùng semantic topic search (theo topic_meta + vectors).
+    """
+
+    @staticmethod
+    def _query_tokens(user_input: str):
+        if QUERY_REWRITE:
+            tokens = current_catalog().vocab_index().rewrite(user_input).tokens
+            if tokens:
+                return tokens
+        tokens = extract_tokens(user_input)
+        if not tokens:
+            normalized = strip_accents((user_input or "").lower().strip())
+            tokens = [normalized] if normalized else []
+        return tokens
+
+    def keyword_search_ranked(self, user_input: str) -> RankedResults:
+        """Keyword matches ranked by keyword_score instead of id."""
+        tokens = self._query_tokens(user_input)
+        if USE_KEYWORD_INDEX:
+            index = load_keyword_index()
+            return RankedResults(index.search_ranked(tokens), index.get_many, "keyword")
+
+        products = self.keyword_search_paintings(user_input)
+        for p in products:
+            folded_cols = tuple(
+                fold_text(",".join(p[col]) if isinstance(p[col], list) else p[col])
+                for col in SEARCH_COLUMNS
+            )
+            p["score"] = keyword_score(folded_cols, tokens)
+        products.sort(key=lambda p: (-p["score"], p["id"]))
+        return RankedResults.from_products(products, "keyword")
+
+    def keyword_search_paintings(self, user_input: str, limit: Optional[int] = None):
+        tokens = self._query_tokens(user_input)
+
+        if USE_KEYWORD_INDEX:
+            return load_keyword_index().search(tokens, limit=limit)
+        if search_tables_available():
+            return self._keyword_search_fts(tokens, limit=limit)
+        return self._keyword_search_sql(tokens, limit=limit)
+
+    def _keyword_search_fts(self, tokens, limit: Optional[int] = None):
+        """
+        Query the precomputed search tables: tokens >= 3 chars go through the
+        FTS5 trigram MATCH, shorter ones LIKE-scan the pre-folded shadow columns
+        (no Python UDF either way).
+        """
+        long_toks = [t for t in tokens if len(t) >= FTS_MIN_TOKEN]
+        short_toks = [t for t in tokens if len(t) < FTS_MIN_TOKEN]
+
+        clauses = []
+        params = []
+        if long_toks:
+            clauses.append(
+                f"p.id IN (SELECT rowid FROM {SEARCH_FTS_TABLE} "
+                f"WHERE {SEARCH_FTS_TABLE} MATCH ?)"
+            )
+            params.append(" AND ".join(fts_phrase(t) for t in long_toks))
+        for tok in short_toks:
+            clause = " OR ".join(f"s.{col} LIKE ?" for col in SEARCH_COLUMNS)
+            clauses.append(f"({clause})")
+            params.extend([f"%{tok}%"] * len(SEARCH_COLUMNS))
+
+        where_sql = " AND ".join(clauses) if clauses else "1=1"
+        columns = ", ".join(f"p.{c.strip()}" for c in PAINTING_COLUMNS.split(","))
+        query = f"""
+            SELECT {columns}
+            FROM paintings p
+            JOIN {SEARCH_TABLE} s ON s.id = p.id
+            WHERE {where_sql}
+            ORDER BY p.id ASC
+        """
+        if limit is not None:
+            query += "\n            LIMIT ?;"
+            params.append(limit)
+        else:
+            query += ";"
+
+        with db_connection() as conn:
+            rows = conn.execute(query, params).fetchall()
+        return [row_to_painting(r) for r in rows]
+
+    def _keyword_search_sql(self, tokens, limit: Optional[int] = None):
+        """Legacy path: LIKE scan with the Python strip_accents UDF."""
+        clauses = []
+        params = []
+        for tok in tokens:
+            like_pattern = f"%{tok}%"
+            clause = " OR ".join(
+                [f"strip_accents(lower({col})) LIKE ?" for col in SEARCH_COLUMNS]
+            )
+            clauses.append(f"({clause})")
+            params.extend([like_pattern] * len(SEARCH_COLUMNS))
+
+        where_sql = " AND ".join(clauses) if clauses else "1=1"
+
+        query = f"""
+            SELECT {PAINTING_COLUMNS}
+            FROM paintings
+            WHERE {where_sql}
+            ORDER BY id ASC
+        """
+        if limit is not None:
+            query += "\n            LIMIT ?;"
+            params.append(limit)
+        else:
+            query += ";"
+
+        with db_connection() as conn:
+            rows = conn.execute(query, params).fetchall()
+
+        return [row_to_painting(r) for r in rows]
+
+    def semantic_topic_search(
+        self,
+        user_input: str,
+        top_k_topics: int = 2,
+        max_items: Optional[int] = None
+    ):
+        if load_vector_index() is None:
+            return []
+
+        try:
+            q_vec = embed_text(user_input)
+        except Exception as e:
+            print(f"[Retriever] Semantic embedding error: {e}")
+            return []
+        return self.semantic_search_by_vector(q_vec, top_k_topics, max_items)
+
+    async def semantic_topic_search_async(
+        self,
+        user_input: str,
+        top_k_topics: int = 2,
+        max_items: Optional[int] = None
+    ):
+        if load_vector_index() is None:
+            return []
+
+        try:
+            q_vec = await embed_text_async(user_input)
+        except Exception as e:
+            print(f"[Retriever] Semantic embedding error: {e}")
+            return []
+        return await asyncio.to_thread(
+            self.semantic_search_by_vector, q_vec, top_k_topics, max_items
+        )
+
+    def semantic_search_by_vector(
+        self,
+        q_vec,
+        top_k_topics: int = 2,
+        max_items: Optional[int] = None
+    ):
+        """Score topics for an already-embedded query and load their paintings."""
+        catalog = current_catalog()
+        index = catalog.vector_index()
+        if index is None:
+            return []
+        scores, rows = index.search(q_vec, top_k_topics)  # cosine similarity
+        candidates = self._rows_to_candidates(rows[0], scores[0], catalog)[:max_items]
+        found = self._fetch_paintings([pid for pid, _ in candidates], catalog)
+        return self._semantic_products(candidates, found)
+
+    @staticmethod
+    def _rows_to_candidates(rows, scores, catalog: CatalogSnapshot):
+        """[(painting id, cosine)] từ 1 hàng kết quả vector search, loại trùng, giữ thứ tự."""
+        ranked = []
+        seen = set()
+        for row, score in zip(rows, scores):
+            if row < 0:
+                continue
+            for pid in catalog.topic_meta.painting_ids(row):
+                if pid not in seen:
+                    seen.add(pid)
+                    ranked.append((pid, float(score)))
+        return ranked
+
+    @staticmethod
+    def _fetch_paintings(ids, catalog: CatalogSnapshot) -> dict:
+        """{id: painting dict}; cả batch dùng chung vài query `IN (...)`."""
+        ids = list(ids)
+        found = {}
+        with catalog.pool.connection() as conn:
+            for start in range(0, len(ids), SQL_IN_CHUNK):
+                chunk = ids[start:start + SQL_IN_CHUNK]
+                placeholders = ",".join("?" for _ in chunk)
+                sql = f"""
+                    SELECT {PAINTING_COLUMNS}
+                    FROM paintings
+                    WHERE id IN ({placeholders});
+                """
+                for r in conn.execute(sql, chunk).fetchall():
+                    found[r["id"]] = r
+        return found
+
+    @staticmethod
+    def _semantic_products(candidates, found: dict) -> list:
+        results = []
+        for pid, score in candidates:
+            r = found.get(pid)
+            if not r:
+                continue
+            item = row_to_painting(r)
+            item["score"] = round(score, 4)  # cosine của topic dẫn tới tranh này
+            results.append(item)
+        return results
+
+    def search_paintings_for_user_query(self, user_input: str, max_results: Optional[int] = None):
+        """
+        Router search:
+        - Ưu tiên keyword.
+        - Nếu keyword trả quá ít kết quả -> dùng thêm semantic topic search.
+        """
+        return self.search_with_route(user_input, max_results)[0]
+
+    def refine_terms(self, text: str) -> list:
+        """Chữ nội dung (đã fold, qua rewrite) của phần nội dung câu refine."""
+        return [t for t in self._query_tokens(text) if t not in GENERIC_WORDS] if text else []
+
+    def refine(self, ranked, terms) -> Optional[RankedResults]:
+        """
+        Lọc kết quả lượt trước (`ranked` [(id, score)]) theo `terms`, chỉ dùng
+        keyword index trong RAM (không SQL, không embedding): giữ tranh có đủ
+        mọi chữ — nguyên chữ, không phải chuỗi con — theo thứ tự cũ. None nếu
+        không tranh nào khớp hoặc không loại được tranh nào (-> retrieval mới).
+        Lọc lần lượt theo t1 rồi t2 = lọc 1 lần theo t1 + t2.
+        """
+        if not terms:
+            return None
+        index = current_catalog().keyword_index()
+        kept = []
+        for pid, score in ranked:
+            pos = index.pos_by_id.get(pid)
+            if pos is None:
+                continue
+            col_words = index.col_words[pos]
+            if all(any(term in words for words in col_words) for term in terms):
+                kept.append((pid, score))
+        if not kept or len(kept) == len(ranked):
+            return None
+        return RankedResults(kept, index.get_many, "refine")
+
+    def search_with_route(self, user_input: str, max_results: Optional[int] = None):
+        """Như search_paintings_for_user_query, trả thêm route: keyword | semantic | none."""
+        results = self.search_ranked(user_input)
+        return results.page(0, max_results), results.route
+
+    @staticmethod
+    def _flight_key(user_input: str):
+        return current_catalog().version, normalize_query(user_input)
+
+    def search_ranked(self, user_input: str) -> RankedResults:
+        """Router trả RankedResults (xếp hạng theo độ liên quan, phân trang được)."""
+        return RETRIEVE_FLIGHT.do(self._flight_key(user_input), self._search_ranked, user_input)
+
+    @staticmethod
+    def _count_rewrite(user_input: str):
+        """Đếm kiểu rewrite (1 lần / retrieval; rewrite đã cache nên gần như miễn phí)."""
+        if not QUERY_REWRITE:
+            return
+        rewrite = current_catalog().vocab_index().rewrite(user_input)
+        changes = [
+            kind for kind, hit in (
+                ("corrected", rewrite.corrected), ("dropped", rewrite.dropped),
+                ("phrase", rewrite.phrases),
+            ) if hit
+        ]
+        for kind in changes or ["none"]:
+            metrics.QUERY_REWRITES.inc(change=kind)
+
+    def _search_ranked(self, user_input: str) -> RankedResults:
+        self._count_rewrite(user_input)
+        if RETRIEVAL_MODE == "hybrid":
+            return self.hybrid_search(user_input)
+
+        kw_results = self.keyword_search_ranked(user_input)
+        if len(kw_results):
+            print(f"[Retriever] Keyword search trả {len(kw_results)} kết quả, dùng trực tiếp.")
+            return kw_results
+
+        print("[Retriever] Keyword ít kết quả -> thêm semantic topic search.")
+        sem_results = self.semantic_topic_search(user_input, top_k_topics=2)
+
+        if sem_results:
+            print(f"[Retriever] Semantic topic search trả {len(sem_results)} kết quả.")
+            return RankedResults.from_products(sem_results, "semantic")
+
+        print("[Retriever] Không có semantic -> fallback keyword.")
+        return RankedResults([], lambda ids: {}, "none")
+
+    async def search_ranked_async(self, user_input: str) -> RankedResults:
+        """Router như bản sync; SQLite/index chạy trong thread, embedding qua client async."""
+        return await RETRIEVE_FLIGHT.ado(
+            self._flight_key(user_input), self._search_ranked_async, user_input
+        )
+
+    async def _search_ranked_async(self, user_input: str) -> RankedResults:
+        self._count_rewrite(user_input)
+        if RETRIEVAL_MODE == "hybrid":
+            query_vec = None
+            if not await asyncio.to_thread(self._skip_embedding, user_input):
+                try:
+                    query_vec = await embed_text_async(user_input)
+                except Exception as e:
+                    print(f"[Retriever] Semantic embedding error: {e}")
+            return await asyncio.to_thread(self.hybrid_search, user_input, query_vec, False)
+
+        kw_results = await asyncio.to_thread(self.keyword_search_ranked, user_input)
+        if len(kw_results):
+            return kw_results
+
+        sem_results = await self.semantic_topic_search_async(user_input, top_k_topics=2)
+        if sem_results:
+            return RankedResults.from_products(sem_results, "semantic")
+        return RankedResults([], lambda ids: {}, "none")
+
+    def _lexical_confident(self, user_input: str) -> bool:
+        """Đủ tranh khớp mọi token -> lexical đủ tin cậy, không cần chờ embedding."""
+        tokens = self._query_tokens(user_input)
+        return bool(tokens) and len(load_keyword_index()._match(tokens)) >= HYBRID_CONFIDENT_HITS
+
+    def _skip_embedding(self, user_input: str, lexical=None) -> bool:
+        """
+        Hybrid không chờ embedding: lexical đủ tin cậy, hoặc BM25 đã có kết quả
+        và ước lượng latency embedding vượt HYBRID_BUDGET_MS.
+        """
+        if self._lexical_confident(user_input):
+            return True
+        if lexical is None:
+            lexical = load_keyword_index().bm25.search(
+                self._query_tokens(user_input), HYBRID_CANDIDATES
+            )
+        return bool(lexical) and EMBED_LATENCY.value > HYBRID_BUDGET_MS
+
+    def _vector_candidates(self, query_vec, limit: int, catalog: CatalogSnapshot):
+        """[(painting id, cosine)] từ các vector gần nhất (mỗi id lấy score cao nhất)."""
+        index = catalog.vector_index()
+        if index is None or len(query_vec) != index.dim:
+            return []
+        scores, rows = index.search(query_vec, limit)
+        return self._rows_to_candidates(rows[0], scores[0], catalog)[:limit]
+
+    def hybrid_search(self, user_input: str, query_vec=None, allow_embed: bool = True):
+        """
+        BM25 (local) + cosine vector, fuse bằng weighted reciprocal rank fusion.
+        Vector leg chỉ gọi API embedding khi: chưa có embedding trong cache,
+        lexical chưa đủ tin cậy, và ước lượng latency embedding nằm trong budget.
+        """
+        catalog = current_catalog()
+        index = catalog.keyword_index()
+        tokens = self._query_tokens(user_input)
+        lexical = index.bm25.search(tokens, HYBRID_CANDIDATES)
+
+        if query_vec is None:
+            query_vec = EMBED_CACHE.get(user_input, get_embedding_backend().name, count=False)
+        if query_vec is None and allow_embed:
+            if not self._skip_embedding(user_input, lexical):
+                try:
+                    query_vec = embed_text(user_input)
+                except Exception as e:
+                    print(f"[Retriever] Semantic embedding error: {e}")
+
+        vector = (
+            self._vector_candidates(query_vec, HYBRID_CANDIDATES, catalog)
+            if query_vec is not None else []
+        )
+        results = self._fuse(lexical, vector, index)
+        print(f"[Retriever] Hybrid ({results.route}): {len(lexical)} BM25 + {len(vector)} vector.")
+        return results
+
+    @staticmethod
+    def _fuse(lexical, vector, index: KeywordIndex) -> RankedResults:
+        """Weighted reciprocal rank fusion của 2 danh sách [(id, score)]."""
+        fused = {}
+        for weight, leg in ((HYBRID_LEXICAL_WEIGHT, lexical), (HYBRID_VECTOR_WEIGHT, vector)):
+            for rank, (pid, _) in enumerate(leg):
+                fused[pid] = fused.get(pid, 0.0) + weight / (HYBRID_RRF_K + rank + 1)
+        ranked = sorted(((pid, round(score, 6)) for pid, score in fused.items()),
+                        key=lambda item: (-item[1], item[0]))
+
+        if not ranked:
+            route = "none"
+        elif not vector:
+            route = "hybrid-lexical"
+        elif not lexical:
+            route = "hybrid-vector"
+        else:
+            route = "hybrid"
+        return RankedResults(ranked, index.get_many, route)
+
+    def search_ranked_batch(self, queries) -> list:
+        """
+        search_ranked cho nhiều câu (kết quả theo thứ tự `queries`). Câu trùng
+        sau normalize_query chỉ tính 1 lần; mọi câu cần vector được embed
+        trong 1 request, chấm điểm bằng 1 phép nhân ma trận-ma trận, và tranh
+        của cả batch lấy bằng chung các query SQLite.
+        """
+        unique = {}
+        for query in queries:
+            unique.setdefault(normalize_query(query), query)
+        for query in unique.values():
+            self._count_rewrite(query)
+        if RETRIEVAL_MODE == "hybrid":
+            by_key = self._hybrid_batch(unique)
+        else:
+            by_key = self._router_batch(unique)
+        return [by_key[normalize_query(query)] for query in queries]
+
+    @staticmethod
+    def _batch_vectors(texts, catalog: CatalogSnapshot, k: int):
+        """(scores, rows) của vector search cho `texts` (1 lần embed + 1 lần search), hoặc None."""
+        index = catalog.vector_index()
+        if index is None or not texts:
+            return None
+        try:
+            query_vecs = embed_texts(texts)
+        except Exception as e:
+            print(f"[Retriever] Batch embedding error: {e}")
+            return None
+        if query_vecs.shape[1] != index.dim:
+            return None
+        return index.search(query_vecs, k)
+
+    def _router_batch(self, unique: dict) -> dict:
+        results = {}
+        semantic_keys = []
+        for key, query in unique.items():
+            kw_results = self.keyword_search_ranked(query)
+            if len(kw_results):
+                results[key] = kw_results
+            else:
+                semantic_keys.append(key)
+
+        catalog = current_catalog()
+        searched = self._batch_vectors([unique[k] for k in semantic_keys], catalog, 2)
+        if searched is not None:
+            scores, rows = searched
+            candidates = [
+                self._rows_to_candidates(rows[i], scores[i], catalog)
+                for i in range(len(semantic_keys))
+            ]
+            found = self._fetch_paintings(
+                {pid for cands in candidates for pid, _ in cands}, catalog
+            )
+            for key, cands in zip(semantic_keys, candidates):
+                products = self._semantic_products(cands, found)
+                if products:
+                    results[key] = RankedResults.from_products(products, "semantic")
+
+        for key in semantic_keys:
+            results.setdefault(key, RankedResults([], lambda ids: {}, "none"))
+        print(f"[Retriever] Batch router: {len(unique)} câu, {len(semantic_keys)} cần semantic.")
+        return results
+
+    def _hybrid_batch(self, unique: dict) -> dict:
+        catalog = current_catalog()
+        index = catalog.keyword_index()
+        model = get_embedding_backend().name
+        lexical = {}
+        vector_keys = []
+        for key, query in unique.items():
+            lexical[key] = index.bm25.search(self._query_tokens(query), HYBRID_CANDIDATES)
+            # như hybrid_search: embedding đã cache thì dùng, lexical đủ tin cậy thì bỏ qua
+            if (EMBED_CACHE.get(query, model, count=False) is not None
+                    or not self._lexical_confident(query)):
+                vector_keys.append(key)
+
+        vector = {}
+        searched = self._batch_vectors(
+            [unique[k] for k in vector_keys], catalog, HYBRID_CANDIDATES
+        )
+        if searched is not None:
+            scores, rows = searched
+            for i, key in enumerate(vector_keys):
+                vector[key] = self._rows_to_candidates(
+                    rows[i], scores[i], catalog
+                )[:HYBRID_CANDIDATES]
+
+        print(f"[Retriever] Batch hybrid: {len(unique)} câu, {len(vector)} có vector leg.")
+        return {key: self._fuse(lexical[key], vector.get(key, []), index) for key in unique}
+
+    async def search_with_route_async(
+        self, user_input: str, max_results: Optional[int] = None
+    ):
+        results = await self.search_ranked_async(user_input)
+        return await asyncio.to_thread(results.page, 0, max_results), results.route
+
+    async def search_paintings_for_user_query_async(
+        self, user_input: str, max_results: Optional[int] = None
+    ):
+        return (await self.search_with_route_async(user_input, max_results))[0]
+
+
+# =========================
+# 5. AGENT: SUMMARIZER
+# =========================
+
+class SummarizerAgent:
+    """
+    Nhiệm vụ:
+    - Viết 1 đoạn giới thiệu ngắn (2–4 câu) về chủ đề tranh phù hợp với yêu cầu của khách.
+    - Không render gallery, chỉ text giới thiệu.
+    """
+
+    SYSTEM_PROMPT = """
+Bạn là nhân viên tư vấn bán tranh.
+Nhiệm vụ: Viết đoạn giới thiệu NGẮN GỌN (2–4 câu) về bộ sưu tập tranh
+phù hợp với yêu cầu của khách hàng.
+
+Quy tắc:
+- Không liệt kê từng bức tranh chi tiết.
+- Chỉ nói khái quát về phong cách, cảm xúc, không gian phù hợp.
+- Giọng văn thân thiện, rõ ràng, ưu tiên súc tích.
+"""
+
+    def _compact_for_summary(self, products, max_items: int = 10):
+        """Giữ thông tin tối thiểu cho Summarizer để giảm token."""
+        trimmed = []
+        for item in products[:max_items]:
+            if not isinstance(item, dict):
+                continue
+            trimmed.append({
+                "id": item.get("id"),
+                "title": item.get("title"),
+                "general_info": item.get("general_info"),
+                "themes": item.get("themes"),
+                "emotions": item.get("emotions"),
+                "description_short": item.get("description_short"),
+            })
+        return trimmed
+
+    NOT_FOUND_TEXT = "Hiện tại mình chưa tìm thấy bức tranh phù hợp trong kho dữ liệu."
+
+    @staticmethod
+    def _call_tokens(messages) -> int:
+        """Token call chiếm trong TPM của OPENAI_SCHEDULER."""
+        return estimate_tokens([m["content"] for m in messages], SUMMARY_MAX_TOKENS)
+
+    def _build_messages(self, user_input: str, products: list):
+        compacted = self._compact_for_summary(products)
+        context_text = json.dumps(compacted, ensure_ascii=False, separators=(",", ":"))
+
+        return [
+            {"role": "system", "content": self.SYSTEM_PROMPT},
+            {
+                "role": "user",
+                "content": (
+                    f"Yêu cầu của khách: {user_input}\n\n"
+                    f"Dữ liệu tóm tắt các tranh:\n{context_text}"
+                )
+            },
+        ]
+
+    @staticmethod
+    def template_intro(products: list, max_items: int = 10) -> str:
+        """Intro dựng local từ themes/emotions (degraded mode, không gọi LLM)."""
+        themes, emotions = Counter(), Counter()
+        for item in products[:max_items]:
+            for counter, field in ((themes, "themes"), (emotions, "emotions")):
+                values = item.get(field) or []
+                if isinstance(values, str):
+                    values = values.split(",")
+                for value in values:
+                    value = value.strip()
+                    if value:
+                        counter[value] += 1
+        text = "Mình gợi ý một số bức tranh phù hợp với yêu cầu của bạn"
+        if themes:
+            text += " với chủ đề " + ", ".join(t for t, _ in themes.most_common(3))
+        if emotions:
+            text += ", mang lại cảm giác " + ", ".join(e for e, _ in emotions.most_common(3))
+        return text + ". Bạn xem thử bộ sưu tập bên dưới nhé."
+
+    def summarize(self, user_input: str, products: list) -> str:
+        if not products:
+            return self.NOT_FOUND_TEXT
+
+        messages = self._build_messages(user_input, products)
+        with upstream_call(CHAT_BREAKER, CHAT_TIMEOUT_S, self._call_tokens(messages)) as timeout, \
+                metrics.openai_span("chat", CHAT_MODEL) as span:
+            resp = with_timeout(get_openai_client(), timeout).chat.completions.create(
+                model=CHAT_MODEL,
+                messages=messages,
+                temperature=0.7,
+                max_tokens=SUMMARY_MAX_TOKENS,
+                response_format={"type": "text"},
+            )
+            span.record_usage(getattr(resp, "usage", None))
+
+        return resp.choices[0].message.content
+
+    async def summarize_async(self, user_input: str, products: list) -> str:
+        if not products:
+            return self.NOT_FOUND_TEXT
+
+        messages = self._build_messages(user_input, products)
+        tokens = self._call_tokens(messages)
+        async with aupstream_call(CHAT_BREAKER, CHAT_TIMEOUT_S, tokens) as timeout:
+            with metrics.openai_span("chat", CHAT_MODEL) as span:
+                openai_client = with_timeout(get_async_openai_client(), timeout)
+                resp = await openai_client.chat.completions.create(
+                    model=CHAT_MODEL,
+                    messages=messages,
+                    temperature=0.7,
+                    max_tokens=SUMMARY_MAX_TOKENS,
+                    response_format={"type": "text"},
+                )
+                span.record_usage(getattr(resp, "usage", None))
+
+        return resp.choices[0].message.content
+
+    async def summarize_stream_async(self, user_input: str, products: list):
+        if not products:
+            yield self.NOT_FOUND_TEXT
+            return
+
+        messages = self._build_messages(user_input, products)
+        tokens = self._call_tokens(messages)
+        async with aupstream_call(CHAT_BREAKER, CHAT_TIMEOUT_S, tokens) as timeout:
+            with metrics.openai_span("chat_stream", CHAT_MODEL) as span:
+                openai_client = with_timeout(get_async_openai_client(), timeout)
+                stream = await openai_client.chat.completions.create(
+                    model=CHAT_MODEL,
+                    messages=messages,
+                    temperature=0.7,
+                    max_tokens=SUMMARY_MAX_TOKENS,
+                    response_format={"type": "text"},
+                    stream=True,
+                    stream_options={"include_usage": True},
+                )
+                async for chunk in stream:
+                    span.record_usage(getattr(chunk, "usage", None))
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        yield delta
+
+    def summarize_stream(self, user_input: str, products: list):
+        """Như summarize nhưng yield từng đoạn text ngay khi model sinh ra."""
+        if not products:
+            yield self.NOT_FOUND_TEXT
+            return
+
+        messages = self._build_messages(user_input, products)
+        with upstream_call(CHAT_BREAKER, CHAT_TIMEOUT_S, self._call_tokens(messages)) as timeout, \
+                metrics.openai_span("chat_stream", CHAT_MODEL) as span:
+            stream = with_timeout(get_openai_client(), timeout).chat.completions.create(
+                model=CHAT_MODEL,
+                messages=messages,
+                temperature=0.7,
+                max_tokens=SUMMARY_MAX_TOKENS,
+                response_format={"type": "text"},
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+            for chunk in stream:
+                span.record_usage(getattr(chunk, "usage", None))
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield delta
+
+
+# =========================
+# 6. AGENT: DESIGNER (RENDER UI/HTML)
+# =========================
+
+PRODUCT_URL = "https://cgi.vn/san-pham/{id}"
+AR_URL = "https://cgi.vn/ar/{id}.html"
+
+
+GALLERY_HEADER = "<h3>Danh sách tranh gợi ý</h3>"
+GALLERY_OPEN = '<div class="gallery">'
+GALLERY_CLOSE = "</div>"
+
+
+def render_item_html(item: dict) -> str:
+    """HTML block của 1 tranh (ảnh + link chi tiết/AR)."""
+    title = item.get("title") or "Tranh"
+    image_html = "<div>(Không có hình)</div>"
+    links_combined = ""
+    if "image" in item and "id" in item:
+        sp_id = item["id"]
+        image_html = (
+            f"<img src='{build_image_url(item['image'])}' "
+            f"style='max-width: 100%; border-radius: 10px;'>"
+        )
+        links_combined = (
+            f"<p class='links-row'>"
+            f"<a class='link-btn' href='{AR_URL.format(id=sp_id)}' target='_blank'>Xem AR</a>"
+            f"<span class=\"link-separator\">|</span>"
+            f"<a class='link-btn' href='{PRODUCT_URL.format(id=sp_id)}' "
+            f"target='_blank'>Xem chi tiết</a></p>"
+        )
+
+    return f"""
+            <div class="item" style="margin-bottom: 16px;">
+                <h4>{title}</h4>
+                {image_html}
+                {links_combined}
+            </div>
+            """
+
+
+class FragmentCache:
+    """
+    id tranh -> (HTML block, JSON record không có score), dựng 1 lần cho mỗi
+    catalog version; toàn bộ bị xoá khi catalog_version() đổi.
+    """
+
+    def __init__(self):
+        self._version = None
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _sync_version(self):
+        version = catalog_version()
+        if version != self._version:
+            with self._lock:
+                if version != self._version:
+                    self._entries = {}
+                    self._version = version
+        return self._entries
+
+    @staticmethod
+    def _build(item: dict):
+        sp_id = item["id"]
+        record = {
+            "id": sp_id,
+            "title": item.get("title") or "Tranh",
+            "image_url": build_image_url(item.get("image")),
+            "detail_url": PRODUCT_URL.format(id=sp_id),
+            "ar_url": AR_URL.format(id=sp_id),
+            "themes": item.get("themes") or [],
+            "emotions": item.get("emotions") or [],
+        }
+        return render_item_html(item), record
+
+    def get_many(self, products: list) -> list:
+        """[(html, record)] theo thứ tự products; tranh chưa có thì dựng và lưu lại."""
+        entries = self._sync_version()
+        out = []
+        for item in products:
+            fragment = entries.get(item["id"])
+            if fragment is None:
+                self.misses += 1
+                fragment = entries[item["id"]] = self._build(item)
+            else:
+                self.hits += 1
+            out.append(fragment)
+        return out
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+
+FRAGMENT_CACHE = FragmentCache()
+metrics.register_stats("fragment_cache", FRAGMENT_CACHE.stats)
+
+
+class DesignerAgent:
+    """
+    Nhiệm vụ:
+    - Render HTML layout: phần trên là intro_text, phần dưới là gallery nhiều tranh.
+    - Xuất bản ghi JSON gọn cho front end tự render.
+    HTML/JSON của từng tranh lấy từ FRAGMENT_CACHE, render chỉ là join.
+    """
+
+    @staticmethod
+    def product_record(item: dict) -> dict:
+        """JSON record của 1 tranh cho API (front end tự dựng gallery)."""
+        record = FRAGMENT_CACHE.get_many([item])[0][1]
+        return {**record, "score": item.get("score")}
+
+    def render_gallery(self, intro_text: str, products: list) -> str:
+        """
+        Tạo HTML hoàn chỉnh:
+        - Phần đầu: intro_text.
+        - Phần sau: gallery tất cả tranh.
+        """
+        if not products:
+            return (
+                "<p>Hiện tại mình chưa tìm thấy bức tranh phù hợp trong kho dữ liệu.</p>"
+            )
+
+        html_parts = []
+        # Phần giới thiệu ngắn
+        if intro_text:
+            html_parts.append(f"<p>{intro_text}</p>")
+
+        # Phần gallery
+        html_parts.append(self.render_products(products))
+        return "\n".join(html_parts)
+
+    def render_products(self, products: list) -> str:
+        """Chỉ phần gallery (không intro) — dùng khi stream intro riêng."""
+        if not products:
+            return ""
+        blocks = [html for html, _ in FRAGMENT_CACHE.get_many(products)]
+        return "\n".join([GALLERY_HEADER, GALLERY_OPEN, *blocks, GALLERY_CLOSE])
+
+
+# =========================
+# 7. AGENT: LOGS
+# =========================
+
+# Session mặc định của log (CLI, /chat/batch); lượt chat qua web dùng session
+# của cookie (SESSION_COOKIE).
+SESSION_ID = str(uuid4())[:8]
+
+LOG_FLUSH_INTERVAL = float(os.getenv("CHATBOT_LOG_FLUSH_INTERVAL", "1.0"))
+LOG_BATCH_SIZE = int(os.getenv("CHATBOT_LOG_BATCH_SIZE", "256"))
+LOG_MAX_BYTES = int(os.getenv("CHATBOT_LOG_MAX_BYTES", str(50 * 1024 * 1024)))
+LOG_QUEUE_SIZE = int(os.getenv("CHATBOT_LOG_QUEUE_SIZE", "10000"))
+# flush() (atexit, worker thoát) chờ tối đa chừng này giây rồi bỏ qua phần còn lại.
+LOG_FLUSH_TIMEOUT_S = float(os.getenv("CHATBOT_LOG_FLUSH_TIMEOUT_S", "5"))
+
+# Đánh dấu trong queue: flush() yêu cầu thread ghi batch hiện tại ngay.
+_FLUSH = object()
+
+try:  # khoá file giữa nhiều worker (POSIX); Windows dev chạy 1 process
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class StageTimer:
+    """Đo thời gian (ms) từng bước của 1 lượt chat (kèm histogram /metrics)."""
+
+    def __init__(self):
+        self.timings = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.timings[name] = round(elapsed * 1000, 2)
+            metrics.STAGE_SECONDS.observe(elapsed, stage=name)
+            metrics.record_timing(name, elapsed * 1000)
+
+
+class LogAgent:
+    """
+    Nhiệm vụ:
+    - Ghi log JSONL có cấu trúc (session, query, id tranh, route, timings),
+      không lưu HTML.
+    - Request chỉ đẩy record vào queue; 1 thread nền gom batch và ghi theo
+      chu kỳ/kích thước, xoay file theo ngày và theo dung lượng.
+    """
+
+    def __init__(self, log_dir: str = LOG_DIR, flush_interval: float = LOG_FLUSH_INTERVAL,
+                 batch_size: int = LOG_BATCH_SIZE, max_bytes: int = LOG_MAX_BYTES):
+        self.log_dir = log_dir
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        os.makedirs(self.log_dir, exist_ok=True)
+        self._queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        self._thread = None
+        self._thread_pid = None
+        self._start_lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+        atexit.register(self.flush)
+
+    def log_chat(self, user_input: str, product_ids=None, route: Optional[str] = None,
+                 timings: Optional[dict] = None, session_id: Optional[str] = None,
+                 cached: bool = False, degraded=None):
+        record = {
+            "ts": datetime.now().isoformat(timespec="milliseconds"),
+            "session": session_id or SESSION_ID,
+            "query": user_input,
+            "ids": list(product_ids or []),
+            "route": route,
+            "cached": cached,
+            "degraded": sorted(degraded or []),
+            "timings_ms": timings or {},
+        }
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1  # không bao giờ chặn request vì log
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._thread is None or self._thread_pid != os.getpid():
+                self._thread = threading.Thread(
+                    target=self._run, name="chat-log-writer", daemon=True
+                )
+                self._thread_pid = os.getpid()
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size and batch[-1] is not _FLUSH:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                self._write([record for record in batch if record is not _FLUSH])
+            except Exception as e:  # lỗi bất kỳ (OSError, record không serialize được...)
+                # không được làm chết thread ghi
+                self.dropped += sum(record is not _FLUSH for record in batch)
+                print(f"[LogAgent] Lỗi ghi log: {e!r}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _log_path(self, day: str) -> str:
+        return os.path.join(self.log_dir, f"{day}.jsonl")
+
+    def _write(self, batch):
+        by_day = {}
+        for record in batch:
+            by_day.setdefault(record["ts"][:10], []).append(record)
+
+        for day, records in by_day.items():
+            lines = []
+            for r in records:
+                try:
+                    lines.append(json.dumps(r, ensure_ascii=False, separators=(",", ":")))
+                except (TypeError, ValueError) as e:  # bỏ record hỏng, giữ phần còn lại
+                    self.dropped += 1
+                    print(f"[LogAgent] Bỏ record không ghi được: {e}")
+            if not lines:
+                continue
+            data = "".join(line + "\n" for line in lines).encode("utf-8")
+            with open(os.path.join(self.log_dir, ".lock"), "a") as lock:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                path = self._log_path(day)
+                self._rotate_if_needed(path, day)
+                fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    os.write(fd, data)
+                finally:
+                    os.close(fd)
+            self.written += len(lines)
+
+    def _rotate_if_needed(self, path: str, day: str):
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        if size < self.max_bytes:
+            return
+        n = 1
+        while os.path.exists(os.path.join(self.log_dir, f"{day}.{n}.jsonl")):
+            n += 1
+        os.replace(path, os.path.join(self.log_dir, f"{day}.{n}.jsonl"))
+
+    def flush(self, timeout: float = LOG_FLUSH_TIMEOUT_S) -> bool:
+        """
+        Chờ ghi hết các record đang trong queue (dùng khi tắt server/test), tối
+        đa `timeout` giây. False nếu còn record chưa ghi.
+        """
+        if self._thread is None or self._thread_pid != os.getpid():
+            return True
+        deadline = time.monotonic() + timeout
+        try:  # ghi ngay batch đang gom, không chờ hết flush_interval
+            self._queue.put(_FLUSH, timeout=timeout)
+        except queue.Full:
+            return False
+        done = self._queue.all_tasks_done
+        with done:
+            while self._queue.unfinished_tasks and self._thread.is_alive():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                done.wait(remaining)
+            return not self._queue.unfinished_tasks
+
+
+# =========================
+# 8. AGENT: DIRECTOR (ĐIỀU PHỐI)
+# =========================
+
+REPLY_CACHE_MAX_ENTRIES = int(os.getenv("CHATBOT_REPLY_CACHE_MAX", "2048"))
+REPLY_CACHE_THRESHOLD = float(os.getenv("CHATBOT_REPLY_CACHE_THRESHOLD", "0.92"))
+REPLY_CACHE_MIN_OVERLAP = float(os.getenv("CHATBOT_REPLY_CACHE_MIN_OVERLAP", "0.6"))
+
+
+class ReplyCache:
+    """
+    Cache intro text của Summarizer.
+    - Exact: (normalize_query(query), tập id tranh đã retrieve).
+    - Semantic: nếu có sẵn embedding của query (không gọi thêm API), tái dùng
+      intro của câu đã cache có cosine >= threshold và tập tranh trùng đủ nhiều.
+    Bounded LRU; toàn bộ cache bị xoá khi catalog_version() đổi.
+    """
+
+    def __init__(self, max_entries: int = REPLY_CACHE_MAX_ENTRIES,
+                 threshold: float = REPLY_CACHE_THRESHOLD,
+                 min_overlap: float = REPLY_CACHE_MIN_OVERLAP):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.min_overlap = min_overlap
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (intro, ids, slot | None)
+        self._vectors = None           # (max_entries, dim) normalized query vectors
+        self._slot_keys = [None] * max_entries
+        self._free_slots = list(range(max_entries - 1, -1, -1))
+        self._version = None
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(query: str, ids) -> tuple:
+        return normalize_query(query), frozenset(ids)
+
+    def _sync_version(self, version: str):
+        if version != self._version:
+            self._entries.clear()
+            self._vectors = None  # slot cũ không được chiếm chỗ trong top-k cosine
+            self._slot_keys = [None] * self.max_entries
+            self._free_slots = list(range(self.max_entries - 1, -1, -1))
+            self._version = version
+
+    def _semantic_lookup(self, ids: frozenset, query_vec):
+        if self._vectors is None or query_vec is None or len(query_vec) != self._vectors.shape[1]:
+            return None
+        q = query_vec / (np.linalg.norm(query_vec) + 1e-8)
+        scores = self._vectors @ q
+        for slot in top_k_indices(scores, 8):
+            if scores[slot] < self.threshold:
+                break
+            key = self._slot_keys[slot]
+            if key is None:
+                continue
+            intro, cached_ids, _ = self._entries[key]
+            overlap = len(ids & cached_ids) / max(len(ids | cached_ids), 1)
+            if overlap >= self.min_overlap:
+                self._entries.move_to_end(key)
+                return intro
+        return None
+
+    def get(self, query: str, ids, version: str, query_vec=None) -> Optional[str]:
+        key = self._key(query, ids)
+        with self._lock:
+            self._sync_version(version)
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.exact_hits += 1
+                return entry[0]
+            intro = self._semantic_lookup(key[1], query_vec)
+            if intro is not None:
+                self.semantic_hits += 1
+                return intro
+            self.misses += 1
+            return None
+
+    def put(self, query: str, ids, intro: str, version: str, query_vec=None):
+        key = self._key(query, ids)
+        with self._lock:
+            self._sync_version(version)
+            old = self._entries.pop(key, None)
+            if old is not None and old[2] is not None:
+                self._release(old[2])
+            while len(self._entries) >= self.max_entries:
+                _, (_, _, slot) = self._entries.popitem(last=False)
+                if slot is not None:
+                    self._release(slot)
+
+            slot = None
+            if query_vec is not None:
+                if self._vectors is None:
+                    self._vectors = np.zeros((self.max_entries, len(query_vec)), dtype="float32")
+                if len(query_vec) == self._vectors.shape[1]:
+                    slot = self._free_slots.pop()
+                    self._vectors[slot] = query_vec / (np.linalg.norm(query_vec) + 1e-8)
+                    self._slot_keys[slot] = key
+            self._entries[key] = (intro, key[1], slot)
+
+    def _release(self, slot: int):
+        self._vectors[slot] = 0.0
+        self._slot_keys[slot] = None
+        self._free_slots.append(slot)
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits = self.exact_hits + self.semantic_hits
+            total = hits + self.misses
+            return {
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "hit_rate": hits / total if total else 0.0,
+                "entries": len(self._entries),
+            }
+
+
+# Trạng thái hội thoại theo session (cookie SESSION_COOKIE): kết quả lượt trước
+# để câu refine ("màu xanh thôi", "cho phòng khách") lọc lại local.
+SESSION_COOKIE = "chatbot_sid"
+SESSION_MAX = int(os.getenv("CHATBOT_SESSION_MAX", "10000"))
+SESSION_TTL_S = float(os.getenv("CHATBOT_SESSION_TTL_S", "1800"))
+SESSION_MAX_BYTES = int(os.getenv("CHATBOT_SESSION_MAX_BYTES", str(32 * 1024 * 1024)))
+SESSION_MAX_IDS = 500  # số tranh (đã xếp hạng) giữ lại mỗi lượt
+# Số lượt gần nhất giữ lại mỗi session (cursor của lượt cũ vẫn lật trang được).
+SESSION_HISTORY = int(os.getenv("CHATBOT_SESSION_HISTORY", "4"))
+SESSION_REFINE = os.getenv("CHATBOT_SESSION_REFINE", "1") == "1"
+# Dấu hiệu câu refine, so trên chữ *có dấu* ("chó", "voi" không phải "cho", "với"):
+# chữ đầu câu, chữ cuối câu (không dấu cũng được) hoặc cụm ở bất kỳ đâu (không
+# dấu cũng được: "chi lay" vẫn đủ rõ).
+REFINE_LEADING = frozenset({"chỉ", "lọc", "thêm", "còn"})
+REFINE_TRAILING = frozenset({"thôi", "nữa"})
+REFINE_PHRASES = (
+    ("chỉ", "lấy"), ("chỉ", "cần"), ("lọc", "theo"), ("lọc", "ra"), ("thêm", "nữa"),
+    ("trong", "số", "đó"), ("trong", "đó"),
+)
+# Tiểu từ cuối câu bỏ qua khi tìm chữ cuối ("màu xanh thôi nhé").
+REFINE_PARTICLES = frozenset({"nhé", "nha", "ạ", "đi", "nhe"})
+# Phần nội dung nhiều hơn chừng này chữ = câu hỏi mới; tổng số chữ lọc của 1 chuỗi refine.
+REFINE_MAX_TERMS = 4
+REFINE_MAX_CHAIN = 8
+REFINE_ROUTES = ("refine",)
+SESSION_ID_RE = re.compile(r"[A-Za-z0-9_-]{8,64}")
+UNICODE_WORD_RE = re.compile(r"\w+")
+
+
+def session_id_from(value: Optional[str]) -> str:
+    """Session id từ cookie nếu hợp lệ, nếu không thì id mới."""
+    if value and SESSION_ID_RE.fullmatch(value):
+        return value
+    return uuid4().hex[:16]
+
+
+def _strip_phrases(words: list, folded: list) -> bool:
+    """Bỏ các cụm REFINE_PHRASES khỏi `words` / `folded` (tại chỗ); True nếu có."""
+    found = False
+    for phrase in REFINE_PHRASES:
+        plain = [fold_text(w) for w in phrase]
+        n = len(phrase)
+        i = 0
+        while i + n <= len(words):
+            if words[i:i + n] == list(phrase) or folded[i:i + n] == plain:
+                del words[i:i + n], folded[i:i + n]
+                found = True
+            else:
+                i += 1
+    return found
+
+
+def refinement_text(message: str, refine: Optional[bool] = None) -> Optional[str]:
+    """
+    Phần nội dung của câu refine ("màu xanh thôi" -> "màu xanh"), None nếu câu
+    không phải refine. `refine` do client gửi thì theo nó; nếu không thì đoán
+    theo REFINE_LEADING / REFINE_TRAILING / REFINE_PHRASES, và câu nhắc "tranh"
+    ("cho tôi tranh mèo") là câu hỏi mới.
+    """
+    if refine is False or (refine is None and not SESSION_REFINE):
+        return None
+    words = UNICODE_WORD_RE.findall(unicodedata.normalize("NFC", (message or "").lower()))
+    folded = [fold_text(w) for w in words]
+    cued = _strip_phrases(words, folded)
+    if words and words[0] in REFINE_LEADING:
+        del words[0], folded[0]
+        cued = True
+    while words and words[-1] in REFINE_PARTICLES:
+        del words[-1], folded[-1]
+    if words and folded[-1] in {fold_text(w) for w in REFINE_TRAILING}:
+        del words[-1], folded[-1]
+        cued = True
+    if refine is None and (not cued or "tranh" in folded):
+        return None
+    return " ".join(words)
+
+
+class SessionState:
+    """
+    Kết quả 1 lượt của session: câu gốc (lượt không refine gần nhất) + các chữ
+    lọc đã áp dụng (`terms`), id + score đã xếp hạng (numpy, gọn bộ nhớ).
+    """
+
+    __slots__ = ("query", "terms", "ids", "scores", "route", "version", "nbytes")
+
+    def __init__(self, query: str, ranked, route: str, version: str, terms=()):
+        self.query = query
+        self.terms = tuple(terms)
+        self.ids = np.fromiter((pid for pid, _ in ranked), dtype=np.int64, count=len(ranked))
+        self.scores = np.fromiter((sc for _, sc in ranked), dtype=np.float32, count=len(ranked))
+        self.route = route
+        self.version = version
+        self.nbytes = (self.ids.nbytes + self.scores.nbytes
+                       + 2 * (len(query) + sum(len(t) for t in self.terms)) + 256)
+
+    @property
+    def key(self) -> tuple:
+        return self.query, self.terms
+
+    def ranked(self):
+        return list(zip(self.ids.tolist(), self.scores.tolist()))
+
+
+class SessionStore:
+    """
+    `history` lượt gần nhất của mỗi session: LRU, hết hạn sau `ttl_s` giây không
+    dùng, tổng dung lượng ước lượng <= `max_bytes`. Mỗi process 1 store (worker
+    khác không thấy session -> lượt đó retrieval đầy đủ như bình thường).
+    """
+
+    def __init__(self, max_sessions: int = SESSION_MAX, ttl_s: float = SESSION_TTL_S,
+                 max_bytes: int = SESSION_MAX_BYTES, history: int = SESSION_HISTORY):
+        self.max_sessions = max_sessions
+        self.ttl_s = ttl_s
+        self.max_bytes = max_bytes
+        self.history = max(1, history)
+        self._lock = threading.Lock()
+        # session id -> [hạn (monotonic), list SessionState, lượt mới nhất ở cuối]
+        self._sessions = OrderedDict()
+        self.bytes = 0
+        self.evicted = 0
+        self.expired = 0
+
+    def _drop(self, session_id: str):
+        entry = self._sessions.pop(session_id, None)
+        if entry is not None:
+            self.bytes -= sum(state.nbytes for state in entry[1])
+
+    def get(self, session_id: Optional[str], version: str,
+            key: Optional[tuple] = None) -> Optional[SessionState]:
+        """Lượt mới nhất (hoặc lượt có `key` = (query, terms)) của session; None nếu hết hạn."""
+        if not session_id:
+            return None
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic() or entry[1][-1].version != version:
+                self._drop(session_id)
+                self.expired += 1
+                return None
+            entry[0] = time.monotonic() + self.ttl_s
+            self._sessions.move_to_end(session_id)
+            if key is None:
+                return entry[1][-1]
+            for state in reversed(entry[1]):
+                if state.key == key:
+                    return state
+            return None
+
+    def put(self, session_id: Optional[str], query: str, results: RankedResults, version: str,
+            terms=()):
+        if not session_id:
+            return
+        now = time.monotonic()
+        state = SessionState(query, results.ranked[:SESSION_MAX_IDS], results.route, version,
+                             terms)
+        with self._lock:
+            entry = self._sessions.pop(session_id, None)
+            if entry is None or entry[1][-1].version != version:
+                if entry is not None:
+                    self.bytes -= sum(old.nbytes for old in entry[1])
+                entry = [now, []]
+            turns = entry[1]
+            for old in [old for old in turns if old.key == state.key]:
+                turns.remove(old)
+                self.bytes -= old.nbytes
+            turns.append(state)
+            self.bytes += state.nbytes
+            while len(turns) > self.history:
+                self.bytes -= turns.pop(0).nbytes
+            entry[0] = now + self.ttl_s
+            self._sessions[session_id] = entry
+            # LRU: đầu OrderedDict là session lâu nhất không dùng (hết hạn trước tiên)
+            while self._sessions:
+                oldest_id, (expires, _) = next(iter(self._sessions.items()))
+                if expires <= now:
+                    self.expired += 1
+                elif len(self._sessions) > self.max_sessions or self.bytes > self.max_bytes:
+                    self.evicted += 1
+                else:
+                    break
+                self._drop(oldest_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "active": len(self._sessions),
+                "bytes": self.bytes,
+                "evicted": self.evicted,
+                "expired": self.expired,
+            }
+
+
+PAGE_SIZE = int(os.getenv("CHATBOT_PAGE_SIZE", "12"))
+MAX_PAGE_SIZE = 100  # trang lớn nhất /chat/batch trả và cursor chấp nhận
+# /chat/batch: số câu tối đa, budget của cả batch, số summarizer chạy song song.
+BATCH_MAX_QUERIES = int(os.getenv("CHATBOT_BATCH_MAX_QUERIES", "500"))
+BATCH_BUDGET_S = float(os.getenv("CHATBOT_BATCH_BUDGET_S", "120"))
+BATCH_SUMMARY_WORKERS = int(os.getenv("CHATBOT_BATCH_SUMMARY_WORKERS", "4"))
+SUMMARIZE_MODES = ("none", "template", "llm")
+# Câu mẫu cho DirectorAgent.warmup(), phân cách bằng "|".
+WARMUP_QUERIES = [
+    q.strip()
+    for q in os.getenv("CHATBOT_WARMUP_QUERIES", "tranh phong cảnh|hoa sen|tranh trừu tượng")
+    .split("|")
+    if q.strip()
+]
+SUMMARY_ITEMS = 10  # số tranh top đưa cho Summarizer
+# Cùng câu hỏi + cùng tranh top đang chờ LLM -> 1 lần gọi summarizer.
+SUMMARY_FLIGHT = SingleFlight("summarize")
+
+
+def encode_cursor(query: str, offset: int, page_size: int,
+                  session_id: Optional[str] = None, terms=()) -> str:
+    """
+    Cursor không trạng thái cho /results/<cursor>: worker nào cũng tính lại
+    được trang (keyword rẻ, semantic dùng embedding đã cache). Kết quả refine
+    kèm session id + chữ lọc: trang sau lấy từ SessionStore, hết session thì
+    tính lại = kết quả của `query` lọc theo `terms`.
+    """
+    data = {"q": query, "o": offset, "n": page_size}
+    if session_id:
+        data["s"] = session_id
+    if terms:
+        data["r"] = list(terms)
+    raw = json.dumps(data, ensure_ascii=False)
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    """
+    (query, offset, page_size, session_id | None, terms); ValueError nếu cursor
+    hỏng.
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        query, offset, page_size = str(data["q"]), int(data["o"]), int(data["n"])
+        session_id = data.get("s")
+        terms = tuple(data.get("r") or ())
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        raise ValueError(f"invalid cursor: {cursor!r}") from e
+    if offset < 0 or not 0 < page_size <= MAX_PAGE_SIZE:
+        raise ValueError(f"invalid cursor: {cursor!r}")
+    if session_id is not None and not SESSION_ID_RE.fullmatch(str(session_id)):
+        raise ValueError(f"invalid cursor: {cursor!r}")
+    if len(terms) > REFINE_MAX_CHAIN or not all(
+        isinstance(t, str) and WORD_RE.fullmatch(t) for t in terms
+    ):
+        raise ValueError(f"invalid cursor: {cursor!r}")
+    return query, offset, page_size, session_id, terms
+
+
+# DirectorAgent đang sống (app, benchmark, test...): gauge reply_cache / sessions
+# đăng ký 1 lần ở đây và cộng dồn trên tất cả instance.
+_DIRECTORS = weakref.WeakSet()
+
+
+def _sum_director_stats(attr: str) -> dict:
+    total = {}
+    for director in list(_DIRECTORS):
+        for key, value in getattr(director, attr).stats().items():
+            total[key] = total.get(key, 0) + value
+    return total
+
+
+def reply_cache_stats() -> dict:
+    stats = _sum_director_stats("reply_cache")
+    if stats:
+        hits = stats["exact_hits"] + stats["semantic_hits"]
+        total = hits + stats["misses"]
+        stats["hit_rate"] = hits / total if total else 0.0
+    return stats
+
+
+metrics.register_stats("reply_cache", reply_cache_stats)
+metrics.register_stats("sessions", lambda: _sum_director_stats("sessions"))
+
+
+class DirectorAgent:
+    """
+    Nhiệm vụ:
+    - Nhận câu hỏi từ user.
+    - Gọi Retriever -> lấy danh sách tranh.
+    - Gọi Summarizer -> tạo intro ngắn.
+    - Gọi Designer -> render HTML trả về.
+    - Gọi LogAgent -> ghi log.
+    """
+
+    def __init__(self):
+        require_openai_key()  # fail fast nếu thiếu OPENAI_API_KEY
+        self.retriever = RetrieverAgent()
+        self.summarizer = SummarizerAgent()
+        self.designer = DesignerAgent()
+        self.logger = LogAgent()
+        self.reply_cache = ReplyCache()
+        self.sessions = SessionStore()
+        _DIRECTORS.add(self)
+        self._summary_pool = None
+        self._summary_pool_lock = threading.Lock()
+
+    def summarize_cached(self, user_input: str, products: list) -> str:
+        """Summarizer qua ReplyCache: câu hỏi lặp lại không tốn thêm LLM call."""
+        ids = [p["id"] for p in products]
+        return self._summarize_cached(user_input, products, ids)[0]
+
+    def _summarize_cached(self, user_input: str, products: list, ids: list):
+        """(intro, cached?) — `ids` là toàn bộ id đã retrieve (key của ReplyCache)."""
+        if not products:
+            return self.summarizer.summarize(user_input, products), False
+
+        intro_text, version, query_vec = self._cached_intro(user_input, ids)
+        if intro_text is not None:
+            return intro_text, True
+        try:
+            intro_text = SUMMARY_FLIGHT.do(
+                self._summary_key(user_input, products, version),
+                self._summarize_fresh, user_input, products, ids, version, query_vec,
+            )
+        except Exception as e:
+            return self._degraded_intro(products, e), False
+        return intro_text, False
+
+    @staticmethod
+    def _summary_key(user_input: str, products: list, version: str):
+        return version, normalize_query(user_input), tuple(p["id"] for p in products)
+
+    def _summarize_fresh(self, user_input, products, ids, version, query_vec) -> str:
+        intro_text = self.summarizer.summarize(user_input, products)
+        self.reply_cache.put(user_input, ids, intro_text, version, query_vec)
+        return intro_text
+
+    async def _asummarize_fresh(self, user_input, products, ids, version, query_vec) -> str:
+        intro_text = await self.summarizer.summarize_async(user_input, products)
+        if products:
+            self.reply_cache.put(user_input, ids, intro_text, version, query_vec)
+        return intro_text
+
+    def _degraded_intro(self, products: list, error: Exception) -> str:
+        """Summarizer lỗi / breaker mở / hết budget -> intro mẫu (không cache)."""
+        print(f"[Director] Summarizer không dùng được ({error}) -> intro mẫu.")
+        budget = current_budget()
+        if budget is not None:
+            budget.degraded.add(CHAT_BREAKER.name)
+        return self.summarizer.template_intro(products)
+
+    def _cached_intro(self, user_input: str, ids: list):
+        """
+        (intro | None, version, query_vec) — tra ReplyCache.
+        Chỉ dùng embedding đã có trong cache (nhánh semantic), không gọi thêm API.
+        """
+        version = catalog_version()
+        query_vec = EMBED_CACHE.get(user_input, get_embedding_backend().name, count=False)
+        intro_text = self.reply_cache.get(user_input, ids, version, query_vec) if ids else None
+        return intro_text, version, query_vec
+
+    def _page_payload(self, query: str, results: RankedResults, offset: int,
+                      page_size: int, page: list, session_id: Optional[str] = None,
+                      terms=()) -> dict:
+        next_offset = offset + page_size
+        refined = results.route in REFINE_ROUTES
+        return {
+            "products": [self.designer.product_record(p) for p in page],
+            "total": len(results),
+            "next_cursor": (
+                encode_cursor(query, next_offset, page_size, *(
+                    (session_id, terms) if refined else ()
+                ))
+                if next_offset < len(results) else None
+            ),
+        }
+
+    def _record_turn(self, user_input: str, page: list, route: str, timer: StageTimer,
+                     cached: bool, budget: RequestBudget, session_id: Optional[str] = None):
+        """Ghi log (chỉ đẩy vào queue) + đếm route / degraded cho /metrics."""
+        metrics.RETRIEVAL_ROUTES.inc(route=route, cached=str(cached).lower())
+        for upstream in budget.degraded:
+            metrics.DEGRADED_TURNS.inc(upstream=upstream)
+        self.logger.log_chat(
+            user_input, [p["id"] for p in page], route, timer.timings, session_id=session_id,
+            cached=cached, degraded=budget.degraded,
+        )
+
+    def _session_refine(self, user_input: str, session_id: Optional[str],
+                        refine: Optional[bool]):
+        """
+        (RankedResults | None, query, terms) của lượt. Câu refine + session còn
+        kết quả lượt trước -> lọc local; query = câu gốc của chuỗi refine, terms =
+        mọi chữ lọc (không trùng, tối đa REFINE_MAX_CHAIN). Không lọc được (câu
+        hỏi mới, không tranh nào khớp...) -> (None, user_input, ()): retrieval mới.
+        """
+        text = refinement_text(user_input, refine) if session_id else None
+        if text is None:
+            return None, user_input, ()
+        state = self.sessions.get(session_id, catalog_version())
+        if state is None:
+            return None, user_input, ()
+        new_terms = [t for t in self.retriever.refine_terms(text) if t not in state.terms]
+        terms = state.terms + tuple(new_terms)
+        if len(new_terms) > REFINE_MAX_TERMS or len(terms) > REFINE_MAX_CHAIN:
+            return None, user_input, ()
+        results = self.retriever.refine(state.ranked(), new_terms)
+        if results is None:
+            return None, user_input, ()
+        return results, state.query, terms
+
+    def _retrieve(self, user_input: str, session_id: Optional[str], refine: Optional[bool]):
+        results, query, terms = self._session_refine(user_input, session_id, refine)
+        if results is None:
+            results = self.retriever.search_ranked(query)
+        self.sessions.put(session_id, query, results, catalog_version(), terms)
+        return results, query, terms
+
+    def _refined_results(self, query: str, terms) -> RankedResults:
+        """Kết quả của `query` lọc theo `terms` (trang sau khi session không còn)."""
+        results = self.retriever.search_ranked(query)
+        return self.retriever.refine(results.ranked, terms) or results
+
+    def _refine_intro(self, top: list) -> str:
+        """Lượt refine: intro mẫu từ tranh đã lọc (không gọi LLM)."""
+        if not top:
+            return SummarizerAgent.NOT_FOUND_TEXT
+        return self.summarizer.template_intro(top)
+
+    def handle_chat(self, user_input: str, page_size: int = PAGE_SIZE,
+                    session_id: Optional[str] = None, refine: Optional[bool] = None) -> dict:
+        """
+        Payload cho /chat: intro + trang đầu tiên (HTML và JSON record),
+        `next_cursor` để lấy tiếp qua results_page. Có `session_id`: câu refine
+        lọc lại kết quả lượt trước của session (xem refinement_text).
+        """
+        budget = start_budget()
+        timer = StageTimer()
+
+        # 1. Lấy dữ liệu tranh (đã xếp hạng), chỉ dựng dict cho phần cần dùng
+        with timer.stage("retrieve"):
+            results, query, terms = self._retrieve(user_input, session_id, refine)
+            top = results.page(0, max(page_size, SUMMARY_ITEMS))
+            page = top[:page_size]
+
+        # 2. Tạo đoạn giới thiệu ngắn (có cache; lượt refine dùng intro mẫu)
+        with timer.stage("summarize"):
+            if results.route in REFINE_ROUTES:
+                intro_text, cached = self._refine_intro(top), False
+            else:
+                intro_text, cached = self._summarize_cached(query, top, results.ids)
+
+        # 3. Render HTML layout + JSON
+        with timer.stage("render"):
+            response_html = self.designer.render_gallery(intro_text, page)
+            payload = self._page_payload(query, results, 0, page_size, page, session_id, terms)
+
+        # 4. Ghi log (chỉ đẩy vào queue)
+        self._record_turn(user_input, page, results.route, timer, cached, budget, session_id)
+
+        return {"reply": response_html, "intro": intro_text, **payload,
+                "degraded": bool(budget.degraded)}
+
+    def warmup(self, queries=None) -> dict:
+        """
+        Dựng trước những gì request đầu tiên cần, không gọi OpenAI: snapshot
+        catalogue (meta, vector/keyword index, SQLite) rồi chạy BM25 + render
+        fragment cho vài câu mẫu để nạp trang SQLite và FragmentCache.
+        """
+        start = time.perf_counter()
+        queries = WARMUP_QUERIES if queries is None else queries
+        catalog = current_catalog()
+        catalog.warm()
+        catalog.keyword_index()
+        products = 0
+        for query in queries:
+            page = self.retriever.hybrid_search(query, allow_embed=False).page(0, PAGE_SIZE)
+            self.designer.render_products(page)
+            products += len(page)
+        return {"queries": len(queries), "products": products,
+                "seconds": round(time.perf_counter() - start, 3)}
+
+    def _summary_executor(self) -> ThreadPoolExecutor:
+        """Pool dùng chung cho summarizer của mọi batch (giới hạn số LLM call song song)."""
+        if self._summary_pool is None:
+            with self._summary_pool_lock:
+                if self._summary_pool is None:
+                    self._summary_pool = ThreadPoolExecutor(
+                        max_workers=BATCH_SUMMARY_WORKERS, thread_name_prefix="batch-summary"
+                    )
+        return self._summary_pool
+
+    def _batch_intros(self, queries: list, tops: list, results: list, mode: str) -> list:
+        if mode == "none":
+            return [""] * len(queries)
+        if mode == "template":
+            return [
+                self.summarizer.template_intro(top) if top else SummarizerAgent.NOT_FOUND_TEXT
+                for top in tops
+            ]
+        pool = self._summary_executor()
+        # copy_context: worker thấy budget của batch (ContextVar)
+        futures = [
+            pool.submit(copy_context().run, self._summarize_cached, query, top, res.ids)
+            for query, top, res in zip(queries, tops, results)
+        ]
+        return [future.result()[0] for future in futures]
+
+    def handle_batch(self, queries: list, page_size: int = PAGE_SIZE,
+                     summarize: str = "template", html: bool = False) -> list:
+        """
+        /chat/batch: payload như handle_chat cho từng câu (theo thứ tự, câu trùng
+        chỉ tính 1 lần). Retrieval chạy 1 lượt cho cả batch (search_ranked_batch);
+        intro: "none" (bỏ qua), "template" (local) hoặc "llm" (ReplyCache +
+        summarizer, tối đa BATCH_SUMMARY_WORKERS call song song).
+        """
+        if summarize not in SUMMARIZE_MODES:
+            raise ValueError(f"summarize must be one of {SUMMARIZE_MODES}")
+        if len(queries) > BATCH_MAX_QUERIES:
+            raise ValueError(f"at most {BATCH_MAX_QUERIES} queries per batch")
+        page_size = min(max(1, page_size), MAX_PAGE_SIZE)
+        budget = start_budget(BATCH_BUDGET_S, priority="batch")
+        timer = StageTimer()
+
+        first = {}
+        for query in queries:
+            first.setdefault(normalize_query(query), query)
+        unique, unique_queries = list(first), list(first.values())
+
+        with timer.stage("batch_retrieve"):
+            results = self.retriever.search_ranked_batch(unique_queries)
+            tops = [r.page(0, max(page_size, SUMMARY_ITEMS)) for r in results]
+
+        with timer.stage("batch_summarize"):
+            intros = self._batch_intros(unique_queries, tops, results, summarize)
+
+        with timer.stage("batch_render"):
+            payloads = {}
+            for key, query, res, top, intro in zip(unique, unique_queries, results, tops, intros):
+                page = top[:page_size]
+                payload = {"query": query, "intro": intro, "route": res.route,
+                           **self._page_payload(query, res, 0, page_size, page)}
+                if html:
+                    payload["reply"] = self.designer.render_gallery(intro, page)
+                payloads[key] = payload
+                metrics.RETRIEVAL_ROUTES.inc(route=res.route, cached="false")
+                self.logger.log_chat(query, [p["id"] for p in page], res.route,
+                                     degraded=budget.degraded)
+
+        degraded = bool(budget.degraded)
+        return [
+            {**payloads[normalize_query(query)], "query": query, "degraded": degraded}
+            for query in queries
+        ]
+
+    def handle_user_message(self, user_input: str) -> str:
+        return self.handle_chat(user_input)["reply"]
+
+    def results_page(self, cursor: str) -> dict:
+        """
+        Trang tiếp theo cho /results/<cursor> (không gọi Summarizer). Có budget
+        riêng: tính lại trang có thể cần embedding của câu hỏi.
+        """
+        query, offset, page_size, session_id, terms = decode_cursor(cursor)
+        with request_budget():
+            key = (query, terms)
+            state = self.sessions.get(session_id, catalog_version(), key) if terms else None
+            if state is not None and state.route in REFINE_ROUTES:
+                ranked, fetch = state.ranked(), load_keyword_index().get_many
+                results = RankedResults(ranked, fetch, state.route)
+            elif terms:
+                results = self._refined_results(query, terms)
+            else:
+                results = self.retriever.search_ranked(query)
+            page = results.page(offset, page_size)
+        return self._page_payload(query, results, offset, page_size, page, session_id, terms)
+
+    async def _summarize_cached_async(self, user_input: str, products: list, ids: list,
+                                      timer: StageTimer):
+        with timer.stage("summarize"):
+            intro_text, version, query_vec = await asyncio.to_thread(
+                self._cached_intro, user_input, ids
+            )
+            if intro_text is not None:
+                return intro_text, True
+            try:
+                intro_text = await SUMMARY_FLIGHT.ado(
+                    self._summary_key(user_input, products, version),
+                    self._asummarize_fresh, user_input, products, ids, version, query_vec,
+                )
+            except Exception as e:
+                return self._degraded_intro(products, e), False
+            return intro_text, False
+
+    async def _retrieve_async(self, user_input: str, page_size: int, timer: StageTimer,
+                              session_id: Optional[str] = None, refine: Optional[bool] = None):
+        """(results, query, terms của lượt, top, page)."""
+        with timer.stage("retrieve"):
+            results, query, terms = await asyncio.to_thread(
+                self._session_refine, user_input, session_id, refine
+            )
+            if results is None:
+                results = await self.retriever.search_ranked_async(query)
+            self.sessions.put(session_id, query, results, catalog_version(), terms)
+            top = await asyncio.to_thread(results.page, 0, max(page_size, SUMMARY_ITEMS))
+        return results, query, terms, top, top[:page_size]
+
+    async def handle_chat_async(self, user_input: str, page_size: int = PAGE_SIZE,
+                                session_id: Optional[str] = None,
+                                refine: Optional[bool] = None) -> dict:
+        """
+        Bản async của handle_chat: render gallery (thread) chạy song song
+        với Summarizer.
+        """
+        budget = start_budget()
+        timer = StageTimer()
+        results, query, terms, top, page = await self._retrieve_async(
+            user_input, page_size, timer, session_id, refine
+        )
+
+        async def render():
+            with timer.stage("render"):
+                return await asyncio.to_thread(
+                    lambda: (
+                        self.designer.render_products(page),
+                        self._page_payload(
+                            query, results, 0, page_size, page, session_id, terms
+                        ),
+                    )
+                )
+
+        async def summarize():
+            if results.route in REFINE_ROUTES:
+                with timer.stage("summarize"):
+                    return self._refine_intro(top), False
+            return await self._summarize_cached_async(query, top, results.ids, timer)
+
+        (intro_text, cached), (gallery_html, payload) = await asyncio.gather(
+            summarize(), render()
+        )
+        if page:
+            response_html = "\n".join(
+                ([f"<p>{intro_text}</p>"] if intro_text else []) + [gallery_html]
+            )
+        else:
+            response_html = self.designer.render_gallery(intro_text, page)
+
+        self._record_turn(user_input, page, results.route, timer, cached, budget, session_id)
+        return {"reply": response_html, "intro": intro_text, **payload,
+                "degraded": bool(budget.degraded)}
+
+    async def handle_user_message_async(self, user_input: str) -> str:
+        return (await self.handle_chat_async(user_input))["reply"]
+
+    async def stream_user_message_async(self, user_input: str, page_size: int = PAGE_SIZE,
+                                        session_id: Optional[str] = None,
+                                        refine: Optional[bool] = None):
+        """Async generator cùng event với stream_user_message."""
+        budget = start_budget()
+        timer = StageTimer()
+        results, query, terms, top, page = await self._retrieve_async(
+            user_input, page_size, timer, session_id, refine
+        )
+        with timer.stage("render"):
+            payload = self._page_payload(query, results, 0, page_size, page, session_id, terms)
+        yield "gallery", payload
+
+        ids = results.ids
+        with timer.stage("summarize"):
+            if results.route in REFINE_ROUTES:
+                intro_text, version, query_vec = self._refine_intro(top), None, None
+            else:
+                intro_text, version, query_vec = await asyncio.to_thread(
+                    self._cached_intro, query, ids
+                )
+            cached = intro_text is not None and results.route not in REFINE_ROUTES
+            if intro_text is not None:
+                yield "intro", intro_text
+            else:
+                parts = []
+                try:
+                    async for delta in self.summarizer.summarize_stream_async(query, top):
+                        parts.append(delta)
+                        yield "intro", delta
+                except Exception as e:
+                    if not parts:
+                        yield "intro", self._degraded_intro(top, e)
+                    parts = None
+                if top and parts:
+                    self.reply_cache.put(query, ids, "".join(parts), version, query_vec)
+
+        self._record_turn(user_input, page, results.route, timer, cached, budget, session_id)
+        yield "done", None
+
+    def stream_user_message(self, user_input: str, page_size: int = PAGE_SIZE,
+                            session_id: Optional[str] = None, refine: Optional[bool] = None):
+        """
+        Như handle_chat nhưng trả từng event:
+        - ("gallery", {"products", "total", "next_cursor"}) ngay khi Retriever xong,
+        - ("intro", text) nhiều lần theo token stream của Summarizer,
+        - ("done", None).
+        """
+        budget = start_budget()
+        timer = StageTimer()
+        with timer.stage("retrieve"):
+            results, query, terms = self._retrieve(user_input, session_id, refine)
+            top = results.page(0, max(page_size, SUMMARY_ITEMS))
+            page = top[:page_size]
+        with timer.stage("render"):
+            payload = self._page_payload(query, results, 0, page_size, page, session_id, terms)
+        yield "gallery", payload
+
+        ids = results.ids
+        with timer.stage("summarize"):
+            if results.route in REFINE_ROUTES:
+                intro_text, version, query_vec = self._refine_intro(top), None, None
+            else:
+                intro_text, version, query_vec = self._cached_intro(query, ids)
+            cached = intro_text is not None and results.route not in REFINE_ROUTES
+            if intro_text is not None:
+                yield "intro", intro_text
+            else:
+                parts = []
+                try:
+                    for delta in self.summarizer.summarize_stream(query, top):
+                        parts.append(delta)
+                        yield "intro", delta
+                except Exception as e:
+                    if not parts:
+                        yield "intro", self._degraded_intro(top, e)
+                    parts = None
+                if top and parts:
+                    self.reply_cache.put(query, ids, "".join(parts), version, query_vec)
+
+        self._record_turn(user_input, page, results.route, timer, cached, budget, session_id)
+        yield "done", None
+
+
+# =========================
+# 9. MAIN CHATBOT LOOP (CLI)
+# =========================
+
+def chatbot_cli():
+    # Preload topic index + keyword index để tránh đọc file ở request đầu tiên
+    load_vector_index()
+    if USE_KEYWORD_INDEX:
+        load_keyword_index()
+
+    director = DirectorAgent()
+
+    print("🤖 Chatbot (multi-agent) đã sẵn sàng! Gõ 'exit' để thoát.\n")
+    while True:
+        user_input = input("Bạn: ")
+        if user_input.lower().strip() == "exit":
+            print("👋 Chatbot kết thúc.")
+            break
+
+        try:
+            reply = director.handle_user_message(user_input)
+        except Exception as e:
+            print("❌ Lỗi trong quá trình xử lý:", e)
+            reply = "Xin lỗi, hiện tại mình đang gặp chút trục trặc hệ thống, bạn thử lại sau nhé."
+
+        print("Chatbot (HTML):")
+        print(reply)
+        print("-" * 40)
+
+
+if __name__ == "__main__":
+    chatbot_cli()
@@ -1,5 +1,13 @@
-from flask import Flask, request, render_template, jsonify
-from Chatbot import DirectorAgent
+import json
+import os
+import time
+
+from flask import Flask, Response, g, request, render_template, jsonify, stream_with_context
+from Chatbot import (
+    CATALOG, MAX_PAGE_SIZE, OPENAI_SCHEDULER, PAGE_SIZE, SESSION_COOKIE, DirectorAgent,
+    USE_KEYWORD_INDEX, clear_budget, load_keyword_index, session_id_from,
+)
+import metrics
 
 
 app = Flask(
@@ -10,6 +18,55 @@ app = Flask(
 )
 
 director = DirectorAgent()
+# Build the keyword index at startup instead of on the first /chat.
+if USE_KEYWORD_INDEX:
+    load_keyword_index()
+# Reload catalogue khi file trong CHATBOT_DATA_DIR đổi (CHATBOT_CATALOG_WATCH_S > 0).
+CATALOG.start_watcher()
+
+# POST /admin/reload cần header X-Admin-Token bằng giá trị này (trống = tắt route).
+ADMIN_TOKEN = os.getenv("CHATBOT_ADMIN_TOKEN", "")
+
+# Thêm header Server-Timing (ms từng stage) vào mỗi response.
+TIMING_HEADER = os.getenv("CHATBOT_TIMING_HEADER", "0") == "1"
+
+
+@app.before_request
+def start_timing():
+    g.request_start = time.perf_counter()
+    g.timings = metrics.start_request()
+    # Session của khách (cookie): log theo session + refine kết quả lượt trước.
+    g.session_id = session_id_from(request.cookies.get(SESSION_COOKIE))
+
+
+@app.after_request
+def finish_timing(response):
+    start = g.get("request_start")
+    if start is not None and request.endpoint != "metrics_endpoint":
+        metrics.HTTP_SECONDS.observe(
+            time.perf_counter() - start,
+            endpoint=request.endpoint or "unknown",
+            status=str(response.status_code),
+        )
+    if TIMING_HEADER and g.get("timings"):
+        response.headers["Server-Timing"] = metrics.server_timing_header(g.timings)
+    session_id = g.get("session_id")
+    if session_id and request.cookies.get(SESSION_COOKIE) != session_id:
+        response.set_cookie(SESSION_COOKIE, session_id, httponly=True, samesite="Lax")
+    return response
+
+
+@app.teardown_request
+def end_budget(exc=None):
+    # Budget đặt trong handler ở trên ContextVar của thread; waitress dùng lại
+    # thread nên phải gỡ, kể cả khi stream kết thúc (stream_with_context).
+    clear_budget()
+
+
+def refine_flag(data: dict):
+    """"refine": true/false ép lượt này lọc / không lọc kết quả trước; thiếu = tự đoán."""
+    refine = data.get("refine")
+    return refine if isinstance(refine, bool) else None
 
 
 @app.route("/", methods=["GET"])
@@ -21,8 +78,93 @@ def index():
 def chat():
     data = request.get_json() or {}
     user_input = data.get("message", "")
-    reply = director.handle_user_message(user_input)
-    return jsonify({"reply": reply})
+    return jsonify(director.handle_chat(
+        user_input, session_id=g.session_id, refine=refine_flag(data)
+    ))
+
+
+@app.route("/chat/batch", methods=["POST"])
+def chat_batch():
+    """
+    {"queries": [...], "summarize": "none|template|llm", "page_size": 12,
+    "html": false} -> {"results": [payload như /chat + "query", "route"]}.
+    page_size bị kẹp vào [1, MAX_PAGE_SIZE] (cursor trả về luôn dùng được).
+    """
+    data = request.get_json() or {}
+    queries = data.get("queries")
+    if not isinstance(queries, list) or not all(isinstance(q, str) for q in queries):
+        return jsonify({"error": "queries must be a list of strings"}), 400
+    if OPENAI_SCHEDULER.saturated():
+        # Hàng đợi OpenAI đã đầy: nhường chỗ cho /chat, báo client thử lại sau.
+        return jsonify({"error": "overloaded"}), 503, {"Retry-After": "5"}
+    try:
+        page_size = int(data.get("page_size", PAGE_SIZE))
+        results = director.handle_batch(
+            queries,
+            page_size=min(max(1, page_size), MAX_PAGE_SIZE),
+            summarize=data.get("summarize", "template"),
+            html=bool(data.get("html", False)),
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"results": results})
+
+
+@app.route("/results/<cursor>", methods=["GET"])
+def results(cursor):
+    """Trang kết quả tiếp theo (JSON record) theo cursor trả về từ /chat."""
+    try:
+        return jsonify(director.results_page(cursor))
+    except ValueError:
+        return jsonify({"error": "invalid cursor"}), 400
+
+
+@app.route("/chat/stream", methods=["POST"])
+def chat_stream():
+    """
+    NDJSON stream: {"type": "gallery", "products", "total", "next_cursor"} as
+    soon as retrieval is done, then {"type": "intro", "text"} deltas, then
+    {"type": "done"}.
+    """
+    data = request.get_json() or {}
+    user_input = data.get("message", "")
+    session_id, refine = g.session_id, refine_flag(data)
+
+    def generate():
+        try:
+            for kind, payload in director.stream_user_message(
+                user_input, session_id=session_id, refine=refine
+            ):
+                event = {"type": kind}
+                if kind == "gallery":
+                    event.update(payload)
+                elif kind == "intro":
+                    event["text"] = payload
+                yield json.dumps(event, ensure_ascii=False) + "\n"
+        except Exception as e:
+            print("❌ Lỗi stream:", e)
+            yield json.dumps({"type": "error"}) + "\n"
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/admin/reload", methods=["POST"])
+def admin_reload():
+    """Dựng lại index từ file catalogue hiện tại rồi swap (request khác không bị chặn)."""
+    if not ADMIN_TOKEN or request.headers.get("X-Admin-Token") != ADMIN_TOKEN:
+        return jsonify({"error": "forbidden"}), 403
+    force = request.args.get("force") == "1"
+    reloaded = CATALOG.reload(force=force)
+    return jsonify({"reloaded": reloaded, "version": CATALOG.current.version})
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return Response(metrics.expose(), mimetype=metrics.CONTENT_TYPE)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,213 @@
+"""
+Asyncio serving mode: /chat and /chat/stream run on the event loop with the
+async OpenAI client, so an in-flight chat costs a coroutine instead of a
+thread. Every other route (index page, static files...) is delegated to the
+Flask app in a worker thread.
+
+    python asgi.py            # uvicorn, port 8000
+    uvicorn asgi:app --port 8000
+"""
+import asyncio
+import io
+import json
+import os
+import sys
+import time
+from http.cookies import CookieError, SimpleCookie
+
+from app import TIMING_HEADER, app as flask_app, director, refine_flag
+from Chatbot import SESSION_COOKIE, session_id_from
+import metrics
+
+# Số chat xử lý đồng thời tối đa trong 1 process; request vượt ngưỡng sẽ chờ.
+ASYNC_CONCURRENCY = int(os.getenv("CHATBOT_ASYNC_CONCURRENCY", "256"))
+
+_chat_slots = None
+
+
+def chat_slots() -> asyncio.Semaphore:
+    global _chat_slots
+    if _chat_slots is None:
+        _chat_slots = asyncio.Semaphore(ASYNC_CONCURRENCY)
+    return _chat_slots
+
+
+async def read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def send_json(send, payload, status: int = 200, timings: dict = None, extra_headers=()):
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    headers = [
+        (b"content-type", b"application/json"),
+        (b"content-length", str(len(body)).encode()),
+        *extra_headers,
+    ]
+    if TIMING_HEADER and timings:
+        headers.append((b"server-timing", metrics.server_timing_header(timings).encode()))
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": headers,
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+def parse_message(body: bytes):
+    """(message, refine) từ JSON body (như /chat của app.py)."""
+    try:
+        data = json.loads(body or b"{}")
+    except ValueError:
+        data = {}
+    if not isinstance(data, dict):
+        return "", None
+    return data.get("message", ""), refine_flag(data)
+
+
+def session_from_scope(scope):
+    """(session id, header Set-Cookie cần gửi) từ cookie SESSION_COOKIE của request."""
+    cookie = SimpleCookie()
+    for name, value in scope.get("headers", []):
+        if name == b"cookie":
+            try:
+                cookie.load(value.decode("latin-1"))
+            except CookieError:
+                pass
+    current = cookie[SESSION_COOKIE].value if SESSION_COOKIE in cookie else None
+    session_id = session_id_from(current)
+    if session_id == current:
+        return session_id, []
+    header = f"{SESSION_COOKIE}={session_id}; Path=/; HttpOnly; SameSite=Lax"
+    return session_id, [(b"set-cookie", header.encode("latin-1"))]
+
+
+async def chat(scope, receive, send):
+    user_input, refine = parse_message(await read_body(receive))
+    session_id, cookie_headers = session_from_scope(scope)
+    timings = metrics.start_request()
+    start = time.perf_counter()
+    async with chat_slots():
+        payload = await director.handle_chat_async(
+            user_input, session_id=session_id, refine=refine
+        )
+    metrics.HTTP_SECONDS.observe(time.perf_counter() - start, endpoint="chat", status="200")
+    await send_json(send, payload, timings=timings, extra_headers=cookie_headers)
+
+
+async def chat_stream(scope, receive, send):
+    user_input, refine = parse_message(await read_body(receive))
+    session_id, cookie_headers = session_from_scope(scope)
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [
+            (b"content-type", b"application/x-ndjson"),
+            (b"cache-control", b"no-cache"),
+            (b"x-accel-buffering", b"no"),
+            *cookie_headers,
+        ],
+    })
+    async with chat_slots():
+        try:
+            async for kind, payload in director.stream_user_message_async(
+                user_input, session_id=session_id, refine=refine
+            ):
+                event = {"type": kind}
+                if kind == "gallery":
+                    event.update(payload)
+                elif kind == "intro":
+                    event["text"] = payload
+                line = json.dumps(event, ensure_ascii=False) + "\n"
+                await send({
+                    "type": "http.response.body",
+                    "body": line.encode("utf-8"),
+                    "more_body": True,
+                })
+        except Exception as e:
+            print("❌ Lỗi stream:", e)
+            await send({
+                "type": "http.response.body",
+                "body": b'{"type": "error"}\n',
+                "more_body": True,
+            })
+    await send({"type": "http.response.body", "body": b""})
+
+
+def call_wsgi(scope, body: bytes):
+    """Run the Flask app for one request; returns (status, headers, body)."""
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": (scope.get("server") or ("localhost", 80))[0],
+        "SERVER_PORT": str((scope.get("server") or ("localhost", 80))[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+        "CONTENT_LENGTH": str(len(body)),
+    }
+    for name, value in scope.get("headers", []):
+        key = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if key == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+        elif key != "CONTENT_LENGTH":
+            environ[f"HTTP_{key}"] = value
+
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started["status"] = int(status.split(" ", 1)[0])
+        started["headers"] = headers
+
+    result = flask_app(environ, start_response)
+    try:
+        payload = b"".join(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    headers = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in started["headers"]]
+    return started["status"], headers, payload
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    if scope["type"] != "http":
+        return
+
+    if scope["method"] == "POST" and scope["path"] == "/chat":
+        return await chat(scope, receive, send)
+    if scope["method"] == "POST" and scope["path"] == "/chat/stream":
+        return await chat_stream(scope, receive, send)
+
+    body = await read_body(receive)
+    status, headers, payload = await asyncio.to_thread(call_wsgi, scope, body)
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": payload})
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    print("Server (asyncio) đang chạy tại http://127.0.0.1:8000/")
+    uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,335 @@
+"""
+Offline benchmark: replay user queries from the chat logs through the chatbot
+with a local OpenAI stand-in (fixed latency, deterministic embeddings and
+completions), then report p50/p95/p99 and throughput per stage.
+
+    python benchmark.py                               # director, concurrency 1
+    python benchmark.py --target both --concurrency 8 --chat-latency-ms 400
+    python benchmark.py --out bench/baseline.json
+    python benchmark.py --compare bench/baseline.json [--fail-on-regression]
+
+Log and cache files go to a temporary directory, so the repo's logs/ and
+cache/ are not touched. No network is used.
+"""
+import argparse
+import contextlib
+import glob
+import hashlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from types import SimpleNamespace
+
+import numpy as np
+
+from vocab_index import read_query_log
+
+REPO_ROOT = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_LOGS = [os.path.join(REPO_ROOT, "logs", "*.csv"), os.path.join(REPO_ROOT, "logs", "*.jsonl")]
+PERCENTILES = (50, 95, 99)
+
+# route của Retriever -> tên stage trong báo cáo
+RETRIEVE_STAGES = {
+    "keyword": "keyword_search",
+    "semantic": "semantic_search",
+    "none": "search_no_result",
+}
+
+
+# =========================
+# QUERIES
+# =========================
+
+def load_queries(patterns) -> list:
+    """Câu hỏi của user trong logs/*.csv (cột "Người dùng") và logs/*.jsonl ("query")."""
+    return read_query_log(path for pattern in patterns for path in sorted(glob.glob(pattern)))
+
+
+# =========================
+# FAKE OPENAI
+# =========================
+
+class FakeOpenAI:
+    """Đủ API cho Chatbot: chat.completions.create (có stream) + embeddings.create."""
+
+    def __init__(self, chat_latency_ms: float, embed_latency_ms: float, embed_dim: int):
+        self.chat_latency = chat_latency_ms / 1000
+        self.embed_latency = embed_latency_ms / 1000
+        self.embed_dim = embed_dim
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._chat))
+        self.embeddings = SimpleNamespace(create=self._embed)
+
+    def with_options(self, **kwargs):
+        return self
+
+    @staticmethod
+    def _reply(messages) -> str:
+        seed = hashlib.sha1(messages[-1]["content"].encode("utf-8")).hexdigest()[:8]
+        return f"Bộ sưu tập tranh phù hợp với yêu cầu của bạn (mã {seed})."
+
+    def _chat(self, model, messages, stream=False, **kwargs):
+        time.sleep(self.chat_latency)
+        text = self._reply(messages)
+        usage = SimpleNamespace(prompt_tokens=sum(len(m["content"]) // 4 for m in messages),
+                                completion_tokens=len(text) // 4)
+        if stream:
+            words = text.split(" ")
+            chunks = [
+                SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=w + " "))],
+                                usage=None)
+                for w in words
+            ]
+            return iter(chunks + [SimpleNamespace(choices=[], usage=usage)])
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=text))], usage=usage
+        )
+
+    def _embed(self, model, input):
+        time.sleep(self.embed_latency)
+        data = []
+        for i, text in enumerate(input):
+            seed = int.from_bytes(hashlib.sha1(text.encode("utf-8")).digest()[:8], "little")
+            vec = np.random.default_rng(seed).standard_normal(self.embed_dim).astype("float32")
+            data.append(SimpleNamespace(index=i, embedding=vec.tolist()))
+        usage = SimpleNamespace(prompt_tokens=sum(len(t) // 4 for t in input), completion_tokens=0)
+        return SimpleNamespace(data=data, usage=usage)
+
+
+# =========================
+# RECORDING
+# =========================
+
+class RecordingLogger:
+    """Bọc LogAgent: giữ timings + route của từng lượt chat, đo luôn bước log."""
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.samples = []
+        self._lock = threading.Lock()
+
+    def log_chat(self, user_input, product_ids=None, route=None, timings=None, **kwargs):
+        start = time.perf_counter()
+        self.inner.log_chat(user_input, product_ids, route, timings, **kwargs)
+        log_ms = (time.perf_counter() - start) * 1000
+        sample = {"route": route, "cached": kwargs.get("cached", False),
+                  "timings": dict(timings or {}), "log": log_ms}
+        with self._lock:
+            self.samples.append(sample)
+
+    def flush(self):
+        self.inner.flush()
+
+
+def summarize_ms(values) -> dict:
+    arr = np.asarray(values, dtype="float64")
+    out = {"count": int(arr.size)}
+    if arr.size:
+        out["mean"] = round(float(arr.mean()), 3)
+        for p in PERCENTILES:
+            out[f"p{p}"] = round(float(np.percentile(arr, p)), 3)
+    return out
+
+
+def stage_report(samples, totals, wall_s: float) -> dict:
+    stages = {}
+    for sample in samples:
+        timings = sample["timings"]
+        retrieve = timings.get("retrieve")
+        if retrieve is not None:
+            name = RETRIEVE_STAGES.get(sample["route"], f"{sample['route']}_search")
+            stages.setdefault(name, []).append(retrieve)
+        for name in ("summarize", "render"):
+            if name in timings:
+                stages.setdefault(name, []).append(timings[name])
+        stages.setdefault("log", []).append(sample["log"])
+    stages["total"] = totals
+
+    report = {
+        "requests": len(totals),
+        "wall_s": round(wall_s, 3),
+        "throughput_rps": round(len(totals) / wall_s, 2) if wall_s else 0.0,
+        "routes": {},
+        "stages": {},
+    }
+    for sample in samples:
+        report["routes"][sample["route"]] = report["routes"].get(sample["route"], 0) + 1
+    for name, values in sorted(stages.items()):
+        stats = summarize_ms(values)
+        # throughput của stage = số lần chạy / tổng thời gian chạy stage (1 worker)
+        busy_s = sum(values) / 1000
+        stats["throughput_per_worker"] = round(len(values) / busy_s, 2) if busy_s else None
+        report["stages"][name] = stats
+    return report
+
+
+# =========================
+# RUN
+# =========================
+
+def run_target(call, queries, concurrency: int, recorder: RecordingLogger) -> dict:
+    recorder.samples.clear()
+    totals = []
+    lock = threading.Lock()
+
+    def one(query):
+        start = time.perf_counter()
+        call(query)
+        elapsed = (time.perf_counter() - start) * 1000
+        with lock:
+            totals.append(elapsed)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, queries))
+    wall_s = time.perf_counter() - start
+    recorder.flush()
+    return stage_report(list(recorder.samples), totals, wall_s)
+
+
+def print_report(name: str, report: dict):
+    print(f"\n== {name}: {report['requests']} requests in {report['wall_s']}s "
+          f"({report['throughput_rps']} req/s), routes {report['routes']}")
+    print(f"{'stage':<20}{'count':>7}{'p50':>10}{'p95':>10}{'p99':>10}{'mean':>10}  (ms)")
+    for stage, s in report["stages"].items():
+        if not s["count"]:
+            continue
+        print(f"{stage:<20}{s['count']:>7}{s['p50']:>10.2f}{s['p95']:>10.2f}"
+              f"{s['p99']:>10.2f}{s['mean']:>10.2f}")
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> list:
+    """In chênh lệch p50/p95/throughput so với baseline; trả danh sách regression."""
+    regressions = []
+    for target, cur in current["targets"].items():
+        base = baseline.get("targets", {}).get(target)
+        if base is None:
+            continue
+        print(f"\n== compare {target} (baseline {baseline['meta'].get('timestamp')})")
+        b_rps, c_rps = base["throughput_rps"], cur["throughput_rps"]
+        if b_rps:
+            change = (c_rps - b_rps) / b_rps
+            flag = "  REGRESSION" if change < -threshold else ""
+            print(f"throughput {b_rps} -> {c_rps} req/s ({change:+.1%}){flag}")
+            if flag:
+                regressions.append(f"{target} throughput")
+        for stage, c in cur["stages"].items():
+            b = base["stages"].get(stage)
+            if not b or not b.get("count") or not c.get("count"):
+                continue
+            parts = []
+            for key in ("p50", "p95"):
+                change = (c[key] - b[key]) / b[key] if b[key] else 0.0
+                flag = "!" if change > threshold else ""
+                if flag:
+                    regressions.append(f"{target} {stage} {key}")
+                parts.append(f"{key} {b[key]:.2f} -> {c[key]:.2f} ({change:+.1%}){flag}")
+            print(f"{stage:<20}" + "   ".join(parts))
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Replay logged queries against a fake OpenAI.")
+    parser.add_argument("--logs", nargs="*", default=DEFAULT_LOGS, help="glob(s) of chat logs")
+    parser.add_argument("--target", choices=["director", "flask", "both"], default="director")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--limit", type=int, default=0, help="max queries per run (0 = all)")
+    parser.add_argument("--repeat", type=int, default=1, help="replay the query list N times")
+    parser.add_argument("--warmup", type=int, default=5, help="untimed queries before each run")
+    parser.add_argument("--chat-latency-ms", type=float, default=0.0)
+    parser.add_argument("--embed-latency-ms", type=float, default=0.0)
+    parser.add_argument("--out", help="write results as a JSON baseline")
+    parser.add_argument("--compare", help="baseline JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="relative change counted as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    parser.add_argument("--verbose", action="store_true", help="keep per-request prints")
+    args = parser.parse_args(argv)
+
+    queries = load_queries(args.logs)
+    if args.limit:
+        queries = queries[:args.limit]
+    queries = queries * args.repeat
+    if not queries:
+        print("Không tìm thấy câu hỏi nào trong log.")
+        return 1
+
+    # Log + cache của benchmark nằm trong thư mục tạm (set trước khi import Chatbot)
+    workdir = tempfile.mkdtemp(prefix="chatbot-bench-")
+    os.environ["CHATBOT_LOG_DIR"] = os.path.join(workdir, "logs")
+    os.environ["CHATBOT_CACHE_DIR"] = os.path.join(workdir, "cache")
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+    import Chatbot
+
+    index = Chatbot.load_vector_index()
+    embed_dim = index.dim if index is not None else 1536
+    Chatbot.client = FakeOpenAI(args.chat_latency_ms, args.embed_latency_ms, embed_dim)
+    Chatbot.load_keyword_index()
+
+    targets = {}
+    if args.target in ("director", "both"):
+        director = Chatbot.DirectorAgent()
+        director.logger = RecordingLogger(director.logger)
+        targets["director"] = (director.handle_user_message, director.logger)
+    if args.target in ("flask", "both"):
+        import app as flask_module
+
+        flask_module.director.logger = RecordingLogger(flask_module.director.logger)
+        local = threading.local()
+
+        def post_chat(query):
+            if not hasattr(local, "client"):
+                local.client = flask_module.app.test_client()
+            resp = local.client.post("/chat", json={"message": query})
+            if resp.status_code != 200:
+                raise RuntimeError(f"/chat -> {resp.status_code}")
+
+        targets["flask"] = (post_chat, flask_module.director.logger)
+
+    result = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "queries": len(queries),
+            "concurrency": args.concurrency,
+            "chat_latency_ms": args.chat_latency_ms,
+            "embed_latency_ms": args.embed_latency_ms,
+            "retrieval_mode": Chatbot.RETRIEVAL_MODE,
+        },
+        "targets": {},
+    }
+    for name, (call, recorder) in targets.items():
+        # print của Retriever mỗi request làm nhiễu đo đạc -> tắt trừ khi --verbose
+        with contextlib.redirect_stdout(sys.stdout if args.verbose else io.StringIO()):
+            for query in queries[:args.warmup]:
+                call(query)
+            report = run_target(call, queries, args.concurrency, recorder)
+        result["targets"][name] = report
+        print_report(name, report)
+
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"\n✅ Baseline: {args.out}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, result, args.threshold)
+        if regressions:
+            print(f"\n⚠️  {len(regressions)} regression(s): {', '.join(regressions)}")
+            if args.fail_on_regression:
+                return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
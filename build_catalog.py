@@ -0,0 +1,453 @@
+"""
+Offline build commands for the chatbot data directory (CHATBOT_DATA_DIR).
+
+    python build_catalog.py search-index            # build if missing/stale
+    python build_catalog.py search-index --rebuild  # force rebuild
+    python build_catalog.py topic-matrix [--dtype float16]
+    python build_catalog.py vectors [--source db|meta] [--backend openai|local]
+    python build_catalog.py vector-index --kind flat|ivf|hnsw
+    python build_catalog.py meta-store [--src meta.pkl]
+"""
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import sys
+
+import numpy as np
+
+import meta_store
+import vector_index
+from Chatbot import (
+    EMBEDDING_BACKENDS,
+    EMBED_BACKEND,
+    FOLD_VERSION,
+    SEARCH_COLUMNS,
+    SEARCH_FTS_TABLE,
+    SEARCH_META_TABLE,
+    SEARCH_TABLE,
+    SQLITE_PATH,
+    TOPIC_MANIFEST_PATH,
+    TOPIC_META_PATH,
+    TOPIC_META_STORE_PATH,
+    TOPIC_VECTORS_NORM_PATH,
+    TOPIC_VECTORS_PATH,
+    fold_text,
+    get_embedding_backend,
+    has_search_tables,
+    load_topic_matrix,
+    normalize_rows,
+    text_hash,
+)
+
+
+# =========================
+# SEARCH INDEX (FTS5)
+# =========================
+
+def catalog_fingerprint(conn) -> str:
+    """Cheap signature of the searchable columns, used to detect stale tables."""
+    length_sum = " + ".join(f"coalesce(length({col}), 0)" for col in SEARCH_COLUMNS)
+    count, max_id, total = conn.execute(
+        f"SELECT count(*), coalesce(max(id), 0), coalesce(sum({length_sum}), 0) "
+        "FROM paintings;"
+    ).fetchone()
+    return f"{count}:{max_id}:{total}"
+
+
+def search_index_fingerprint(conn) -> str:
+    if not has_search_tables(conn):
+        return ""
+    try:
+        row = conn.execute(
+            f"SELECT value FROM {SEARCH_META_TABLE} WHERE key = 'fingerprint';"
+        ).fetchone()
+    except sqlite3.OperationalError:
+        return ""
+    return row[0] if row else ""
+
+
+def build_search_index(db_path: str = SQLITE_PATH, rebuild: bool = False) -> bool:
+    """
+    Write the accent-folded shadow table + FTS5 trigram index into paintings.db.
+    Returns False when the existing tables are already up to date.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        fingerprint = catalog_fingerprint(conn)
+        if not rebuild and search_index_fingerprint(conn) == fingerprint:
+            return False
+
+        cols = ", ".join(SEARCH_COLUMNS)
+        rows = conn.execute(f"SELECT id, {cols} FROM paintings ORDER BY id;").fetchall()
+        folded = [(r[0], *(fold_text(v) for v in r[1:])) for r in rows]
+
+        with conn:
+            conn.execute(f"DROP TABLE IF EXISTS {SEARCH_FTS_TABLE};")
+            conn.execute(f"DROP TABLE IF EXISTS {SEARCH_TABLE};")
+            conn.execute(f"DROP TABLE IF EXISTS {SEARCH_META_TABLE};")
+            conn.execute(
+                f"CREATE TABLE {SEARCH_TABLE} (id INTEGER PRIMARY KEY, "
+                + ", ".join(f"{col} TEXT" for col in SEARCH_COLUMNS)
+                + ");"
+            )
+            conn.execute(
+                f"CREATE VIRTUAL TABLE {SEARCH_FTS_TABLE} USING fts5("
+                f"{cols}, content='{SEARCH_TABLE}', content_rowid='id', "
+                "tokenize='trigram');"
+            )
+            placeholders = ", ".join("?" for _ in range(len(SEARCH_COLUMNS) + 1))
+            conn.executemany(
+                f"INSERT INTO {SEARCH_TABLE} (id, {cols}) VALUES ({placeholders});",
+                folded,
+            )
+            conn.execute(
+                f"INSERT INTO {SEARCH_FTS_TABLE}({SEARCH_FTS_TABLE}) VALUES ('rebuild');"
+            )
+            conn.execute(
+                f"CREATE TABLE {SEARCH_META_TABLE} (key TEXT PRIMARY KEY, value TEXT);"
+            )
+            conn.executemany(
+                f"INSERT INTO {SEARCH_META_TABLE} VALUES (?, ?);",
+                [("fingerprint", fingerprint), ("fold", FOLD_VERSION)],
+            )
+        conn.execute("PRAGMA optimize;")
+    finally:
+        conn.close()
+    return True
+
+
+def cmd_search_index(args) -> int:
+    try:
+        built = build_search_index(args.db, rebuild=args.rebuild)
+    except sqlite3.OperationalError as e:
+        print(f"❌ Không build được search index: {e}", file=sys.stderr)
+        return 1
+    if built:
+        print(f"✅ Đã build {SEARCH_TABLE} + {SEARCH_FTS_TABLE} trong {args.db}")
+    else:
+        print(f"Search index trong {args.db} đã cập nhật, bỏ qua (dùng --rebuild để build lại).")
+    return 0
+
+
+# =========================
+# TOPIC MATRIX
+# =========================
+
+def build_topic_matrix(
+    src: str = TOPIC_VECTORS_PATH,
+    dst: str = TOPIC_VECTORS_NORM_PATH,
+    dtype: str = "float32",
+):
+    """Write the row-normalized topic matrix that workers memory-map at startup."""
+    normed = normalize_rows(np.load(src, mmap_mode="r"), dtype=dtype)
+    tmp = dst + ".tmp.npy"
+    np.save(tmp, normed)
+    os.replace(tmp, dst)  # atomic: running workers keep their old mapping
+    return normed.shape
+
+
+def cmd_topic_matrix(args) -> int:
+    if not os.path.exists(args.src):
+        print(f"❌ Không tìm thấy {args.src}", file=sys.stderr)
+        return 1
+    rows, dim = build_topic_matrix(args.src, args.dst, dtype=args.dtype)
+    print(f"✅ Đã ghi {args.dst} ({rows}x{dim}, {args.dtype})")
+    return 0
+
+
+# =========================
+# VECTORS (BATCH EMBEDDING)
+# =========================
+
+META_COLUMNS = (
+    "id", "file", "json_path", "title", "image", "general_info",
+    "keywords", "themes", "emotions", "description_short", "embedding_text",
+)
+LIST_COLUMNS = ("keywords", "themes", "emotions")
+
+
+def read_catalog_texts(
+    source: str,
+    db_path: str = SQLITE_PATH,
+    meta_path: str = TOPIC_META_PATH,
+    store_path: str = TOPIC_META_STORE_PATH,
+):
+    """
+    Return [(id, text)] in index row order. Rows follow the meta store or
+    meta.pkl (which load_topic_index pairs with vectors.npy); texts come from
+    `source`. When neither exists yet the meta store is written from paintings.db.
+    """
+    meta = meta_store.load_meta(store_path, meta_path)
+    db_texts = {}
+    if source == "db" or meta is None:
+        conn = sqlite3.connect(db_path)
+        conn.row_factory = sqlite3.Row
+        try:
+            db_rows = conn.execute(
+                f"SELECT {', '.join(META_COLUMNS)} FROM paintings ORDER BY id;"
+            ).fetchall()
+        finally:
+            conn.close()
+        db_texts = {r["id"]: r["embedding_text"] or r["title"] or "" for r in db_rows}
+
+    if meta is None:
+        items = []
+        for r in db_rows:
+            item = dict(r)
+            for col in LIST_COLUMNS:
+                item[col] = item[col].split(",") if item[col] else []
+            items.append(item)
+        meta_store.write_meta_store(items, store_path)
+        meta = meta_store.MetaStore(store_path)
+
+    rows = []
+    for i, item in enumerate(meta):
+        if source == "db" and item.get("id") in db_texts:
+            text = db_texts[item["id"]]
+        else:
+            text = meta.text(i, "embedding_text") or item.get("title") or ""
+        rows.append((item.get("id"), text))
+    return rows
+
+
+def load_manifest(path: str = TOPIC_MANIFEST_PATH) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_json_atomic(path: str, payload: dict):
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(payload, f)
+    os.replace(path + ".tmp", path)
+
+
+def build_vectors(
+    backend,
+    source: str = "db",
+    batch_size: int = 128,
+    vectors_path: str = TOPIC_VECTORS_PATH,
+    manifest_path: str = TOPIC_MANIFEST_PATH,
+    db_path: str = SQLITE_PATH,
+    meta_path: str = TOPIC_META_PATH,
+    log=print,
+) -> dict:
+    """
+    Embed catalogue texts in list batches into vectors.npy.
+
+    - Rows whose (model, text) hash matches the manifest reuse their old vector.
+    - Progress goes to `<vectors>.partial.npy` + `<vectors>.progress.json`
+      after every batch, so an interrupted build resumes where it stopped.
+    - The finished matrix replaces vectors.npy atomically.
+    """
+    rows = read_catalog_texts(source, db_path=db_path, meta_path=meta_path)
+    hashes = [text_hash(backend.name, text) for _, text in rows]
+
+    old_rows = {}
+    manifest = load_manifest(manifest_path)
+    if manifest.get("model") == backend.name and os.path.exists(vectors_path):
+        old_vectors = np.load(vectors_path, mmap_mode="r")
+        for i, entry in enumerate(manifest.get("rows", [])):
+            if i < len(old_vectors):
+                old_rows[(entry["id"], entry["hash"])] = i
+    else:
+        old_vectors = None
+
+    reuse = {}
+    todo = []
+    for i, ((pid, _), h) in enumerate(zip(rows, hashes)):
+        if (pid, h) in old_rows:
+            reuse[i] = old_rows[(pid, h)]
+        else:
+            todo.append(i)
+
+    stats = {"rows": len(rows), "reused": len(reuse), "embedded": 0, "batches": 0}
+    if not todo and old_vectors is not None and len(old_vectors) == len(rows) and all(
+        reuse[i] == i for i in range(len(rows))
+    ):
+        log("Vectors đã cập nhật, không cần embed lại.")
+        return stats
+
+    partial_path = vectors_path[:-len(".npy")] + ".partial.npy"
+    progress_path = vectors_path[:-len(".npy")] + ".progress.json"
+    plan_digest = hashlib.sha1(
+        json.dumps([backend.name, hashes, todo]).encode("utf-8")
+    ).hexdigest()
+
+    progress = load_manifest(progress_path)
+    done = 0
+    out = None
+    if progress.get("plan") == plan_digest and os.path.exists(partial_path):
+        out = np.lib.format.open_memmap(partial_path, mode="r+")
+        done = progress.get("done", 0)
+        log(f"Tiếp tục build dở: {done}/{len(todo)} dòng đã embed.")
+
+    def open_output(dim):
+        mat = np.lib.format.open_memmap(
+            partial_path, mode="w+", dtype="float32", shape=(len(rows), dim)
+        )
+        for i, j in reuse.items():
+            mat[i] = old_vectors[j]
+        return mat
+
+    if out is None and not todo:
+        out = open_output(old_vectors.shape[1])
+
+    for start in range(done, len(todo), batch_size):
+        batch = todo[start:start + batch_size]
+        vecs = backend.embed([rows[i][1] for i in batch])
+        if out is None:
+            out = open_output(vecs.shape[1])
+        out[batch] = vecs
+        out.flush()
+        stats["embedded"] += len(batch)
+        stats["batches"] += 1
+        write_json_atomic(progress_path, {"plan": plan_digest, "done": start + len(batch)})
+        log(f"  embed {start + len(batch)}/{len(todo)}")
+
+    out.flush()
+    del out
+    os.replace(partial_path, vectors_path)
+    write_json_atomic(manifest_path, {
+        "model": backend.name,
+        "source": source,
+        "rows": [{"id": pid, "hash": h} for (pid, _), h in zip(rows, hashes)],
+    })
+    if os.path.exists(progress_path):
+        os.remove(progress_path)
+    return stats
+
+
+def cmd_vectors(args) -> int:
+    backend = get_embedding_backend(args.backend)
+    stats = build_vectors(backend, source=args.source, batch_size=args.batch_size)
+    print(
+        f"✅ {stats['rows']} dòng: dùng lại {stats['reused']}, "
+        f"embed {stats['embedded']} trong {stats['batches']} request ({backend.name})"
+    )
+    if os.path.exists(TOPIC_VECTORS_NORM_PATH):
+        # giữ bản chuẩn hoá mmap đồng bộ với vectors.npy mới
+        dtype = str(np.load(TOPIC_VECTORS_NORM_PATH, mmap_mode="r").dtype)
+        build_topic_matrix(dtype=dtype)
+    # ... và các FAISS index đã build trước đó (cùng tham số)
+    vectors_dir = os.path.dirname(TOPIC_VECTORS_PATH)
+    for kind in vector_index.INDEX_KINDS[1:]:
+        path = vector_index.index_path(vectors_dir, kind)
+        if os.path.exists(path) and vector_index.load_faiss() is not None:
+            params = load_manifest(path + ".json").get("params", {})
+            build_vector_index(kind, **params)
+    return 0
+
+
+# =========================
+# VECTOR INDEX (FAISS)
+# =========================
+
+def build_vector_index(kind: str, nlist: int = 0, nprobe: int = 16, m: int = 32,
+                       ef_search: int = 64, ef_construction: int = 80) -> str:
+    """Build FAISS index từ ma trận đã chuẩn hoá, ghi cạnh vectors.npy."""
+    matrix = load_topic_matrix()
+    index = vector_index.VectorIndex.build(
+        matrix, kind, nlist=nlist, nprobe=nprobe, hnsw_m=m,
+        ef_construction=ef_construction, ef_search=ef_search,
+    )
+    path = vector_index.index_path(os.path.dirname(TOPIC_VECTORS_PATH), kind)
+    index.save(path, stamp=vector_index.source_stamp(TOPIC_VECTORS_PATH))
+    print(f"✅ {kind} index: {index.size} vector x {index.dim} chiều -> {path} {index.params}")
+    return path
+
+
+def cmd_vector_index(args) -> int:
+    if vector_index.load_faiss() is None:
+        print("❌ Cần faiss-cpu: pip install faiss-cpu")
+        return 1
+    if not os.path.exists(TOPIC_VECTORS_PATH):
+        print(f"❌ Không tìm thấy {TOPIC_VECTORS_PATH}")
+        return 1
+    build_vector_index(args.kind, nlist=args.nlist, nprobe=args.nprobe, m=args.m,
+                       ef_search=args.ef_search, ef_construction=args.ef_construction)
+    return 0
+
+
+# =========================
+# META STORE
+# =========================
+
+def dir_size(path: str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(path, name)) for name in os.listdir(path)
+    )
+
+
+def cmd_meta_store(args) -> int:
+    if not os.path.exists(args.src):
+        print(f"❌ Không thấy {args.src}")
+        return 1
+    with open(args.src, "rb") as f:
+        rows = pickle.load(f)
+    kinds = meta_store.write_meta_store(rows, args.dst)
+    store = meta_store.MetaStore(args.dst)
+    for i, row in enumerate(rows):  # kiểm tra round-trip trước khi dùng
+        texts = [k for k in meta_store.TEXT_FIELDS if k in row]
+        expected = {k: v for k, v in row.items() if k not in texts}
+        got = {k: v for k, v in store[i].items() if k in row}
+        if got != expected or any((store.text(i, k) or "") != (row[k] or "") for k in texts):
+            print(f"❌ Hàng {i} không khớp sau khi chuyển đổi")
+            return 1
+    print(
+        f"✅ {len(rows)} dòng, {len(kinds)} field -> {args.dst} "
+        f"({dir_size(args.dst) / 1e6:.2f} MB, pickle {os.path.getsize(args.src) / 1e6:.2f} MB)"
+    )
+    return 0
+
+
+# =========================
+# CLI
+# =========================
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Build offline data for the chatbot.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("search-index", help="accent-folded shadow table + FTS5 index")
+    p.add_argument("--db", default=SQLITE_PATH, help="path to paintings.db")
+    p.add_argument("--rebuild", action="store_true", help="rebuild even if up to date")
+    p.set_defaults(func=cmd_search_index)
+
+    p = sub.add_parser("topic-matrix", help="row-normalized, mmap-able topic vectors")
+    p.add_argument("--src", default=TOPIC_VECTORS_PATH)
+    p.add_argument("--dst", default=TOPIC_VECTORS_NORM_PATH)
+    p.add_argument("--dtype", choices=["float32", "float16"], default="float32")
+    p.set_defaults(func=cmd_topic_matrix)
+
+    p = sub.add_parser("vectors", help="batch-embed embedding_text into vectors.npy")
+    p.add_argument("--source", choices=["db", "meta"], default="db",
+                   help="read embedding_text from paintings.db or the meta store")
+    p.add_argument("--backend", choices=sorted(EMBEDDING_BACKENDS), default=EMBED_BACKEND)
+    p.add_argument("--batch-size", type=int, default=128)
+    p.set_defaults(func=cmd_vectors)
+
+    p = sub.add_parser("vector-index", help="FAISS index over vectors.npy")
+    p.add_argument("--kind", choices=vector_index.INDEX_KINDS[1:], default="hnsw")
+    p.add_argument("--nlist", type=int, default=0, help="IVF lists (0 = ~4*sqrt(rows))")
+    p.add_argument("--nprobe", type=int, default=16, help="IVF lists probed per query")
+    p.add_argument("--m", type=int, default=32, help="HNSW neighbours per node")
+    p.add_argument("--ef-construction", type=int, default=80)
+    p.add_argument("--ef-search", type=int, default=64)
+    p.set_defaults(func=cmd_vector_index)
+
+    p = sub.add_parser("meta-store", help="convert meta.pkl to the columnar meta store")
+    p.add_argument("--src", default=TOPIC_META_PATH)
+    p.add_argument("--dst", default=TOPIC_META_STORE_PATH)
+    p.set_defaults(func=cmd_meta_store)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,56 +1,45 @@
+"""
+Vector search service (POST /search {"query": ...}) dùng chung dữ liệu, model
+embedding và vector index với Chatbot.py (CHATBOT_DATA_DIR, CHATBOT_VECTOR_INDEX).
+"""
 from flask import Flask, request, jsonify
-import faiss
-import numpy as np
-import pickle
-import os
-import openai
 
-FAISS_INDEX_PATH = "F:/AI/Chatbot/Vecter_Data/faiss_index.bin"
-METADATA_PATH = "F:/AI/Chatbot/Vecter_Data/metadata.pkl"
+from Chatbot import current_catalog, embed_text, load_vector_index
 
-# Load FAISS index & metadata
-index = faiss.read_index(FAISS_INDEX_PATH)
-with open(METADATA_PATH, "rb") as f:
-    metadata = pickle.load(f)
+app = Flask(__name__)
 
-# Configure OpenAI API key from environment
-openai.api_key = os.environ.get("OPENAI_API_KEY")
-if not openai.api_key:
-    raise RuntimeError("Missing environment variable OPENAI_API_KEY")
+# Nạp index + metadata khi khởi động
+if load_vector_index() is None:
+    raise RuntimeError("Semantic index không dùng được (thiếu vectors.npy/meta.pkl hoặc sai model)")
 
-app = Flask(__name__)
 
 @app.route('/search', methods=['POST'])
 def search():
-    data = request.json
-    user_query = data["query"].strip()
-
-    # If query does not contain 'tranh', prepend to clarify intent
-    if "tranh" not in user_query.lower():
-        query = "Tim tranh: " + user_query
-    else:
-        query = user_query
-
-    # Convert query to embedding vector
-    response = openai.embeddings.create(
-        input=[query],
-        model="text-embedding-ada-002"
-    )
-    query_vector = np.array([response.data[0].embedding]).astype("float32")
+    data = request.json or {}
+    user_query = (data.get("query") or "").strip()
+    if not user_query:
+        return jsonify([])
+
+    catalog = current_catalog()  # index + meta của cùng 1 version catalogue
+    index = catalog.vector_index()
+    query_vector = embed_text(user_query)
 
     # Number of results to retrieve
-    k = min(10, len(metadata))
-    D, I = index.search(query_vector, k=k)
+    k = min(10, index.size)
+    scores, rows = index.search(query_vector, k)
 
-    # Return results with distance score
+    # Return results with cosine score (larger = more similar)
     results = []
-    for idx, dist in zip(I[0], D[0]):
-        if idx != -1:
-            item = metadata[idx].copy()
-            item["distance"] = float(dist)  # smaller distance = more similar
+    for row, score in zip(rows[0], scores[0]):
+        if row != -1:
+            item = dict(catalog.topic_meta[row])
+            item.pop("embedding_text", None)
+            item["score"] = float(score)
+            item["distance"] = 1.0 - float(score)  # smaller distance = more similar
             results.append(item)
 
     return jsonify(results)
 
+
 if __name__ == '__main__':
     app.run(host='127.0.0.1', port=5000)
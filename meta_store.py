@@ -0,0 +1,287 @@
+"""
+Metadata dạng cột cho các hàng của vectors.npy (thay meta.pkl).
+
+Thư mục store (mặc định central_data/vectors/meta/) gồm các file .npy mở bằng
+mmap, nên mọi worker dùng chung page cache và chỉ đọc trang thực sự truy cập:
+
+- `manifest.json`: số hàng + kiểu từng field.
+- `strings.npy` (uint8) + `string_offsets.npy`: bảng chuỗi đã intern (mỗi chuỗi
+  khác nhau lưu 1 lần); field chuỗi / danh sách chuỗi lưu id trong bảng này.
+- field số nguyên (`id`...): mảng int64; danh sách số (`suggest_ids`): CSR
+  `<field>.offsets.npy` + `<field>.npy`.
+- field văn bản lớn (`embedding_text`): blob + offsets riêng, không intern,
+  không có trong dict của hàng — đọc bằng `text(row, field)` khi cần.
+- field chuỗi suy ra được từ id (`file` = "{id}.json", `json_path`, `image`):
+  chỉ lưu mẫu trong manifest, không tốn byte nào cho từng hàng.
+
+Cột chỉ được mở (mmap) khi lần đầu cần đến; serving chỉ đọc `id` / `suggest_ids`.
+
+    python build_catalog.py meta-store     # chuyển meta.pkl -> meta/
+"""
+import json
+import os
+import pickle
+import shutil
+from typing import Optional
+
+import numpy as np
+
+FORMAT_VERSION = 2
+READ_FORMATS = (1, 2)  # format 1: chưa có field "derived"
+MANIFEST = "manifest.json"
+# Field lớn, retrieval không cần: không nằm trong dict của hàng.
+TEXT_FIELDS = ("embedding_text",)
+
+
+def _infer_kind(field: str, values) -> str:
+    if field in TEXT_FIELDS:
+        return "text"
+    for v in values:
+        if v is None:
+            continue
+        if isinstance(v, bool):
+            break
+        if isinstance(v, int):
+            return "int"
+        if isinstance(v, str):
+            return "str"
+        if isinstance(v, (list, tuple)):
+            items = [x for x in v if x is not None]
+            if items and all(isinstance(x, int) for x in items):
+                return "ids"
+            if all(isinstance(x, str) for x in items):
+                return "list" if items else None
+        break
+    else:
+        return None
+    raise ValueError(f"meta field '{field}' has an unsupported type")
+
+
+def _id_template(values, ids) -> Optional[str]:
+    """Mẫu chung ("cgi/{id}.jpg") nếu mọi giá trị = mẫu với {id} thay bằng id của hàng."""
+    template = None
+    for value, pid in zip(values, ids):
+        if value is None or pid is None or "{id}" in value:
+            return None
+        key = str(pid)
+        if value.count(key) != 1:
+            return None
+        candidate = value.replace(key, "{id}")
+        if template is None:
+            template = candidate
+        elif candidate != template:
+            return None
+    return template
+
+
+def _save(path: str, name: str, array):
+    np.save(os.path.join(path, name + ".npy"), np.ascontiguousarray(array))
+
+
+def write_meta_store(rows, path: str):
+    """Ghi list dict (như meta.pkl) thành store; ghi vào thư mục tạm rồi đổi tên."""
+    rows = list(rows)
+    fields = []
+    for row in rows:
+        for key in row:
+            if key not in fields:
+                fields.append(key)
+
+    kinds = {}
+    for field in fields:
+        values = [row.get(field) for row in rows]
+        kind = _infer_kind(field, values)
+        if kind is None:  # toàn None/rỗng: đoán theo tên
+            kind = "ids" if field == "suggest_ids" else "list"
+        kinds[field] = kind
+
+    templates = {}
+    if rows and kinds.get("id") == "int":
+        ids = [row.get("id") for row in rows]
+        for field, kind in kinds.items():
+            if kind == "str" and field != "id":
+                template = _id_template([row.get(field) for row in rows], ids)
+                if template is not None:
+                    kinds[field] = "derived"
+                    templates[field] = template
+
+    tmp = path + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    strings = {}
+
+    def intern(s):
+        if s is None:
+            return -1
+        sid = strings.get(s)
+        if sid is None:
+            sid = strings[s] = len(strings)
+        return sid
+
+    for field, kind in kinds.items():
+        values = [row.get(field) for row in rows]
+        if kind == "int":
+            _save(tmp, field, np.array([-1 if v is None else v for v in values], dtype=np.int64))
+        elif kind == "str":
+            _save(tmp, field, np.array([intern(v) for v in values], dtype=np.int32))
+        elif kind == "derived":
+            continue
+        elif kind in ("list", "ids"):
+            flat, offsets = [], [0]
+            for v in values:
+                items = list(v or [])
+                flat.extend(intern(x) for x in items) if kind == "list" else flat.extend(items)
+                offsets.append(len(flat))
+            _save(tmp, field, np.array(flat, dtype=np.int32 if kind == "list" else np.int64))
+            _save(tmp, field + ".offsets", np.array(offsets, dtype=np.int64))
+        else:  # text
+            blobs = [(v or "").encode("utf-8") for v in values]
+            _save(tmp, field, np.frombuffer(b"".join(blobs), dtype=np.uint8))
+            _save(tmp, field + ".offsets",
+                  np.concatenate([[0], np.cumsum([len(b) for b in blobs])]).astype(np.int64))
+
+    encoded = [s.encode("utf-8") for s in strings]  # dict giữ thứ tự intern
+    _save(tmp, "strings", np.frombuffer(b"".join(encoded), dtype=np.uint8))
+    _save(tmp, "string_offsets",
+          np.concatenate([[0], np.cumsum([len(b) for b in encoded])]).astype(np.int64))
+
+    with open(os.path.join(tmp, MANIFEST), "w", encoding="utf-8") as f:
+        json.dump({"format": FORMAT_VERSION, "rows": len(rows), "fields": kinds,
+                   "templates": templates}, f)
+
+    old = path + ".old"
+    shutil.rmtree(old, ignore_errors=True)
+    if os.path.exists(path):
+        os.replace(path, old)
+    os.replace(tmp, path)
+    shutil.rmtree(old, ignore_errors=True)
+    return kinds
+
+
+class MetaStore:
+    """Đọc store: `store[row]` -> dict (không gồm TEXT_FIELDS), `store.ids` -> mảng id."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, MANIFEST), encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("format") not in READ_FORMATS:
+            raise ValueError(f"unsupported meta store format: {manifest.get('format')}")
+        self.kinds = manifest["fields"]
+        self.templates = manifest.get("templates", {})
+        self._rows = manifest["rows"]
+        self._strings = None
+        self._string_offsets = None
+        self._decoded = {}
+        self._columns = {}  # field -> (kind, col, offsets), mở khi cần
+        self.ids = self._column("id")[1] if self.kinds.get("id") == "int" else None
+
+    def _load(self, name: str):
+        return np.load(os.path.join(self.path, name + ".npy"), mmap_mode="r")
+
+    def _column(self, field: str):
+        column = self._columns.get(field)
+        if column is None:
+            kind = self.kinds[field]
+            col = offsets = None
+            if kind != "derived":
+                col = self._load(field)
+            if kind in ("list", "ids", "text"):
+                offsets = self._load(field + ".offsets")
+            column = self._columns[field] = (kind, col, offsets)
+        return column
+
+    def __len__(self):
+        return self._rows
+
+    def _string(self, sid: int):
+        if sid < 0:
+            return None
+        s = self._decoded.get(sid)
+        if s is None:
+            if self._strings is None:
+                self._string_offsets = self._load("string_offsets")
+                self._strings = self._load("strings")
+            start, end = self._string_offsets[sid], self._string_offsets[sid + 1]
+            s = self._decoded[sid] = bytes(self._strings[start:end]).decode("utf-8")
+        return s
+
+    def _value(self, row: int, field: str):
+        kind, col, offsets = self._column(field)
+        if kind == "derived":
+            pid = self._value(row, "id")
+            return None if pid is None else self.templates[field].replace("{id}", str(pid))
+        if kind == "int":
+            v = int(col[row])
+            return None if v == -1 else v
+        if kind == "str":
+            return self._string(int(col[row]))
+        start, end = offsets[row], offsets[row + 1]
+        if kind == "list":
+            return [self._string(int(sid)) for sid in col[start:end]]
+        if kind == "ids":
+            return [int(x) for x in col[start:end]]
+        return bytes(col[start:end]).decode("utf-8")
+
+    def __getitem__(self, row: int) -> dict:
+        if not 0 <= row < self._rows:
+            raise IndexError(row)
+        return {
+            field: self._value(row, field)
+            for field, kind in self.kinds.items() if kind != "text"
+        }
+
+    def __iter__(self):
+        return (self[i] for i in range(self._rows))
+
+    def text(self, row: int, field: str) -> Optional[str]:
+        """Field bất kỳ của 1 hàng, kể cả field văn bản lớn."""
+        if field not in self.kinds:
+            return None
+        return self._value(row, field)
+
+    def painting_ids(self, row: int) -> list:
+        """Id tranh của 1 hàng (hàng theo tranh: `id`; hàng topic cũ: `suggest_ids`)."""
+        if "suggest_ids" in self.kinds:
+            ids = self._value(row, "suggest_ids")
+            if ids:
+                return ids
+        if self.ids is not None and self.ids[row] != -1:
+            return [int(self.ids[row])]
+        return []
+
+
+class ListMeta(list):
+    """meta.pkl (list dict) với cùng giao diện như MetaStore."""
+
+    def text(self, row: int, field: str):
+        return self[row].get(field)
+
+    def painting_ids(self, row: int) -> list:
+        meta = self[row]
+        ids = meta.get("suggest_ids") or []
+        if not ids and meta.get("id") is not None:
+            ids = [meta["id"]]
+        return ids
+
+
+def load_meta(store_path: str, pickle_path: str):
+    """
+    MetaStore nếu store tồn tại và không cũ hơn meta.pkl; nếu không thì đọc
+    pickle (ListMeta). None nếu không có cả hai.
+    """
+    manifest = os.path.join(store_path, MANIFEST)
+    has_store = os.path.exists(manifest)
+    has_pickle = os.path.exists(pickle_path)
+    if has_store and (
+        not has_pickle or os.path.getmtime(manifest) >= os.path.getmtime(pickle_path)
+    ):
+        return MetaStore(store_path)
+    if has_pickle:
+        if has_store:
+            print("[Meta] meta.pkl mới hơn meta store -> đọc pickle "
+                  "(chạy `python build_catalog.py meta-store`).")
+        with open(pickle_path, "rb") as f:
+            return ListMeta(pickle.load(f))
+    return None
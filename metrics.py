@@ -0,0 +1,287 @@
+"""
+Metrics trong process, xuất theo Prometheus text format (GET /metrics).
+
+- Counter / Histogram có label; Gauge đọc lúc scrape từ các hàm stats()
+  (EMBED_CACHE, ReplyCache, SQLite pool...).
+- Timing của request hiện tại (dùng cho header Server-Timing) giữ trong
+  ContextVar, nên chạy đúng cả với thread pool của Flask lẫn asyncio.
+
+Mỗi worker process có bộ đếm riêng; scrape từng worker hoặc cộng ở Prometheus.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Optional
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(labelnames, values, extra=()) -> str:
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    body = ",".join(
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in pairs
+    )
+    return "{" + body + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(n, "") for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        key = tuple(labels.get(n, "") for n in self.labelnames)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def snapshot(self) -> dict:
+        """{tuple giá trị label: count} (bản sao)."""
+        with self._lock:
+            return dict(self._values)
+
+    def expose(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(n, "") for n in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def expose(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._series.items())
+        for key, series in items:
+            for bound, count in zip(self.buckets + (float("inf"),),
+                                    series[:len(self.buckets)] + [series[-1]]):
+                labels = _format_labels(self.labelnames, key, [("le", _format_value(float(bound)))])
+                yield f"{self.name}_bucket{labels} {count}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(float(series[-2]))}"
+            yield f"{self.name}_count{labels} {series[-1]}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._stats = {}  # prefix -> stats() callable
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def register_stats(self, prefix: str, stats_fn: Callable[[], dict]):
+        """Mỗi giá trị số trong stats_fn() thành gauge `chatbot_<prefix>_<key>`."""
+        with self._lock:
+            self._stats[prefix] = stats_fn
+
+    def expose(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics)
+            stats = sorted(self._stats.items())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.expose())
+        for prefix, stats_fn in stats:
+            try:
+                values = stats_fn()
+            except Exception as e:
+                print(f"[Metrics] stats '{prefix}' error: {e}")
+                continue
+            for key, value in values.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                name = f"chatbot_{prefix}_{key}"
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def counter(name: str, help: str, labelnames=()) -> Counter:
+    return REGISTRY.register(Counter(name, help, labelnames))
+
+
+def histogram(name: str, help: str, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.register(Histogram(name, help, labelnames, buckets))
+
+
+def register_stats(prefix: str, stats_fn: Callable[[], dict]):
+    REGISTRY.register_stats(prefix, stats_fn)
+
+
+def expose() -> str:
+    return REGISTRY.expose()
+
+
+# =========================
+# Metrics của chatbot
+# =========================
+
+STAGE_SECONDS = histogram(
+    "chatbot_stage_seconds", "Latency of each DirectorAgent stage.", ["stage"]
+)
+OPENAI_SECONDS = histogram(
+    "chatbot_openai_seconds", "Latency of OpenAI API calls.", ["kind", "model", "outcome"]
+)
+OPENAI_TOKENS = counter(
+    "chatbot_openai_tokens_total", "Tokens reported by OpenAI usage.", ["kind", "model", "type"]
+)
+RETRIEVAL_ROUTES = counter(
+    "chatbot_retrieval_route_total", "Chat turns by retrieval route.", ["route", "cached"]
+)
+UPSTREAM_SKIPPED = counter(
+    "chatbot_upstream_skipped_total",
+    "OpenAI calls not attempted (circuit open or request budget exhausted).",
+    ["upstream", "reason"],
+)
+DEGRADED_TURNS = counter(
+    "chatbot_degraded_total", "Chat turns answered in degraded mode.", ["upstream"]
+)
+SINGLEFLIGHT_CALLS = counter(
+    "chatbot_singleflight_calls_total",
+    "Coalesced calls by layer; role=shared are upstream/compute calls saved.",
+    ["layer", "role"],
+)
+OPENAI_QUEUE_WAIT = histogram(
+    "chatbot_openai_queue_wait_seconds",
+    "Time OpenAI calls waited for the scheduler (0 when admitted at once).",
+    ["priority"],
+)
+QUERY_REWRITES = counter(
+    "chatbot_query_rewrite_total",
+    "Retrievals whose query was rewritten locally, by change (none = unchanged).",
+    ["change"],
+)
+HTTP_SECONDS = histogram(
+    "chatbot_http_request_seconds", "HTTP request latency (until the view returns).",
+    ["endpoint", "status"],
+)
+
+
+# =========================
+# Timing của request hiện tại (header Server-Timing)
+# =========================
+
+_request_timings: ContextVar[Optional[dict]] = ContextVar("chatbot_request_timings", default=None)
+
+
+def start_request() -> dict:
+    """Bắt đầu gom timing cho request hiện tại; trả dict stage -> ms."""
+    timings = {}
+    _request_timings.set(timings)
+    return timings
+
+
+def record_timing(name: str, ms: float):
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[name] = round(timings.get(name, 0.0) + ms, 2)
+
+
+def server_timing_header(timings: dict) -> str:
+    return ", ".join(f"{name};dur={ms}" for name, ms in timings.items())
+
+
+class OpenAISpan:
+    """Ghi latency + token usage của 1 lần gọi OpenAI."""
+
+    def __init__(self, kind: str, model: str):
+        self.kind = kind
+        self.model = model
+        self.usage = None
+
+    def record_usage(self, usage):
+        if usage is not None:
+            self.usage = usage
+
+
+@contextmanager
+def openai_span(kind: str, model: str):
+    """`with openai_span("chat", model) as span: resp = ...; span.record_usage(resp.usage)`"""
+    span = OpenAISpan(kind, model)
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        yield span
+        outcome = "ok"
+    finally:
+        elapsed = time.perf_counter() - start
+        OPENAI_SECONDS.observe(elapsed, kind=kind, model=model, outcome=outcome)
+        record_timing(f"openai_{kind}", elapsed * 1000)
+        usage = span.usage
+        if usage is not None:
+            for token_type in ("prompt_tokens", "completion_tokens"):
+                count = getattr(usage, token_type, None)
+                if count:
+                    OPENAI_TOKENS.inc(count, kind=kind, model=model, type=token_type.split("_")[0])
+
+
+# =========================
+# Thời gian khởi động (serve.py)
+# =========================
+
+STARTUP_SECONDS = {}  # phase -> giây (import, warmup, ready)
+
+
+def record_startup(phase: str, seconds: float):
+    STARTUP_SECONDS[phase] = round(seconds, 4)
+
+
+register_stats(
+    "startup", lambda: {f"{phase}_seconds": s for phase, s in STARTUP_SECONDS.items()}
+)
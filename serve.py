@@ -0,0 +1,145 @@
+"""
+Production entry point: waitress (WSGI thread pool), tuỳ chọn pre-fork.
+
+    python serve.py [--host 0.0.0.0] [--port 8000] [--threads 8] [--workers 4]
+
+Process chính import app, nạp SDK openai và chạy DirectorAgent.warmup() (meta,
+vector/keyword index, SQLite, FragmentCache) *trước khi* nhận request. Với
+--workers > 1 (chỉ POSIX) nó bind socket rồi fork: các worker dùng chung
+những trang đã nạp theo kiểu copy-on-write, mỗi worker chạy 1 waitress trên
+cùng socket; worker chết thì được khởi động lại.
+
+Thời gian khởi động: gauge chatbot_startup_{import,warmup,ready}_seconds trên /metrics.
+"""
+import time
+
+START = time.perf_counter()
+
+import argparse  # noqa: E402
+import gc  # noqa: E402
+import os  # noqa: E402
+import signal  # noqa: E402
+import socket  # noqa: E402
+import sys  # noqa: E402
+
+import metrics  # noqa: E402
+
+
+def preload(warm: bool = True):
+    """Import Flask app (+ Chatbot, SDK openai) và warmup; trả module app."""
+    import app as app_module
+    from Chatbot import preload_openai
+
+    preload_openai()
+    metrics.record_startup("import", time.perf_counter() - START)
+    if warm:
+        start = time.perf_counter()
+        stats = app_module.director.warmup()
+        metrics.record_startup("warmup", time.perf_counter() - start)
+        print(f"[Serve] Warmup: {stats['queries']} câu mẫu, {stats['seconds']}s")
+    return app_module
+
+
+def run_waitress(wsgi_app, sock, threads: int):
+    from waitress import serve
+
+    serve(wsgi_app, sockets=[sock], threads=threads)
+
+
+def run_workers(app_module, sock, workers: int, threads: int):
+    """Fork `workers` process con dùng chung `sock`; process cha chỉ giám sát."""
+    catalog = app_module.CATALOG
+    # Thread và connection SQLite không được mang qua fork.
+    catalog.stop_watcher()
+    catalog.current.pool.close_all()
+    gc.collect()
+    gc.freeze()  # GC không chạm vào object đã nạp -> trang giữ nguyên được chia sẻ
+
+    children = {}
+    stopping = False
+
+    def stop_worker(signum, frame):
+        raise SystemExit(0)  # thoát qua finally bên dưới (ghi nốt log)
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                signal.signal(signal.SIGINT, stop_worker)
+                signal.signal(signal.SIGTERM, stop_worker)
+                catalog.start_watcher()
+                run_waitress(app_module.app, sock, threads)
+            except SystemExit as e:
+                code = e.code or 0
+            except BaseException as e:
+                print(f"[Serve] worker {os.getpid()} lỗi: {e!r}")
+                code = 1
+            finally:
+                # os._exit bỏ qua atexit: tự ghi nốt log đang trong queue.
+                app_module.director.logger.flush()
+                os._exit(code)
+        children[pid] = time.monotonic()
+
+    def shutdown(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+    for _ in range(workers):
+        spawn()
+    print(f"[Serve] {workers} worker: {', '.join(map(str, children))}")
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        started = children.pop(pid, None)
+        if started is None or stopping:
+            continue
+        print(f"[Serve] worker {pid} thoát (status {status}) -> khởi động lại")
+        if time.monotonic() - started < 1.0:
+            time.sleep(1.0)  # tránh vòng lặp crash liên tục
+        spawn()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Serve the chatbot with waitress.")
+    parser.add_argument("--host", default=os.getenv("CHATBOT_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("CHATBOT_PORT", "8000")))
+    parser.add_argument("--threads", type=int, default=int(os.getenv("CHATBOT_THREADS", "8")))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("CHATBOT_WORKERS", "1")),
+                        help="pre-forked processes (POSIX only)")
+    parser.add_argument("--backlog", type=int, default=1024)
+    parser.add_argument("--no-warmup", action="store_true", help="skip DirectorAgent.warmup()")
+    args = parser.parse_args(argv)
+
+    workers = args.workers
+    if workers > 1 and not hasattr(os, "fork"):
+        print("⚠️  Hệ điều hành không có fork -> chạy 1 process.")
+        workers = 1
+
+    app_module = preload(warm=not args.no_warmup)
+    sock = socket.create_server((args.host, args.port), backlog=args.backlog)
+    metrics.record_startup("ready", time.perf_counter() - START)
+    print(
+        f"Server (waitress) đang chạy tại http://{args.host}:{args.port}/ "
+        f"— sẵn sàng sau {time.perf_counter() - START:.2f}s"
+    )
+
+    if workers > 1:
+        run_workers(app_module, sock, workers, args.threads)
+    else:
+        run_waitress(app_module.app, sock, args.threads)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
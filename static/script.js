@@ -19,18 +19,11 @@ async function sendMessage() {
     showLoadingIcon(true);
 
     try {
-        const response = await fetch("/chat", {
-            method: "POST",
-            headers: { "Content-Type": "application/json" },
-            body: JSON.stringify({ message })
-        });
-
-        if (!response.ok) {
-            throw new Error(`Server returned ${response.status}`);
+        if (window.ReadableStream && window.TextDecoder) {
+            await streamResponse(message);
+        } else {
+            await fetchFullResponse(message);
         }
-
-        const data = await response.json();
-        typeResponse("Bot", data.reply);
     } catch (err) {
         console.error("Send message failed:", err);
         typeResponse("Bot", "Xin lỗi, hệ thống đang gặp sự cố. Vui lòng thử lại sau.");
@@ -39,6 +32,85 @@ async function sendMessage() {
     }
 }
 
+async function fetchFullResponse(message) {
+    const response = await fetch("/chat", {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({ message })
+    });
+
+    if (!response.ok) {
+        throw new Error(`Server returned ${response.status}`);
+    }
+
+    const data = await response.json();
+    typeResponse("Bot", data.reply);
+}
+
+function createBotBubble() {
+    const box = document.getElementById("chat-box");
+    const div = document.createElement("div");
+    div.classList.add("chat-row");
+
+    const bubble = document.createElement("div");
+    bubble.className = "chat-bubble bot";
+    bubble.innerHTML = "<strong>CGI:</strong> ";
+
+    const introSpan = document.createElement("span");
+    introSpan.className = "intro-text";
+    bubble.appendChild(introSpan);
+
+    div.appendChild(bubble);
+    box.appendChild(div);
+    box.scrollTop = box.scrollHeight;
+    return { bubble, introSpan };
+}
+
+// Đọc /chat/stream (NDJSON): gallery hiện ngay khi retrieve xong, intro chạy theo token.
+async function streamResponse(message) {
+    const response = await fetch("/chat/stream", {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({ message })
+    });
+
+    if (!response.ok || !response.body) {
+        throw new Error(`Server returned ${response.status}`);
+    }
+
+    const box = document.getElementById("chat-box");
+    const { bubble, introSpan } = createBotBubble();
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder("utf-8");
+    let buffered = "";
+
+    const handleEvent = (event) => {
+        if (event.type === "gallery") {
+            renderProducts(bubble, event.products || [], event.next_cursor, true);
+        } else if (event.type === "intro") {
+            introSpan.textContent += event.text;
+            box.scrollTop = box.scrollHeight;
+        } else if (event.type === "error") {
+            throw new Error("Stream error");
+        }
+    };
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffered += decoder.decode(value, { stream: true });
+
+        let newline;
+        while ((newline = buffered.indexOf("\n")) >= 0) {
+            const line = buffered.slice(0, newline).trim();
+            buffered = buffered.slice(newline + 1);
+            if (line) handleEvent(JSON.parse(line));
+        }
+        showLoadingIcon(false);
+    }
+    if (buffered.trim()) handleEvent(JSON.parse(buffered));
+}
+
 function appendMessage(sender, message) {
     const box = document.getElementById("chat-box");
     const div = document.createElement("div");
@@ -63,6 +135,49 @@ function showLoadingIcon(show) {
            </svg>`;
 }
 
+function escapeHtml(text) {
+    const div = document.createElement("div");
+    div.textContent = text == null ? "" : String(text);
+    return div.innerHTML;
+}
+
+function productsToHtml(products, withHeading) {
+    if (!products.length) return "";
+    const items = products.map(p => `
+            <div class="item" style="margin-bottom: 16px;">
+                <h4>${escapeHtml(p.title)}</h4>
+                <img src="${escapeHtml(p.image_url)}" style="max-width: 100%; border-radius: 10px;">
+                <p class="links-row"><a class="link-btn" href="${escapeHtml(p.ar_url)}" target="_blank">Xem AR</a><span class="link-separator">|</span><a class="link-btn" href="${escapeHtml(p.detail_url)}" target="_blank">Xem chi tiết</a></p>
+            </div>`).join("");
+    const heading = withHeading ? "<h3>Danh sách tranh gợi ý</h3>" : "";
+    return `${heading}<div class="gallery">${items}</div>`;
+}
+
+// Dựng gallery từ JSON record; nút "Xem thêm" lấy trang tiếp qua /results/<cursor>.
+function renderProducts(bubble, products, nextCursor, withHeading) {
+    const html = productsToHtml(products, withHeading);
+    if (html) renderHtmlInChunks(bubble, html, 4);
+    if (!nextCursor) return;
+
+    const more = document.createElement("button");
+    more.className = "link-btn more-btn";
+    more.textContent = "Xem thêm";
+    more.onclick = async () => {
+        more.disabled = true;
+        try {
+            const response = await fetch(`/results/${encodeURIComponent(nextCursor)}`);
+            if (!response.ok) throw new Error(`Server returned ${response.status}`);
+            const data = await response.json();
+            more.remove();
+            renderProducts(bubble, data.products || [], data.next_cursor, false);
+        } catch (err) {
+            console.error("Load more failed:", err);
+            more.disabled = false;
+        }
+    };
+    bubble.appendChild(more);
+}
+
 function renderHtmlInChunks(bubble, htmlString, batchSize = 4) {
     const box = document.getElementById("chat-box");
     const temp = document.createElement("div");
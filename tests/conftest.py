@@ -0,0 +1,16 @@
+"""
+Test defaults: log / cache dirs tạm, key giả, embedding local (không gọi
+OpenAI). Catalogue là central_data của repo, mở read-only.
+"""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_TMP = tempfile.mkdtemp(prefix="chatbot-tests-")
+os.environ.setdefault("CHATBOT_LOG_DIR", os.path.join(_TMP, "logs"))
+os.environ.setdefault("CHATBOT_CACHE_DIR", os.path.join(_TMP, "cache"))
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+os.environ.setdefault("CHATBOT_EMBED_BACKEND", "local")
@@ -0,0 +1,40 @@
+import pytest
+
+import app as app_module
+from Chatbot import MAX_PAGE_SIZE
+
+
+@pytest.fixture()
+def client():
+    return app_module.app.test_client()
+
+
+def test_batch_page_size_is_capped_and_cursor_pages(client):
+    r = client.post("/chat/batch", json={
+        "queries": ["tranh biển", "hoa sen", "tranh biển"],
+        "summarize": "none", "page_size": 500,
+    })
+    assert r.status_code == 200
+    results = r.get_json()["results"]
+    assert [res["query"] for res in results] == ["tranh biển", "hoa sen", "tranh biển"]
+    sea = results[0]
+    assert sea["total"] > MAX_PAGE_SIZE
+    assert len(sea["products"]) == MAX_PAGE_SIZE
+    assert sea["intro"] == "" or isinstance(sea["intro"], str)
+
+    page = client.get("/results/" + sea["next_cursor"])
+    assert page.status_code == 200
+    rest = page.get_json()
+    assert len(rest["products"]) == sea["total"] - MAX_PAGE_SIZE
+    seen = {p["id"] for p in sea["products"]}
+    assert seen.isdisjoint(p["id"] for p in rest["products"])
+
+
+def test_batch_rejects_bad_input(client):
+    assert client.post("/chat/batch", json={"queries": "tranh"}).status_code == 400
+    assert client.post("/chat/batch", json={
+        "queries": ["a"], "summarize": "poem",
+    }).status_code == 400
+    assert client.post("/chat/batch", json={
+        "queries": ["a"], "page_size": "many",
+    }).status_code == 400
@@ -0,0 +1,99 @@
+import time
+
+import pytest
+
+import app as app_module
+from Chatbot import (
+    OPENAI_SCHEDULER, CircuitBreaker, UpstreamUnavailable, _request_budget, current_budget,
+    encode_cursor, start_budget, upstream_call,
+)
+
+
+@pytest.fixture(autouse=True)
+def no_budget():
+    token = _request_budget.set(None)
+    yield
+    _request_budget.reset(token)
+
+
+def test_opens_after_consecutive_failures():
+    breaker = CircuitBreaker("test", failures=3, reset_s=60)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()  # chuỗi lỗi bị ngắt
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.allow() and not breaker.is_open
+    breaker.record_failure()
+    assert breaker.is_open and not breaker.allow()
+    assert breaker.stats() == {"open": 1, "trips": 1, "rejected": 1}
+
+
+def test_half_open_allows_one_probe():
+    breaker = CircuitBreaker("test", failures=1, reset_s=0.05)
+    breaker.record_failure()
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow()      # probe
+    assert not breaker.allow()  # chỉ 1 probe cùng lúc
+    breaker.record_failure()    # probe lỗi -> mở lại, không tính trip mới
+    assert breaker.is_open and breaker.trips == 1
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.release()           # probe không rõ kết quả -> cho thử lại
+    assert breaker.allow()
+    breaker.record_success()
+    assert not breaker.is_open and breaker.allow()
+
+
+def test_upstream_call_counts_failures_and_skips_when_open():
+    breaker = CircuitBreaker("test", failures=2, reset_s=60)
+    budget = start_budget(5)
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            with upstream_call(breaker, 1.0) as timeout:
+                assert 0 < timeout <= 1.0
+                raise ConnectionError()
+    assert breaker.is_open and budget.degraded == {"test"}
+    with pytest.raises(UpstreamUnavailable):
+        with upstream_call(breaker, 1.0):
+            pytest.fail("called while the circuit is open")
+    assert OPENAI_SCHEDULER.stats()["in_flight"] == 0
+
+
+def test_upstream_call_skips_when_budget_is_spent():
+    breaker = CircuitBreaker("test")
+    budget = start_budget(0.1)
+    with pytest.raises(UpstreamUnavailable):
+        with upstream_call(breaker, 1.0):
+            pytest.fail("called without budget")
+    assert budget.degraded == {"test"} and not breaker.is_open
+
+
+def test_upstream_call_without_budget_has_no_timeout():
+    with upstream_call(CircuitBreaker("test"), 1.0) as timeout:
+        assert timeout is None
+
+
+def test_request_budget_is_cleared_after_each_request():
+    client = app_module.app.test_client()
+    r = client.post("/chat/batch", json={"queries": ["tranh biển"], "summarize": "none"})
+    assert r.status_code == 200
+    assert current_budget() is None
+
+
+def test_results_page_runs_with_its_own_budget(monkeypatch):
+    director = app_module.director
+    stale = start_budget(0)
+    seen = []
+    search = director.retriever.search_ranked
+
+    def spy(query):
+        seen.append(current_budget())
+        return search(query)
+
+    monkeypatch.setattr(director.retriever, "search_ranked", spy)
+    page = director.results_page(encode_cursor("tranh biển", 0, 5))
+    assert page["products"]
+    assert seen[0] is not stale and seen[0].remaining() > 1
+    assert current_budget() is stale
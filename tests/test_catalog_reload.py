@@ -0,0 +1,25 @@
+from Chatbot import CATALOG, CatalogManager, DirectorAgent, catalog_version
+
+
+def test_reload_without_changes_keeps_snapshot():
+    manager = CatalogManager()
+    snapshot = manager.current
+    assert not manager.reload()
+    assert manager.current is snapshot
+
+
+def test_forced_reload_gets_a_new_version_and_drops_caches():
+    director = DirectorAgent()
+    before = catalog_version()
+    files = CATALOG.current.files
+    director.reply_cache.put("tranh biển", [1, 2], "intro cũ", before)
+    assert director.reply_cache.get("tranh biển", [1, 2], before) == "intro cũ"
+
+    assert CATALOG.reload(force=True)
+    after = catalog_version()
+    assert after != before and CATALOG.current.files == files
+    assert director.reply_cache.get("tranh biển", [1, 2], after) is None
+
+    assert CATALOG.reload(force=True)
+    assert catalog_version() not in (before, after)
+    assert not CATALOG.reload()  # file vẫn không đổi: watcher / reload thường bỏ qua
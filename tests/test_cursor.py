@@ -0,0 +1,62 @@
+import base64
+import json
+
+import pytest
+
+import app as app_module
+from Chatbot import MAX_PAGE_SIZE, RankedResults, decode_cursor, encode_cursor
+
+
+def _raw(data) -> str:
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip("=")
+
+
+def test_round_trip():
+    cursor = encode_cursor("tranh biển", 24, 12)
+    assert "=" not in cursor
+    assert decode_cursor(cursor) == ("tranh biển", 24, 12, None, ())
+    assert decode_cursor(encode_cursor("hoa", 0, 5, "sess-0001")) == ("hoa", 0, 5, "sess-0001", ())
+
+
+@pytest.mark.parametrize("cursor", [
+    "not base64!",
+    _raw(["q", 0, 12]),
+    _raw({"q": "a", "o": 0}),
+    _raw({"q": "a", "o": -1, "n": 12}),
+    _raw({"q": "a", "o": 0, "n": 0}),
+    _raw({"q": "a", "o": 0, "n": MAX_PAGE_SIZE + 1}),
+    _raw({"q": "a", "o": "x", "n": 12}),
+    _raw({"q": "a", "o": 0, "n": 12, "s": "../../x"}),
+])
+def test_invalid_cursors(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)
+
+
+def test_results_endpoint_pages_without_overlap():
+    director = app_module.director
+    client = app_module.app.test_client()
+    results = director.retriever.search_ranked("tranh biển")
+    assert len(results) > 24
+
+    seen = []
+    cursor = encode_cursor("tranh biển", 0, 12)
+    while cursor:
+        r = client.get("/results/" + cursor)
+        assert r.status_code == 200
+        body = r.get_json()
+        assert body["total"] == len(results)
+        seen += [p["id"] for p in body["products"]]
+        cursor = body["next_cursor"]
+    assert seen == results.ids
+
+    assert client.get("/results/garbage").status_code == 400
+
+
+def test_ranked_results_page_skips_missing_rows():
+    products = [{"id": i, "score": 1.0 - i / 10} for i in range(5)]
+    results = RankedResults.from_products(products, "keyword")
+    results.ranked.insert(1, (99, 0.95))  # id không còn trong catalogue
+    assert [p["id"] for p in results.page(0, 3)] == [0, 1]
+    assert [p["id"] for p in results.page(3)] == [2, 3, 4]
+    assert len(results) == 6
@@ -0,0 +1,56 @@
+import shutil
+import sqlite3
+
+import pytest
+
+import build_catalog
+from Chatbot import (
+    FOLD_VERSION, SEARCH_META_TABLE, SQLITE_PATH, RetrieverAgent, extract_tokens, fold_text,
+    has_search_tables, strip_accents,
+)
+
+
+def test_d_stroke_is_folded():
+    assert strip_accents("Đồng quê đẹp") == "Dong que dep"
+    assert fold_text("Hoa ĐÀO") == "hoa dao"
+    assert extract_tokens("tranh hoa đào") == extract_tokens("tranh hoa dao")
+
+
+def test_accented_and_plain_queries_agree():
+    retriever = RetrieverAgent()
+    for accented, plain in [("hoa đào", "hoa dao"), ("đồng quê", "dong que")]:
+        a, b = retriever.search_ranked(accented), retriever.search_ranked(plain)
+        assert a.ranked and a.ranked == b.ranked
+
+
+@pytest.fixture()
+def db_copy(tmp_path):
+    path = str(tmp_path / "paintings.db")
+    shutil.copy(SQLITE_PATH, path)
+    return path
+
+
+def test_search_tables_built_with_old_fold_are_rebuilt(db_copy):
+    assert build_catalog.build_search_index(db_copy)
+    conn = sqlite3.connect(db_copy)
+    try:
+        assert has_search_tables(conn)
+        hits = conn.execute(
+            "SELECT count(*) FROM paintings_search WHERE keywords LIKE '%hoa dao%';"
+        ).fetchone()[0]
+        assert hits > 0
+        with conn:
+            conn.execute(f"UPDATE {SEARCH_META_TABLE} SET value = '1' WHERE key = 'fold';")
+        assert not has_search_tables(conn)  # runtime bỏ qua, dùng LIKE
+    finally:
+        conn.close()
+
+    assert build_catalog.build_search_index(db_copy)  # fold cũ -> build lại
+    assert not build_catalog.build_search_index(db_copy)  # đã cập nhật
+    conn = sqlite3.connect(db_copy)
+    try:
+        assert conn.execute(
+            f"SELECT value FROM {SEARCH_META_TABLE} WHERE key = 'fold';"
+        ).fetchone()[0] == FOLD_VERSION
+    finally:
+        conn.close()
@@ -0,0 +1,65 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+import Chatbot
+from Chatbot import EMBED_LATENCY, HYBRID_BUDGET_MS, RetrieverAgent
+
+QUERY = "chó đốm"  # có kết quả BM25 nhưng ít hơn HYBRID_CONFIDENT_HITS tranh khớp mọi chữ
+
+
+@pytest.fixture()
+def embeds(monkeypatch):
+    calls = []
+
+    def embed_text(text):
+        calls.append(("sync", text))
+        raise RuntimeError("no embedding in tests")
+
+    async def embed_text_async(text):
+        calls.append(("async", text))
+        raise RuntimeError("no embedding in tests")
+
+    monkeypatch.setattr(Chatbot, "RETRIEVAL_MODE", "hybrid")
+    monkeypatch.setattr(Chatbot, "embed_text", embed_text)
+    monkeypatch.setattr(Chatbot, "embed_text_async", embed_text_async)
+    monkeypatch.setattr(Chatbot.EMBED_CACHE, "get", lambda *args, **kwargs: None)
+    monkeypatch.setattr(EMBED_LATENCY, "value", EMBED_LATENCY.value)
+    return calls
+
+
+def _search_both(retriever):
+    sync = retriever._search_ranked(QUERY)
+    async_ = asyncio.run(retriever._search_ranked_async(QUERY))
+    return sync, async_
+
+
+def test_slow_embedding_is_skipped_on_both_paths(embeds):
+    retriever = RetrieverAgent()
+    assert not retriever._lexical_confident(QUERY)
+    EMBED_LATENCY.value = HYBRID_BUDGET_MS * 2
+    sync, async_ = _search_both(retriever)
+    assert embeds == []
+    assert sync.route == async_.route == "hybrid-lexical"
+    assert sync.ranked == async_.ranked
+
+
+def test_fast_embedding_is_awaited_on_both_paths(embeds):
+    EMBED_LATENCY.value = HYBRID_BUDGET_MS / 2
+    _search_both(RetrieverAgent())
+    assert embeds == [("sync", QUERY), ("async", QUERY)]
+
+
+def test_async_embed_records_latency(monkeypatch):
+    class SlowBackend:
+        name = "slow"
+
+        async def aembed(self, texts):
+            await asyncio.sleep(0.05)
+            return [np.zeros(4, dtype="float32") for _ in texts]
+
+    monkeypatch.setattr(Chatbot.EMBED_CACHE, "put", lambda *args: None)
+    monkeypatch.setattr(EMBED_LATENCY, "value", 0.0)
+    asyncio.run(Chatbot._aembed_and_cache(SlowBackend(), "x"))
+    assert EMBED_LATENCY.value > 0
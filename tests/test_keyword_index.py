@@ -0,0 +1,28 @@
+import pytest
+
+from Chatbot import RetrieverAgent, extract_tokens, load_keyword_index, strip_accents
+
+QUERIES = [
+    "tranh biển", "tranh bien", "hoa đào", "hoa dao", "Đà Lạt", "hoàng hôn màu xanh",
+    "thuyền trên biển lúc hoàng hôn", "sen", "zzzqqq",
+]
+
+
+def _tokens(query):
+    return extract_tokens(query) or [strip_accents(query.lower())]
+
+
+@pytest.mark.parametrize("query", QUERIES)
+def test_index_matches_sql_like_path(query):
+    tokens = _tokens(query)
+    sql = [p["id"] for p in RetrieverAgent()._keyword_search_sql(tokens)]
+    index = [p["id"] for p in load_keyword_index().search(tokens)]
+    assert index == sql
+
+
+def test_phrase_token_and_limit_match_sql():
+    retriever, index = RetrieverAgent(), load_keyword_index()
+    for tokens in (["hoang hon"], ["bien"], []):
+        sql = [p["id"] for p in retriever._keyword_search_sql(tokens, limit=7)]
+        assert [p["id"] for p in index.search(tokens, limit=7)] == sql
+    assert index.search(["zzzqqq"]) == []
@@ -0,0 +1,87 @@
+import glob
+import json
+import os
+import time
+
+from Chatbot import LogAgent
+
+
+def read_records(log_dir):
+    records = []
+    for path in sorted(glob.glob(os.path.join(log_dir, "*.jsonl"))):
+        with open(path, encoding="utf-8") as f:
+            records.extend(json.loads(line) for line in f)
+    return records
+
+
+def test_records_are_written_as_jsonl(tmp_path):
+    agent = LogAgent(str(tmp_path), flush_interval=0.01)
+    agent.log_chat("tranh biển", [3, 38], route="keyword", session_id="abc12345",
+                   timings={"retrieve": 1.5})
+    assert agent.flush()
+    (record,) = read_records(str(tmp_path))
+    assert record["query"] == "tranh biển" and record["ids"] == [3, 38]
+    assert record["session"] == "abc12345" and record["route"] == "keyword"
+    assert "html" not in record
+
+
+def test_flush_does_not_wait_for_batch_interval(tmp_path):
+    agent = LogAgent(str(tmp_path), flush_interval=30, batch_size=1000)
+    for i in range(5):
+        agent.log_chat(f"q{i}")
+    start = time.monotonic()
+    assert agent.flush(timeout=5)
+    assert time.monotonic() - start < 2
+    assert len(read_records(str(tmp_path))) == 5
+
+
+def test_bad_record_does_not_kill_writer(tmp_path):
+    agent = LogAgent(str(tmp_path), flush_interval=0.01)
+    agent.log_chat("ok 1")
+    agent.log_chat("bad", timings={"x": object()})  # json.dumps -> TypeError
+    agent.log_chat("ok 2")
+    assert agent.flush(timeout=5)
+    agent.log_chat("after")
+    assert agent.flush(timeout=5)
+    assert [r["query"] for r in read_records(str(tmp_path))] == ["ok 1", "ok 2", "after"]
+    assert agent.dropped == 1 and agent._thread.is_alive()
+
+
+def test_write_error_does_not_kill_writer(tmp_path, monkeypatch):
+    agent = LogAgent(str(tmp_path), flush_interval=0.01)
+    real_write = agent._write
+    calls = []
+
+    def failing_write(batch):
+        calls.append(batch)
+        if len(calls) == 1:
+            raise RuntimeError("boom")
+        real_write(batch)
+
+    monkeypatch.setattr(agent, "_write", failing_write)
+    agent.log_chat("lost")
+    assert agent.flush(timeout=5)
+    agent.log_chat("kept")
+    assert agent.flush(timeout=5)
+    assert [r["query"] for r in read_records(str(tmp_path))] == ["kept"]
+    assert agent.dropped == 1
+
+
+def test_flush_times_out_instead_of_blocking(tmp_path, monkeypatch):
+    agent = LogAgent(str(tmp_path), flush_interval=0.01)
+    monkeypatch.setattr(agent, "_write", lambda batch: time.sleep(1))
+    agent.log_chat("slow")
+    start = time.monotonic()
+    assert agent.flush(timeout=0.2) is False
+    assert time.monotonic() - start < 0.9
+
+
+def test_rotation_by_size(tmp_path):
+    agent = LogAgent(str(tmp_path), flush_interval=0.01, max_bytes=200)
+    for i in range(6):
+        agent.log_chat(f"câu hỏi số {i}")
+        assert agent.flush()
+    names = sorted(os.listdir(tmp_path))
+    assert any(".1.jsonl" in name for name in names)
+    assert len([r for r in read_records(str(tmp_path))]) == 6
+    assert os.path.exists(os.path.join(tmp_path, ".lock"))
@@ -0,0 +1,73 @@
+import json
+import os
+import pickle
+
+import meta_store
+
+ROWS = [
+    {"id": 1, "file": "1.json", "image": "cgi/1.jpg", "title": "Biển",
+     "keywords": ["biển", "thuyền"], "suggest_ids": [], "embedding_text": "văn bản dài 1"},
+    {"id": 10, "file": "10.json", "image": "cgi/10.jpg", "title": "Hoa sen",
+     "keywords": [], "suggest_ids": [4, 5], "embedding_text": "văn bản dài 2"},
+    {"id": 100, "file": "100.json", "image": "other/x.jpg", "title": None,
+     "keywords": ["hoa"], "suggest_ids": [], "embedding_text": ""},
+]
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "meta")
+    meta_store.write_meta_store(ROWS, path)
+    store = meta_store.MetaStore(path)
+    assert len(store) == 3 and list(store.ids) == [1, 10, 100]
+    for i, row in enumerate(ROWS):
+        expected = {k: v for k, v in row.items() if k != "embedding_text"}
+        assert store[i] == expected
+        assert store.text(i, "embedding_text") == row["embedding_text"]
+    assert store.painting_ids(0) == [1] and store.painting_ids(1) == [4, 5]
+
+
+def test_id_patterned_strings_are_derived(tmp_path):
+    path = str(tmp_path / "meta")
+    kinds = meta_store.write_meta_store(ROWS, path)
+    assert kinds["file"] == "derived"
+    assert kinds["image"] == "str"  # "other/x.jpg" không theo mẫu
+    assert not os.path.exists(os.path.join(path, "file.npy"))
+    with open(os.path.join(path, meta_store.MANIFEST), encoding="utf-8") as f:
+        assert json.load(f)["templates"] == {"file": "{id}.json"}
+
+
+def test_columns_open_lazily(tmp_path):
+    path = str(tmp_path / "meta")
+    meta_store.write_meta_store(ROWS, path)
+    store = meta_store.MetaStore(path)
+    assert set(store._columns) == {"id"} and store._strings is None
+    store.painting_ids(1)
+    assert set(store._columns) == {"id", "suggest_ids"} and store._strings is None
+    assert store.text(2, "file") == "100.json"
+    assert "embedding_text" not in store._columns
+
+
+def test_reads_format_1(tmp_path):
+    path = str(tmp_path / "meta")
+    rows = [{k: v for k, v in row.items() if k not in ("file",)} for row in ROWS]
+    rows[0]["image"] = "cgi/1.jpg"
+    meta_store.write_meta_store(rows, path)
+    manifest = os.path.join(path, meta_store.MANIFEST)
+    with open(manifest, encoding="utf-8") as f:
+        data = json.load(f)
+    assert "derived" not in data["fields"].values()
+    data["format"] = 1
+    del data["templates"]
+    with open(manifest, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    assert meta_store.MetaStore(path)[1]["image"] == "cgi/10.jpg"
+
+
+def test_load_meta_prefers_fresh_store(tmp_path):
+    pkl = str(tmp_path / "meta.pkl")
+    with open(pkl, "wb") as f:
+        pickle.dump(ROWS, f)
+    store_path = str(tmp_path / "meta")
+    assert isinstance(meta_store.load_meta(store_path, pkl), meta_store.ListMeta)
+    meta_store.write_meta_store(ROWS, store_path)
+    assert isinstance(meta_store.load_meta(store_path, pkl), meta_store.MetaStore)
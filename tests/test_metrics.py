@@ -0,0 +1,43 @@
+import gc
+
+import metrics
+from Chatbot import DirectorAgent, _DIRECTORS
+
+
+def gauge(text, name):
+    for line in text.splitlines():
+        if line.startswith(name + " "):
+            return float(line.split()[1])
+    return None
+
+
+def test_counter_and_histogram_exposition():
+    registry = metrics.Registry()
+    calls = registry.register(metrics.Counter("t_calls_total", "Calls.", ["kind"]))
+    seconds = registry.register(metrics.Histogram("t_seconds", "Latency.", buckets=(0.1, 1.0)))
+    calls.inc(kind="a")
+    calls.inc(2, kind="a")
+    seconds.observe(0.05)
+    seconds.observe(0.5)
+    text = registry.expose()
+    assert 't_calls_total{kind="a"} 3' in text
+    assert 't_seconds_bucket{le="0.1"} 1' in text
+    assert 't_seconds_bucket{le="+Inf"} 2' in text
+    assert "t_seconds_count 2" in text
+
+
+def test_director_stats_cover_every_instance():
+    first, second = DirectorAgent(), DirectorAgent()
+    first.reply_cache.misses += 3
+    second.reply_cache.exact_hits += 1
+    second.sessions.evicted += 2
+    text = metrics.expose()
+    misses = sum(d.reply_cache.misses for d in _DIRECTORS)
+    assert gauge(text, "chatbot_reply_cache_misses") == misses
+    assert gauge(text, "chatbot_sessions_evicted") >= 2
+    assert 0 < gauge(text, "chatbot_reply_cache_hit_rate") < 1
+
+    count = len(_DIRECTORS)
+    del first, second
+    gc.collect()
+    assert len(_DIRECTORS) == count - 2
@@ -0,0 +1,38 @@
+import numpy as np
+
+from Chatbot import ReplyCache
+
+
+def _vec(*values):
+    return np.array(values, dtype="float32")
+
+
+def test_exact_and_semantic_hits():
+    cache = ReplyCache(max_entries=4)
+    cache.put("tranh biển", [1, 2, 3], "intro", "v1", _vec(1, 0, 0))
+    assert cache.get("Tranh  biển", [3, 2, 1], "v1") == "intro"
+    assert cache.get("tranh biển đẹp", [1, 2, 3], "v1", _vec(0.99, 0.05, 0)) == "intro"
+    assert cache.get("tranh biển đẹp", [7, 8, 9], "v1", _vec(1, 0, 0)) is None  # tập tranh khác
+    assert cache.get("hoa sen", [1, 2, 3], "v1", _vec(0, 1, 0)) is None
+    stats = cache.stats()
+    assert (stats["exact_hits"], stats["semantic_hits"], stats["misses"]) == (1, 1, 2)
+
+
+def test_lru_eviction_frees_slots():
+    cache = ReplyCache(max_entries=2)
+    for i in range(5):
+        cache.put(f"q{i}", [i], f"intro {i}", "v1", _vec(1, i, 0))
+    assert cache.stats()["entries"] == 2
+    assert cache.get("q4", [4], "v1") == "intro 4"
+    assert cache.get("q0", [0], "v1") is None
+
+
+def test_version_change_drops_semantic_slots():
+    cache = ReplyCache(max_entries=16)
+    for i in range(10):
+        cache.put(f"old {i}", [1, 2, 3], "old intro", "v1", _vec(1, 0, 0))
+    assert cache.get("x", [1, 2, 3], "v2", _vec(1, 0, 0)) is None
+    # slot cũ (cosine 1.0) không được lấp mất chỗ của entry mới trong top-k
+    cache.put("new", [1, 2, 3], "new intro", "v2", _vec(1, 0.1, 0))
+    assert cache.get("other", [1, 2, 3], "v2", _vec(1, 0, 0)) == "new intro"
+    assert cache.stats()["entries"] == 1
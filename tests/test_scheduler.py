@@ -0,0 +1,144 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from Chatbot import OpenAIScheduler, SchedulerRejected, TokenBucket
+
+
+def _queued(scheduler, n, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while scheduler.stats()["queued"] < n:
+        assert time.monotonic() < deadline, "waiter never queued"
+        time.sleep(0.005)
+
+
+def _acquire_in_thread(scheduler, priority, out, deadline=None):
+    def run():
+        try:
+            scheduler.acquire(1, priority, deadline)
+            out.append(priority)
+        except SchedulerRejected as e:
+            out.append(e.reason)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_admits_immediately_when_free():
+    scheduler = OpenAIScheduler(rpm=0, tpm=0, concurrency=2, queue_max=4)
+    assert scheduler.acquire(1) < 0.1
+    assert scheduler.acquire(1) < 0.1
+    stats = scheduler.stats()
+    assert stats["in_flight"] == 2 and stats["admitted"] == 2 and stats["queued"] == 0
+
+
+def test_interactive_is_served_before_earlier_batch():
+    scheduler = OpenAIScheduler(rpm=0, tpm=0, concurrency=1, queue_max=4)
+    scheduler.acquire(1)
+    order = []
+    threads = [_acquire_in_thread(scheduler, "batch", order)]
+    _queued(scheduler, 1)
+    threads.append(_acquire_in_thread(scheduler, "interactive", order))
+    _queued(scheduler, 2)
+    assert scheduler.stats()["queued_batch"] == 1
+
+    scheduler.release()
+    threads[1].join(2)
+    assert order == ["interactive"]
+    scheduler.release()
+    threads[0].join(2)
+    assert order == ["interactive", "batch"]
+
+
+def test_full_queue_evicts_lower_priority_or_rejects():
+    scheduler = OpenAIScheduler(rpm=0, tpm=0, concurrency=1, queue_max=1)
+    scheduler.acquire(1)
+    out = []
+    batch = _acquire_in_thread(scheduler, "batch", out)
+    _queued(scheduler, 1)
+    interactive = _acquire_in_thread(scheduler, "interactive", out)
+    batch.join(2)
+    assert out == ["queue_full"]  # batch bị đẩy ra khỏi hàng
+
+    with pytest.raises(SchedulerRejected) as e:
+        scheduler.acquire(1, "interactive")  # hàng đầy call cùng ưu tiên -> từ chối ngay
+    assert e.value.reason == "queue_full"
+    assert scheduler.saturated()
+
+    scheduler.release()
+    interactive.join(2)
+    assert out == ["queue_full", "interactive"]
+    assert scheduler.stats()["rejected_queue_full"] == 2
+
+
+def test_queue_timeout_removes_waiter():
+    scheduler = OpenAIScheduler(rpm=0, tpm=0, concurrency=1, queue_max=4)
+    scheduler.acquire(1)
+    with pytest.raises(SchedulerRejected) as e:
+        scheduler.acquire(1, "interactive", time.monotonic() + 0.05)
+    assert e.value.reason == "queue_timeout"
+    stats = scheduler.stats()
+    assert stats["queued"] == 0 and stats["rejected_queue_timeout"] == 1
+    scheduler.release()
+    assert scheduler.stats()["in_flight"] == 0
+
+
+def test_pause_holds_new_calls():
+    scheduler = OpenAIScheduler(rpm=0, tpm=0, concurrency=4, queue_max=4)
+    scheduler.pause(5)
+    with pytest.raises(SchedulerRejected):
+        scheduler.acquire(1, "interactive", time.monotonic() + 0.05)
+    assert scheduler.stats()["paused"] == 1
+
+
+def test_token_bucket_waits_for_refill():
+    bucket = TokenBucket(60)  # 1 đơn vị / giây
+    now = time.monotonic()
+    assert bucket.wait_s(60, now) == 0
+    bucket.take(60)
+    assert bucket.wait_s(2, now) == pytest.approx(2.0)
+    assert bucket.wait_s(2, now + 2) == 0
+    assert TokenBucket(0).wait_s(10 ** 9, now) == 0  # 0 = không giới hạn
+
+
+def test_aacquire_orders_by_priority():
+    scheduler = OpenAIScheduler(rpm=0, tpm=0, concurrency=1, queue_max=4)
+    order = []
+
+    async def call(priority):
+        await scheduler.aacquire(1, priority)
+        order.append(priority)
+        scheduler.release()
+
+    async def main():
+        await scheduler.aacquire(1)
+        tasks = [asyncio.create_task(call("rebuild"))]
+        await asyncio.sleep(0.01)
+        tasks.append(asyncio.create_task(call("interactive")))
+        await asyncio.sleep(0.01)
+        assert scheduler.stats()["queued"] == 2
+        scheduler.release()
+        await asyncio.wait_for(asyncio.gather(*tasks), 2)
+
+    asyncio.run(main())
+    assert order == ["interactive", "rebuild"]
+    assert scheduler.stats()["in_flight"] == 0
+
+
+def test_cancelled_waiter_leaves_queue():
+    scheduler = OpenAIScheduler(rpm=0, tpm=0, concurrency=1, queue_max=4)
+
+    async def main():
+        await scheduler.aacquire(1)
+        task = asyncio.create_task(scheduler.aacquire(1))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    stats = scheduler.stats()
+    assert stats["queued"] == 0 and stats["in_flight"] == 1
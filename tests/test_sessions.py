@@ -0,0 +1,123 @@
+import pytest
+
+import app as app_module
+from Chatbot import (
+    RankedResults, SessionStore, decode_cursor, encode_cursor, refinement_text,
+)
+
+SEA = "tranh biển"
+
+
+@pytest.fixture()
+def director():
+    director = app_module.director
+    director.sessions = SessionStore()
+    return director
+
+
+@pytest.mark.parametrize("message", [
+    "chó đốm", "mèo và chó", "hoa sen với cá chép", "cho tôi tranh mèo",
+    "thêm tranh hoa sen", SEA,
+])
+def test_new_queries_are_not_refinements(message):
+    assert refinement_text(message) is None
+
+
+@pytest.mark.parametrize("message, text", [
+    ("màu xanh thôi", "màu xanh"),
+    ("chỉ lấy thuyền nhé", "thuyền"),
+    ("chi lay mau xanh", "mau xanh"),
+    ("lọc theo hoàng hôn", "hoàng hôn"),
+    ("thêm hoàng hôn nữa", "hoàng hôn"),
+])
+def test_refinement_cues(message, text):
+    assert refinement_text(message) == text
+
+
+def test_client_flag_overrides_guess():
+    assert refinement_text("màu xanh thôi", refine=False) is None
+    assert refinement_text("chó đốm", refine=True) == "chó đốm"
+
+
+def test_new_query_in_session_is_a_fresh_search(director):
+    sea, _, _ = director._retrieve(SEA, "sess-fresh", None)
+    dogs, query, terms = director._retrieve("chó đốm", "sess-fresh", None)
+    assert dogs.route != "refine"
+    assert (query, terms) == ("chó đốm", ())
+    assert dogs.ranked == director.retriever.search_ranked("chó đốm").ranked
+
+
+def test_refine_narrows_previous_results(director):
+    sea, _, _ = director._retrieve(SEA, "sess-narrow", None)
+    blue, query, terms = director._retrieve("màu xanh thôi", "sess-narrow", None)
+    assert blue.route == "refine"
+    assert 0 < len(blue) < len(sea)
+    previous = [pid for pid, _ in sea.ranked]
+    ids = [pid for pid, _ in blue.ranked]
+    assert ids == [pid for pid in previous if pid in set(ids)]  # giữ thứ tự lượt trước
+    assert (query, terms) == (SEA, ("mau", "xanh"))
+
+
+def test_chained_refine_keeps_base_query_and_dedupes_terms(director):
+    director._retrieve(SEA, "sess-chain", None)
+    director._retrieve("màu xanh thôi", "sess-chain", None)
+    boats, query, terms = director._retrieve("chỉ lấy thuyền xanh", "sess-chain", None)
+    assert boats.route == "refine"
+    assert (query, terms) == (SEA, ("mau", "xanh", "thuyen"))
+
+    payload = director._page_payload(query, boats, 0, 1, boats.page(0, 1), "sess-chain", terms)
+    if payload["next_cursor"]:
+        assert decode_cursor(payload["next_cursor"])[0::4] == (SEA, terms)
+
+
+def test_refine_without_match_falls_back_to_fresh_search(director):
+    director._retrieve(SEA, "sess-miss", None)
+    results, query, terms = director._retrieve("chỉ lấy zzzqqq", "sess-miss", None)
+    assert results.route != "refine"
+    assert (query, terms) == ("chỉ lấy zzzqqq", ())
+
+
+def test_refined_page_is_recomputed_without_session(director):
+    director._retrieve(SEA, "sess-page", None)
+    blue, query, terms = director._retrieve("màu xanh thôi", "sess-page", None)
+    cursor = director._page_payload(query, blue, 0, 5, blue.page(0, 5), "sess-page",
+                                    terms)["next_cursor"]
+    assert cursor
+    stored = director.results_page(cursor)
+    director.sessions = SessionStore()
+    recomputed = director.results_page(cursor)
+    assert recomputed["total"] == stored["total"] == len(blue)
+    assert [p["id"] for p in recomputed["products"]] == [p["id"] for p in stored["products"]]
+
+
+def test_cursor_rejects_bad_terms():
+    cursor = encode_cursor(SEA, 5, 5, "sess-cursor", ("mau",))
+    assert decode_cursor(cursor) == (SEA, 5, 5, "sess-cursor", ("mau",))
+    with pytest.raises(ValueError):
+        decode_cursor(encode_cursor(SEA, 5, 5, "sess-cursor", ("a b",)))
+    with pytest.raises(ValueError):
+        decode_cursor(encode_cursor(SEA, 5, 5, "sess-cursor", ("x",) * 20))
+
+
+def _results(n=3):
+    return RankedResults([(i, 1.0 / (i + 1)) for i in range(n)], lambda ids: [], "keyword")
+
+
+def test_session_store_history_lru_and_ttl():
+    store = SessionStore(max_sessions=2, ttl_s=60, history=2)
+    store.put("a" * 8, "q1", _results(), "v")
+    store.put("a" * 8, "q2", _results(), "v")
+    store.put("a" * 8, "q1", _results(), "v", ("x",))
+    assert store.get("a" * 8, "v", ("q1", ("x",))).terms == ("x",)
+    assert store.get("a" * 8, "v", ("q1", ())) is None  # chỉ giữ `history` lượt
+    assert store.get("a" * 8, "v2") is None  # catalogue đổi -> bỏ session
+
+    store.put("b" * 8, "q", _results(), "v")
+    store.put("c" * 8, "q", _results(), "v")
+    store.put("d" * 8, "q", _results(), "v")
+    assert store.get("b" * 8, "v") is None and store.evicted == 1
+    assert store.bytes == sum(s.nbytes for _, turns in store._sessions.values() for s in turns)
+
+    expiring = SessionStore(ttl_s=0)
+    expiring.put("e" * 8, "q", _results(), "v")
+    assert expiring.get("e" * 8, "v") is None
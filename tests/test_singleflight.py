@@ -0,0 +1,128 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from Chatbot import SingleFlight
+
+
+class Aborted(BaseException):
+    """Như client ngắt kết nối: không phải Exception, follower không nhận lại."""
+
+
+def _run_concurrently(flight, fn, release, n=5):
+    """Leader chạy trước, n - 1 call trùng vào khi leader còn chờ `release`."""
+    started = threading.Event()
+
+    def leader_fn():
+        started.set()
+        return fn()
+
+    with ThreadPoolExecutor(n) as pool:
+        first = pool.submit(flight.do, "k", leader_fn)
+        started.wait(2)
+        rest = [pool.submit(flight.do, "k", fn) for _ in range(n - 1)]
+        time.sleep(0.05)
+        release.set()
+    return [first] + rest
+
+
+def test_concurrent_calls_share_one_result():
+    flight = SingleFlight("test")
+    calls = []
+    release = threading.Event()
+
+    def fn():
+        calls.append(1)
+        release.wait(2)
+        return "value"
+
+    futures = _run_concurrently(flight, fn, release)
+    assert [f.result(2) for f in futures] == ["value"] * 5
+    assert len(calls) == 1
+    assert flight.do("k", lambda: "again") == "again"  # không cache sau khi xong
+
+
+def test_exception_is_shared():
+    flight = SingleFlight("test")
+    release = threading.Event()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        release.wait(2)
+        raise ValueError("boom")
+
+    futures = _run_concurrently(flight, fn, release, n=3)
+    for future in futures:
+        with pytest.raises(ValueError):
+            future.result(2)
+    assert len(calls) == 1
+
+
+def test_follower_runs_itself_after_wait():
+    flight = SingleFlight("test", wait_s=0.05)
+    release = threading.Event()
+    leader = ThreadPoolExecutor(1)
+    first = leader.submit(flight.do, "k", lambda: release.wait(2) and "leader")
+    time.sleep(0.02)
+    assert flight.do("k", lambda: "own") == "own"
+    release.set()
+    assert first.result(2) == "leader"
+    leader.shutdown()
+
+
+def test_aborted_leader_lets_followers_run():
+    flight = SingleFlight("test")
+    release = threading.Event()
+
+    def abort():
+        release.wait(2)
+        raise Aborted()
+
+    with ThreadPoolExecutor(2) as pool:
+        first = pool.submit(flight.do, "k", abort)
+        time.sleep(0.02)
+        follower = pool.submit(flight.do, "k", lambda: "own")
+        time.sleep(0.02)
+        release.set()
+        with pytest.raises(Aborted):
+            first.result(2)
+        assert follower.result(2) == "own"
+
+
+def test_ado_coalesces_on_one_loop():
+    flight = SingleFlight("test")
+    calls = []
+
+    async def fn(value):
+        calls.append(value)
+        await asyncio.sleep(0.02)
+        return value
+
+    async def main():
+        return await asyncio.gather(*(flight.ado("k", fn, i) for i in range(4)),
+                                    flight.ado("other", fn, "x"))
+
+    assert asyncio.run(main()) == [0, 0, 0, 0, "x"]
+    assert calls == [0, "x"]
+
+
+def test_ado_cancelled_leader_does_not_cancel_followers():
+    flight = SingleFlight("test")
+
+    async def slow(value):
+        await asyncio.sleep(0.05)
+        return value
+
+    async def main():
+        leader = asyncio.create_task(flight.ado("k", slow, "leader"))
+        await asyncio.sleep(0.01)
+        follower = asyncio.create_task(flight.ado("k", slow, "own"))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        return await follower
+
+    assert asyncio.run(main()) == "own"
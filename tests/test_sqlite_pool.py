@@ -0,0 +1,88 @@
+import sqlite3
+
+import pytest
+
+from Chatbot import SQLitePool
+
+
+class Conn:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def make_pool(max_idle=2):
+    made = []
+
+    def factory():
+        made.append(Conn())
+        return made[-1]
+
+    return SQLitePool(factory, max_idle=max_idle), made
+
+
+def test_connection_is_reused():
+    pool, made = make_pool()
+    with pool.connection() as a:
+        pass
+    with pool.connection() as b:
+        pass
+    assert a is b and len(made) == 1
+    assert pool.stats() == {"hits": 1, "misses": 1, "discarded": 0, "idle": 1}
+
+
+def test_caller_error_returns_connection():
+    pool, made = make_pool()
+    with pytest.raises(KeyError):
+        with pool.connection():
+            raise KeyError("caller")
+    assert pool.stats()["idle"] == 1 and not made[0].closed
+
+
+def test_database_error_discards_connection():
+    pool, made = make_pool()
+    with pytest.raises(sqlite3.DatabaseError):
+        with pool.connection():
+            raise sqlite3.DatabaseError("broken")
+    assert made[0].closed
+    assert pool.stats()["idle"] == 0 and pool.stats()["discarded"] == 1
+
+
+def test_abandoned_generator_returns_connection():
+    pool, made = make_pool()
+
+    def rows():
+        with pool.connection() as conn:
+            yield conn
+            yield conn
+
+    gen = rows()
+    next(gen)
+    gen.close()  # GeneratorExit bên trong `with`
+    assert pool.stats()["idle"] == 1
+
+
+def test_full_or_retired_pool_closes_connection():
+    pool, made = make_pool(max_idle=1)
+    with pool.connection():
+        with pool.connection():
+            pass
+    assert pool.stats()["idle"] == 1 and sum(c.closed for c in made) == 1
+    pool.retire()
+    with pool.connection():
+        pass
+    assert all(c.closed for c in made) and pool.stats()["idle"] == 0
+
+
+def test_real_database_connection():
+    from Chatbot import get_db_connection
+
+    pool = SQLitePool(get_db_connection)
+    with pool.connection() as conn:
+        assert conn.execute("SELECT count(*) FROM paintings;").fetchone()[0] > 0
+    with pool.connection() as conn:
+        with pytest.raises(sqlite3.OperationalError):
+            conn.execute("CREATE TABLE x (a);")  # read-only
+    pool.close_all()
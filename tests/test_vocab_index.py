@@ -0,0 +1,102 @@
+import threading
+
+import pytest
+
+import vocab_index
+from Chatbot import STOPWORDS, current_catalog, fold_text
+from vocab_index import VocabIndex, edit_distance, read_query_log
+
+
+def make_docs():
+    docs = []
+    for i in range(100):
+        keywords = "màu xanh, biển, hoàng hôn" if i % 2 else "màu đỏ, hoa sen, đẹp"
+        title = f"Tranh của họa sĩ số {i}"
+        docs.append((title, keywords, "thiên nhiên", "yên bình"))
+    docs.append(("Tranh thác nước", "thác nước", "", ""))
+    return docs
+
+
+QUERIES = [
+    "mình cần tranh biển", "mình muốn tranh hoa", "cần tranh thác nước",
+    "thác nước", "mình tìm thác nước", "cần tranh màu xanh",
+]
+
+
+def make_index():
+    return VocabIndex(make_docs(), fold_text, STOPWORDS, QUERIES)
+
+
+def test_common_content_words_are_not_stopwords():
+    index = make_index()
+    # "mau", "thien", "nhien", "yen", "binh", "cua" đều có trong >= 60% tranh,
+    # nhưng chỉ "cua" là chữ chung chung
+    assert "cua" in index.stopwords
+    assert not {"mau", "thien", "nhien", "yen", "binh"} & index.stopwords
+    assert index.rewrite("tranh thiên nhiên màu xanh").tokens == [
+        "thien", "nhien", "mau", "xanh"]
+
+
+def test_fillers_come_from_logs_but_only_generic_words():
+    index = make_index()
+    assert {"minh", "can"} <= index.fillers
+    assert "thac" not in index.fillers  # hay gặp trong log nhưng là chữ nội dung
+    assert index.rewrite("mình cần thác nước").tokens == ["thac", "nuoc"]
+
+
+def test_short_words_are_only_corrected_inside_phrases():
+    index = make_index()
+    rewrite = index.rewrite("tranh bien hoang hom dpe")
+    assert rewrite.tokens == ["bien", "hoang", "hon", "dpe"]
+    assert rewrite.corrected == {"hom": "hon"}
+    assert index.rewrite("xnah").tokens == ["xnah"]
+    assert index.rewrite("bieen").corrected == {"bieen": "bien"}
+
+
+@pytest.mark.parametrize("query, kept", [
+    ("tranh cửu ngư", "cuu"), ("tranh tài lộc", "loc"), ("thuận buồm xuôi gió", "xuoi"),
+])
+def test_valid_syllables_missing_from_catalogue_are_kept(query, kept):
+    rewrite = current_catalog().vocab_index().rewrite(query)
+    assert kept in rewrite.tokens
+    assert kept not in rewrite.corrected
+
+
+def test_rewrite_cache_is_thread_safe(monkeypatch):
+    monkeypatch.setattr(vocab_index, "REWRITE_CACHE_SIZE", 4)
+    index = make_index()
+    errors = []
+
+    def hammer(offset):
+        try:
+            for i in range(2000):
+                index.rewrite(f"bien {(i + offset) % 7}")
+        except Exception as e:  # noqa: BLE001
+            errors.append(e)
+
+    threads = [threading.Thread(target=hammer, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors and len(index._cache) <= 4
+
+
+def test_known_words_and_phrases():
+    index = make_index()
+    assert index.rewrite("hoa sen").phrases == ["hoa sen"]
+    assert index.rewrite("hoang hom").corrected == {"hom": "hon"}
+    assert index.rewrite("hoa đào").tokens == index.rewrite("hoa dao").tokens
+
+
+def test_edit_distance():
+    assert edit_distance("dpe", "dep", 1) == 1  # đảo 2 ký tự kề
+    assert edit_distance("bieen", "bien", 1) == 1
+    assert edit_distance("abc", "xyz", 1) == 2
+
+
+def test_read_query_log(tmp_path):
+    (tmp_path / "a.csv").write_text("Người dùng,Bot\nhoa sen,x\n,y\n", encoding="utf-8")
+    (tmp_path / "b.jsonl").write_text('{"query": "tranh biển"}\nnot json\n', encoding="utf-8")
+    paths = [str(tmp_path / "a.csv"), str(tmp_path / "b.jsonl")]
+    assert read_query_log(paths) == ["hoa sen", "tranh biển"]
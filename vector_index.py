@@ -0,0 +1,295 @@
+"""
+Vector index cho semantic search trên ma trận vector đã chuẩn hoá theo hàng
+(cosine = inner product). Nhãn của mỗi vector là vị trí hàng trong meta.pkl.
+
+- "exact": numpy, quét toàn bộ (không cần faiss) — mặc định.
+- "flat" / "ivf" / "hnsw": FAISS (faiss-cpu là optional dependency).
+
+    python vector_index.py bench [--rows 100000] [--kinds flat,ivf,hnsw]
+
+so sánh recall@k và latency của từng loại index với đường exact.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+_faiss = False  # chưa import
+
+
+def load_faiss():
+    """Module faiss (import lần đầu cần tới, ~0.2s), None nếu chưa cài."""
+    global _faiss
+    if _faiss is False:
+        try:
+            import faiss
+        except ImportError:  # semantic search vẫn chạy bằng numpy
+            faiss = None
+        _faiss = faiss
+    return _faiss
+
+
+INDEX_KINDS = ("exact", "flat", "ivf", "hnsw")
+SCORE_CHUNK_ROWS = 65536
+# Tập lọc nhỏ hơn ngưỡng này: tính exact trên đúng các hàng đó (nhanh hơn selector).
+EXACT_FILTER_MAX = 4096
+
+
+def index_path(vectors_dir: str, kind: str) -> str:
+    return os.path.join(vectors_dir, f"vectors.{kind}.faiss")
+
+
+def source_stamp(path: str) -> str:
+    """mtime + size của file vector nguồn, để phát hiện index cũ."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return ""
+    return f"{st.st_mtime_ns}:{st.st_size}"
+
+
+def _as_queries(queries) -> np.ndarray:
+    q = np.asarray(queries, dtype="float32")
+    if q.ndim == 1:
+        q = q[None, :]
+    norms = np.linalg.norm(q, axis=1, keepdims=True) + 1e-8
+    return np.ascontiguousarray(q / norms, dtype="float32")
+
+
+def _top_k(scores: np.ndarray, k: int):
+    """(scores, cột) của k giá trị lớn nhất mỗi hàng, giảm dần; thiếu thì pad -1."""
+    n_rows, n_cols = scores.shape
+    out_scores = np.full((n_rows, k), -np.inf, dtype="float32")
+    out_idx = np.full((n_rows, k), -1, dtype=np.int64)
+    kk = min(k, n_cols)
+    if kk <= 0:
+        return out_scores, out_idx
+    if kk < n_cols:
+        part = np.argpartition(-scores, kk - 1, axis=1)[:, :kk]
+    else:
+        part = np.broadcast_to(np.arange(n_cols), (n_rows, n_cols))
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-part_scores, axis=1, kind="stable")
+    out_idx[:, :kk] = np.take_along_axis(part, order, axis=1)
+    out_scores[:, :kk] = np.take_along_axis(part_scores, order, axis=1)
+    return out_scores, out_idx
+
+
+def exact_search(matrix, queries: np.ndarray, k: int, rows=None):
+    """Quét toàn bộ (hoặc chỉ `rows`) bằng ma trận x ma trận, float16 upcast theo khối."""
+    if rows is not None:
+        rows = np.asarray(sorted(set(int(r) for r in rows if 0 <= r < matrix.shape[0])),
+                          dtype=np.int64)
+        block = np.asarray(matrix[rows], dtype="float32")
+        scores, cols = _top_k(queries @ block.T, k)
+        return scores, np.where(cols >= 0, rows[np.maximum(cols, 0)], -1)
+
+    if matrix.dtype == np.float32:
+        return _top_k(queries @ matrix.T, k)
+    scores = np.empty((len(queries), matrix.shape[0]), dtype="float32")
+    for start in range(0, matrix.shape[0], SCORE_CHUNK_ROWS):
+        block = np.asarray(matrix[start:start + SCORE_CHUNK_ROWS], dtype="float32")
+        scores[:, start:start + len(block)] = queries @ block.T
+    return _top_k(scores, k)
+
+
+class VectorIndex:
+    """
+    search(queries, k, allowed=None) -> (scores, rows), shape (n_queries, k),
+    cosine giảm dần; hàng thiếu là -1. `queries` là 1 vector hoặc ma trận.
+    """
+
+    def __init__(self, kind: str, matrix=None, index=None, params: dict = None):
+        if kind not in INDEX_KINDS:
+            raise ValueError(f"unknown vector index kind: {kind}")
+        self.kind = kind
+        self.matrix = matrix
+        self.index = index
+        self.params = params or {}
+        self.size = index.ntotal if index is not None else matrix.shape[0]
+        self.dim = index.d if index is not None else matrix.shape[1]
+
+    @classmethod
+    def exact(cls, matrix):
+        return cls("exact", matrix=matrix)
+
+    @classmethod
+    def build(cls, matrix, kind: str, nlist: int = 0, nprobe: int = 16, hnsw_m: int = 32,
+              ef_construction: int = 80, ef_search: int = 64):
+        """Dựng index FAISS (inner product) từ ma trận đã chuẩn hoá."""
+        if kind == "exact":
+            return cls.exact(matrix)
+        faiss = load_faiss()
+        if faiss is None:
+            raise RuntimeError("faiss chưa được cài (pip install faiss-cpu)")
+        n, dim = matrix.shape
+        params = {}
+        if kind == "flat":
+            index = faiss.IndexFlatIP(dim)
+        elif kind == "ivf":
+            nlist = nlist or max(1, min(int(4 * np.sqrt(n)), n // 39))
+            quantizer = faiss.IndexFlatIP(dim)
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
+            sample = np.random.default_rng(0).choice(n, size=min(n, nlist * 256), replace=False)
+            index.train(np.asarray(matrix[np.sort(sample)], dtype="float32"))
+            params = {"nlist": nlist, "nprobe": min(nprobe, nlist)}
+        elif kind == "hnsw":
+            index = faiss.IndexHNSWFlat(dim, hnsw_m, faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efConstruction = ef_construction
+            params = {"m": hnsw_m, "ef_search": ef_search}
+        else:
+            raise ValueError(f"unknown vector index kind: {kind}")
+        for start in range(0, n, SCORE_CHUNK_ROWS):
+            index.add(np.ascontiguousarray(matrix[start:start + SCORE_CHUNK_ROWS], dtype="float32"))
+        return cls(kind, matrix=matrix, index=index, params=params)
+
+    def save(self, path: str, stamp: str = ""):
+        """Ghi index + manifest (`<path>.json`) theo kiểu tmp + rename."""
+        if self.index is None:
+            raise ValueError("exact index has nothing to persist")
+        tmp = path + ".tmp"
+        load_faiss().write_index(self.index, tmp)
+        os.replace(tmp, path)
+        manifest = {"kind": self.kind, "rows": self.size, "dim": self.dim,
+                    "params": self.params, "source": stamp}
+        with open(path + ".json.tmp", "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(path + ".json.tmp", path + ".json")
+
+    @classmethod
+    def load(cls, path: str, matrix=None, stamp: str = ""):
+        """
+        Mở index đã build (mmap nếu loại index hỗ trợ). Trả None nếu thiếu faiss,
+        thiếu file, hoặc index build từ vector nguồn khác (`stamp`).
+        """
+        faiss = load_faiss()
+        if faiss is None or not (os.path.exists(path) and os.path.exists(path + ".json")):
+            return None
+        with open(path + ".json", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if stamp and manifest.get("source") != stamp:
+            print(f"[VectorIndex] {os.path.basename(path)} cũ hơn vectors.npy -> bỏ qua.")
+            return None
+        try:
+            index = faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError:
+            index = faiss.read_index(path)
+        if matrix is not None and matrix.shape[0] != index.ntotal:
+            matrix = None
+        return cls(manifest["kind"], matrix=matrix, index=index, params=manifest.get("params"))
+
+    def _search_params(self, selector=None):
+        faiss = load_faiss()
+        if self.kind == "ivf":
+            return faiss.SearchParametersIVF(sel=selector, nprobe=self.params.get("nprobe", 16))
+        if self.kind == "hnsw":
+            return faiss.SearchParametersHNSW(sel=selector, efSearch=self.params.get("ef_search", 64))
+        return faiss.SearchParameters(sel=selector) if selector is not None else None
+
+    def search(self, queries, k: int, allowed=None):
+        q = _as_queries(queries)
+        if allowed is not None:
+            allowed = list(allowed)
+            if not allowed:
+                return (np.full((len(q), k), -np.inf, dtype="float32"),
+                        np.full((len(q), k), -1, dtype=np.int64))
+            if self.matrix is not None and (self.index is None or len(allowed) <= EXACT_FILTER_MAX):
+                return exact_search(self.matrix, q, k, rows=allowed)
+        if self.index is None:
+            return exact_search(self.matrix, q, k)
+
+        selector = None
+        if allowed is not None:
+            selector = load_faiss().IDSelectorBatch(np.asarray(allowed, dtype=np.int64))
+        scores, rows = self.index.search(q, k, params=self._search_params(selector))
+        scores = np.where(rows >= 0, scores, -np.inf).astype("float32")
+        return scores, rows
+
+
+# =========================
+# BENCHMARK: recall/latency so với exact
+# =========================
+
+def _percentiles(values_ms):
+    arr = np.asarray(values_ms)
+    return {f"p{p}": round(float(np.percentile(arr, p)), 3) for p in (50, 95, 99)}
+
+
+def bench(matrix, kinds, n_queries: int, k: int, batch: int):
+    rng = np.random.default_rng(1)
+    # query = vector có sẵn + nhiễu, gần với phân bố query thật hơn vector ngẫu nhiên
+    picks = rng.choice(matrix.shape[0], size=n_queries, replace=matrix.shape[0] < n_queries)
+    queries = np.asarray(matrix[picks], dtype="float32")
+    queries = _as_queries(queries + rng.standard_normal(queries.shape).astype("float32") * 0.05)
+
+    exact = VectorIndex.exact(matrix)
+    _, truth = exact.search(queries, k)
+    report = {}
+    for kind in ["exact"] + [kd for kd in kinds if kd != "exact"]:
+        start = time.perf_counter()
+        index = exact if kind == "exact" else VectorIndex.build(matrix, kind)
+        build_s = time.perf_counter() - start
+
+        latencies = []
+        found = []
+        for q in queries:
+            t = time.perf_counter()
+            _, rows = index.search(q, k)
+            latencies.append((time.perf_counter() - t) * 1000)
+            found.append(rows[0])
+        recall = np.mean([len(set(f) & set(t)) / k for f, t in zip(found, truth)])
+
+        t = time.perf_counter()
+        for startq in range(0, n_queries, batch):
+            index.search(queries[startq:startq + batch], k)
+        batched_qps = n_queries / (time.perf_counter() - t)
+
+        report[kind] = {"build_s": round(build_s, 3), f"recall@{k}": round(float(recall), 4),
+                        "latency_ms": _percentiles(latencies),
+                        "batched_qps": round(batched_qps, 1), "params": index.params}
+        print(f"{kind:<6} recall@{k}={recall:.4f}  p50={report[kind]['latency_ms']['p50']}ms  "
+              f"p99={report[kind]['latency_ms']['p99']}ms  batch{batch}={batched_qps:.0f} q/s  "
+              f"build={build_s:.2f}s")
+    return report
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Vector index tools.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("bench", help="recall/latency of FAISS indexes vs exact numpy")
+    p.add_argument("--vectors", help="row-normalized .npy (default: synthetic data)")
+    p.add_argument("--rows", type=int, default=100_000, help="synthetic rows")
+    p.add_argument("--dim", type=int, default=1536, help="synthetic dimension")
+    p.add_argument("--kinds", default="flat,ivf,hnsw")
+    p.add_argument("--queries", type=int, default=200)
+    p.add_argument("--k", type=int, default=10)
+    p.add_argument("--batch", type=int, default=32)
+    p.add_argument("--out", help="write the report as JSON")
+    args = parser.parse_args(argv)
+
+    if args.vectors:
+        matrix = np.load(args.vectors, mmap_mode="r")
+    else:
+        # dữ liệu tổng hợp có cụm (giống embedding thật hơn nhiễu đều)
+        rng = np.random.default_rng(0)
+        centers = rng.standard_normal((max(1, args.rows // 100), args.dim)).astype("float32")
+        matrix = centers[rng.integers(0, len(centers), args.rows)]
+        matrix += rng.standard_normal(matrix.shape).astype("float32") * 0.5
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    kinds = [k for k in args.kinds.split(",") if k]
+    if load_faiss() is None and any(k != "exact" for k in kinds):
+        print("⚠️  faiss chưa được cài -> chỉ đo exact.")
+        kinds = ["exact"]
+    report = bench(matrix, kinds, args.queries, args.k, args.batch)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"rows": int(matrix.shape[0]), "dim": int(matrix.shape[1]), "k": args.k,
+                       "results": report}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
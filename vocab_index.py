@@ -0,0 +1,306 @@
+"""
+Từ vựng của catalogue (title/keywords/themes/emotions, đã fold dấu) để viết
+lại câu hỏi trước khi retrieval, hoàn toàn local (không gọi API):
+
+- trie theo chữ của các cụm nhiều chữ trong keywords/themes/emotions
+  ("hoang hon", "thien nhien"...): chữ nằm trong cụm không bị coi là stopword.
+- trigram + Damerau-Levenshtein: sửa lỗi gõ / thừa chữ ("bieen" -> "bien",
+  "hoang hom" -> "hoang hon" nhờ ngữ cảnh cụm). Âm tiết ngắn chỉ được sửa
+  trong cụm: "cuu", "loc" lạ với catalogue vẫn là chữ tiếng Việt đúng.
+- stopword suy ra từ dữ liệu: chữ có trong phần lớn tranh (STOPWORD_DF), và
+  chữ đệm hay gặp trong log câu hỏi nhưng hiếm trong catalogue ("minh can mua").
+  Cả hai chỉ lấy chữ nằm trong danh sách chữ chung chung GENERIC_WORDS, nên chữ
+  nội dung phổ biến ("mau", "thien nhien", "thac") không bao giờ bị bỏ.
+
+Kết quả rewrite được cache theo câu (LRU), nên câu lặp lại gần như miễn phí.
+"""
+import csv
+import json
+import re
+import threading
+from collections import Counter, OrderedDict
+from typing import Optional
+
+WORD_RE = re.compile(r"[a-z0-9]+")
+
+# Chữ có trong >= tỉ lệ tranh này: không phân biệt được tranh nào.
+STOPWORD_DF = 0.6
+# Chữ (đã fold) được phép thành stopword / chữ đệm khi dữ liệu cũng cho thấy vậy:
+# từ chức năng, đại từ, động từ "tìm / mua", từ hỏi, tiểu từ cuối câu.
+GENERIC_WORDS = frozenset("""
+    tranh buc con hinh anh ve cai chiec bo mot cac nhung nhieu may
+    cua va voi cho la co o trong tren duoi ngoai nay kia do ay thi ma de
+    toi minh em ban anh chi shop ad
+    can muon tim kiem xem mua dat goi y giup xin hay nao gi dau sao khong
+    nhe nha a oi nhi ha vay thoi roi duoc dang se da rat lam qua hon
+    loai kieu kieu dang phu hop
+""".split())
+# Chữ đệm từ log: xuất hiện >= FILLER_MIN_QUERIES câu và tỉ lệ trong câu hỏi
+# cao gấp >= FILLER_RATIO lần tỉ lệ trong catalogue.
+FILLER_MIN_QUERIES = 3
+FILLER_RATIO = 5.0
+# Sửa chữ lạ từ 3 ký tự ("hoang hom"). Âm tiết ngắn cách nhau 1 ký tự quá nhiều
+# ("cuu" / "cuc", "loc" / "hoc"), nên chữ < COMMON_CORRECT_LEN ký tự chỉ được sửa
+# khi nằm trong cụm của catalogue; chữ lẻ giữ nguyên (keyword trượt -> semantic).
+MIN_CORRECT_LEN = 3
+COMMON_CORRECT_LEN = 5
+REWRITE_CACHE_SIZE = 4096
+
+
+def read_query_log(paths) -> list:
+    """Câu hỏi trong log: *.csv (cột "Người dùng") và *.jsonl ("query")."""
+    queries = []
+    for path in paths:
+        if path.endswith(".csv"):
+            with open(path, encoding="utf-8", newline="") as f:
+                for row in csv.DictReader(f):
+                    q = (row.get("Người dùng") or "").strip()
+                    if q:
+                        queries.append(q)
+        else:
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        q = (json.loads(line).get("query") or "").strip()
+                    except ValueError:
+                        continue
+                    if q:
+                        queries.append(q)
+    return queries
+
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    """Damerau-Levenshtein (optimal string alignment); > limit thì trả limit + 1."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    prev2 = None
+    prev = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        cur = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + cost)
+            if (prev2 is not None and i > 1 and j > 1
+                    and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]):
+                cur[j] = min(cur[j], prev2[j - 2] + 1)
+        if min(cur) > limit:
+            return limit + 1
+        prev2, prev = prev, cur
+    return prev[-1]
+
+
+ALPHABET = "abcdefghijklmnopqrstuvwxyz0123456789"
+
+
+def _edits1(word: str) -> set:
+    """Mọi chữ cách `word` đúng 1 thao tác (xoá, đảo 2 ký tự kề, thay, chèn)."""
+    splits = [(word[:i], word[i:]) for i in range(len(word) + 1)]
+    edits = {a + b[1:] for a, b in splits if b}
+    edits.update(a + b[1] + b[0] + b[2:] for a, b in splits if len(b) > 1)
+    edits.update(a + c + b[1:] for a, b in splits if b for c in ALPHABET)
+    edits.update(a + c + b for a, b in splits for c in ALPHABET)
+    edits.discard(word)
+    return edits
+
+
+def _trigrams(word: str) -> set:
+    padded = f"^{word}$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class QueryRewrite:
+    """Kết quả rewrite: tokens cho retrieval + các thay đổi (cho log / metrics)."""
+
+    __slots__ = ("tokens", "phrases", "corrected", "dropped")
+
+    def __init__(self, tokens, phrases, corrected, dropped):
+        self.tokens = tokens
+        self.phrases = phrases
+        self.corrected = corrected
+        self.dropped = dropped
+
+
+class VocabIndex:
+    def __init__(self, docs, fold, base_stopwords=(), queries=(),
+                 generic_words=GENERIC_WORDS):
+        """
+        `docs`: mỗi tranh là list giá trị SEARCH_COLUMNS (chuỗi, list phân cách
+        bằng dấu phẩy); `fold`: hàm fold dấu dùng chung với keyword search;
+        `queries`: câu hỏi trong log (để suy ra chữ đệm); `generic_words`: chữ
+        được phép thành stopword / chữ đệm suy ra từ dữ liệu.
+        """
+        self.fold = fold
+        self.df = Counter()
+        self.phrase_trie = {}
+        self.phrase_count = 0
+        self.docs = 0
+        for values in docs:
+            self.docs += 1
+            words = set()
+            for value in values:
+                for item in (value or "").split(","):
+                    item_words = WORD_RE.findall(fold(item))
+                    words.update(item_words)
+                    if len(item_words) >= 2:
+                        self._add_phrase(item_words)
+            self.df.update(words)
+        self.docs = max(1, self.docs)
+
+        self.grams = {}
+        for word in self.df:
+            for gram in _trigrams(word):
+                self.grams.setdefault(gram, []).append(word)
+
+        self.generic_words = frozenset(generic_words)
+        self.base_stopwords = set(base_stopwords)
+        self.stopwords = set(base_stopwords)
+        self.stopwords.update(
+            w for w, n in self.df.items()
+            if n / self.docs >= STOPWORD_DF and w in self.generic_words
+        )
+        self.fillers = self._derive_fillers(queries) & self.generic_words
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+    def _add_phrase(self, words):
+        node = self.phrase_trie
+        for word in words:
+            node = node.setdefault(word, {})
+        if "" not in node:
+            node[""] = " ".join(words)
+            self.phrase_count += 1
+
+    def _derive_fillers(self, queries) -> set:
+        if not queries:
+            return set()
+        counts = Counter()
+        for query in queries:
+            counts.update(set(WORD_RE.findall(self.fold(query))))
+        fillers = set()
+        for word, n in counts.items():
+            if n < FILLER_MIN_QUERIES:
+                continue
+            query_rate = n / len(queries)
+            catalog_rate = self.df.get(word, 0) / self.docs
+            if query_rate >= FILLER_RATIO * max(catalog_rate, 1.0 / self.docs):
+                fillers.add(word)
+        return fillers
+
+    def __len__(self):
+        return len(self.df)
+
+    def candidates(self, word: str) -> list:
+        """
+        Chữ gần `word` (edit distance 1, hoặc 2 nếu >= 7 ký tự), tốt nhất trước:
+        gần hơn, rồi đảo chữ ("dpe" -> "dep") trước, rồi phổ biến hơn.
+        """
+        if len(word) < MIN_CORRECT_LEN or word.isdigit():
+            return []
+        if len(word) < COMMON_CORRECT_LEN:
+            # chữ ngắn ít trigram chung với chữ đúng: sinh thẳng các biến thể
+            nearby = [(1, other) for other in _edits1(word) if other in self.df]
+        else:
+            limit = 2 if len(word) >= 7 else 1
+            shared = Counter()
+            for gram in _trigrams(word):
+                for other in self.grams.get(gram, ()):
+                    shared[other] += 1
+            nearby = []
+            for other, _ in shared.most_common(64):
+                if other == word:
+                    continue
+                dist = edit_distance(word, other, limit)
+                if dist <= limit:
+                    nearby.append((dist, other))
+        letters = sorted(word)
+        found = sorted(
+            (dist, sorted(other) != letters, -self.df[other], other) for dist, other in nearby
+        )
+        return [other for *_, other in found]
+
+    def _match_phrase(self, words, start, options):
+        """
+        (độ dài, chữ đã chọn) của cụm dài nhất bắt đầu ở `start`, hoặc (0, None).
+        Cụm chỉ gồm stopword gốc / chữ đệm ("buc tranh") không tính.
+        """
+        best = (0, None, 0)  # (length, words, substitutions)
+        stack = [(self.phrase_trie, start, [], 0)]
+        while stack:
+            node, pos, chosen, subs = stack.pop()
+            if "" in node and len(chosen) >= 2 and not all(
+                w in self.base_stopwords or w in self.fillers for w in chosen
+            ):
+                length = len(chosen)
+                if length > best[0] or (length == best[0] and subs < best[2]):
+                    best = (length, list(chosen), subs)
+            if pos >= len(words):
+                continue
+            for word in options[pos]:
+                child = node.get(word)
+                if child is not None:
+                    stack.append((child, pos + 1, chosen + [word], subs + (word != words[pos])))
+        return best[0], best[1]
+
+    def rewrite(self, query: str) -> QueryRewrite:
+        key = " ".join(WORD_RE.findall(self.fold(query)))
+        with self._cache_lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                return cached
+        result = self._rewrite(key.split())
+        with self._cache_lock:
+            self._cache[key] = result
+            while len(self._cache) > REWRITE_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return result
+
+    def _isolated_correction(self, word: str, options) -> Optional[str]:
+        """Chữ sửa cho `word` nằm ngoài cụm (None: giữ nguyên, kể cả âm tiết ngắn)."""
+        if word in self.df or not options or len(word) < COMMON_CORRECT_LEN:
+            return None
+        return options[0]
+
+    def _rewrite(self, words) -> QueryRewrite:
+        # Lựa chọn cho từng chữ: chính nó nếu có trong từ vựng, nếu không thì các chữ gần nó.
+        options = [
+            [word] if word in self.df or word in self.fillers else self.candidates(word)[:3]
+            for word in words
+        ]
+
+        tokens, phrases, corrected, dropped = [], [], {}, []
+        pos = 0
+        while pos < len(words):
+            length, chosen = self._match_phrase(words, pos, options)
+            if length:
+                phrases.append(" ".join(chosen))
+                for original, word in zip(words[pos:pos + length], chosen):
+                    if word != original:
+                        corrected[original] = word
+                    tokens.append(word)
+                pos += length
+                continue
+
+            word = words[pos]
+            pos += 1
+            if word in self.stopwords or word in self.fillers:
+                dropped.append(word)
+                continue
+            fixed = self._isolated_correction(word, options[pos - 1])
+            if fixed is None:
+                tokens.append(word)  # chữ đã biết, hoặc không sửa được: giữ nguyên
+            else:
+                corrected[word] = fixed
+                tokens.append(fixed)
+
+        if not tokens:  # toàn stopword: để keyword search xử lý như cũ
+            tokens, dropped = [w for w in words if w not in self.stopwords], []
+        return QueryRewrite(list(dict.fromkeys(tokens)), phrases, corrected, dropped)
+
+    def stats(self) -> dict:
+        return {
+            "words": len(self.df),
+            "phrases": self.phrase_count,
+            "stopwords": len(self.stopwords),
+            "fillers": len(self.fillers),
+        }